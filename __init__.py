@@ -9,6 +9,8 @@ try:
 except NameError:
     pass  # load_translations() added in calibre 1.9
 
+import sys
+
 # The class that all Interface Action plugin wrappers must inherit from
 from calibre.customize import InterfaceActionBase
 
@@ -75,6 +77,14 @@ class ActionCommentsCleaner(InterfaceActionBase):
         :param config_widget: The widget returned by :meth:`config_widget`.
         '''
         config_widget.save_settings()
+    
+    def cli_main(self, args):
+        '''
+        Clean a library from the command line, without the GUI:
+        calibre-debug -r "Comments Cleaner" -- --help
+        '''
+        from .cli import main
+        sys.exit(main(args[1:]))
 
 
 # For testing, run from command line with this:
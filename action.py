@@ -9,23 +9,53 @@ try:
 except NameError:
     pass  # load_translations() added in calibre 1.9
 
+import hashlib
+import json
+import os
+import time
 from collections import defaultdict
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from threading import Event
+from typing import Dict, List, Optional
 
 try:
-    from qt.core import QMenu, QTimer, QToolButton
+    from qt.core import QApplication, QMenu, QThread, QTimer, QToolButton, pyqtSignal
 except ImportError:
-    from PyQt5.Qt import QMenu, QTimer, QToolButton
+    from PyQt5.Qt import QApplication, QMenu, QThread, QTimer, QToolButton, pyqtSignal
 
+from calibre.gui2 import info_dialog, question_dialog, warning_dialog
 from calibre.gui2.actions import InterfaceAction
+from calibre.utils.config import config_dir
+from calibre.utils.ipc.simple_worker import fork_job
 
-from .comments_cleaner import clean_comment, normalize_comment
+from . import ActionCommentsCleaner
+from .cache import ResultCache, fingerprint
+from .comments_cleaner import Cleaner, CommentTimeout, clean_batch, normalize_comment
 from .common_utils import GUI, PLUGIN_NAME, debug_print, get_icon
 from .common_utils.columns import get_html
 from .common_utils.dialogs import ProgressDialog, custom_exception_dialog
 from .common_utils.librarys import get_BookIds_selected
 from .common_utils.menus import create_menu_action_unique
-from .config import CALIBRE_HAS_NOTES, KEY, NOTES_ICON, PLUGIN_ICON, PREFS, SelectNotesDialog
+from .config import NOTES_ICON, PLUGIN_ICON, PREFS, PreviewDialog, SelectNotesDialog
+from .log import CHANGED, FULL, SUMMARY, CleanerLog
+from .preview import CleaningPreview
+from .profiler import RuleProfiler, RuleRecorder
+from .settings import CALIBRE_HAS_NOTES, CALIBRE_VERSIONS_BOLD, KEY
+
+# below, the start of the worker processes cost more than the cleaning
+PARALLEL_MIN_BOOKS = 500
+PARALLEL_MIN_BATCH = 250
+# seconds, for a batch
+PARALLEL_TIMEOUT = 3600
+
+# books by transaction, when the commits are done by chunks
+CHUNK_SIZE = 500
+
+# seconds, min interval between two updates of the progress bar
+PROGRESS_INTERVAL = 0.1
+# milliseconds, max delay to process the GUI events (Cancel button) while the cleaning run
+PROGRESS_WAIT = 50
 
 
 class CommentsCleanerAction(InterfaceAction):
@@ -37,7 +67,7 @@ class CommentsCleanerAction(InterfaceAction):
     action_type = 'current'
     dont_add_to = frozenset(['context-menu-device'])
     accepts_drops = True
-
+    
     def genesis(self):
         self.menu = QMenu(GUI)
         self.qaction.setMenu(self.menu)
@@ -56,6 +86,10 @@ class CommentsCleanerAction(InterfaceAction):
                                         triggered=self.clean_comments,
                                         unique_name='Clean the selected &comments')
         
+        create_menu_action_unique(self, m, _('&Preview the cleaning of the selected comments'), 'search.png',
+                                        triggered=self.preview_comments,
+                                        unique_name='Preview the cleaning of the selected comments')
+        
         if CALIBRE_HAS_NOTES:
             create_menu_action_unique(self, m, _('Clean category &notes'), NOTES_ICON,
                                         triggered=self.clean_notes,
@@ -106,8 +140,38 @@ class CommentsCleanerAction(InterfaceAction):
     def clean_notes(self):
         self._clean_notes(get_BookIds_selected(show_error=False))
     
+    def preview_comments(self):
+        book_ids = get_BookIds_selected(show_error=True)
+        if not book_ids:
+            return
+        
+        # dry run, nothing is written in the library
+        d = CleanerProgressDialog(book_ids, dry_run=True)
+        if d.wasCanceled() or d.exception:
+            return
+        
+        preview = d.preview
+        if not preview.books:
+            info_dialog(GUI, _('No change'),
+                _('The cleaning does not change the comments of the {:d} selected books.').format(len(book_ids)),
+                show=True)
+            return
+        
+        # write the comments already cleaned by the dry run
+        if PreviewDialog(preview).exec():
+            CleanerProgressDialog(list(preview.books), confirmed=preview)
+    
     def _clean_comments(self, book_ids: List[int]):
-        CleanerProgressDialog(book_ids)
+        resume = 0
+        if book_ids and PREFS[KEY.CHUNKED]:
+            checkpoint = read_checkpoint()
+            if checkpoint and checkpoint_match(checkpoint, GUI.current_db.new_api.library_id, book_ids):
+                if question_dialog(GUI, _('Resume the cleaning'),
+                        _('A previous cleaning of this selection was interrupted after {:d} of {:d} books.\n'
+                          'Resume it from there?').format(checkpoint['done'], len(book_ids))):
+                    resume = checkpoint['done']
+        
+        CleanerProgressDialog(book_ids, resume=resume)
     
     def _clean_notes(self, book_ids: List[int]):
         d = SelectNotesDialog(book_ids)
@@ -120,6 +184,72 @@ class CommentsCleanerAction(InterfaceAction):
         CleanerNoteProgressDialog(notes_lst)
 
 
+def open_cache(prefs: dict) -> Optional[ResultCache]:
+    '''
+    the cache of the results for this settings, None if disabled or on error
+    '''
+    if not PREFS[KEY.CACHE]:
+        return None
+    
+    # the options that don't change the result
+    ignored = (KEY.CUSTOM_COLUMN, KEY.PARALLEL, KEY.CACHE, KEY.CHUNKED, KEY.PROFILE, KEY.TIME_BUDGET, KEY.PREFILTER,
+               KEY.LOG_LEVEL, KEY.LOG_FILE)
+    prefs = {k:v for k,v in prefs.items() if k not in ignored}
+    try:
+        return ResultCache(
+            os.path.join(config_dir, 'plugins', PLUGIN_NAME+'.cache.sqlite'),
+            fingerprint(prefs, CALIBRE_VERSIONS_BOLD, ActionCommentsCleaner.version),
+        )
+    except Exception as e:
+        debug_print('Unable to open the cache:', e)
+        return None
+
+
+def close_cache(cache: Optional[ResultCache]):
+    if cache:
+        debug_print(f'Cache: {cache.hits} hits, {cache.misses} misses.')
+        try:
+            cache.close()
+        except Exception as e:
+            debug_print('Unable to write the cache:', e)
+
+
+CHECKPOINT = os.path.join(config_dir, 'plugins', PLUGIN_NAME+'.checkpoint.json')
+PROFILE_FILE = os.path.join(config_dir, 'plugins', PLUGIN_NAME+'.profile.tsv')
+LOG_FILE = os.path.join(config_dir, 'plugins', PLUGIN_NAME+'.log')
+
+
+def selection_hash(book_ids: List[int]) -> str:
+    return hashlib.sha1(','.join(map(str, book_ids)).encode('ascii')).hexdigest()
+
+
+def read_checkpoint() -> Optional[dict]:
+    '''
+    the state of the last cleaning by chunks that was interrupted, if any
+    '''
+    try:
+        with open(CHECKPOINT, encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def checkpoint_match(checkpoint: dict, library_id: str, book_ids: List[int]) -> bool:
+    return (checkpoint.get('library_id') == library_id
+            and checkpoint.get('selection') == selection_hash(book_ids)
+            and 0 < checkpoint.get('done', 0) < len(book_ids))
+
+
+def write_checkpoint(library_id: str, book_ids: List[int], done: int):
+    with open(CHECKPOINT, 'w', encoding='utf-8') as f:
+        json.dump({'library_id': library_id, 'selection': selection_hash(book_ids), 'done': done}, f)
+
+
+def remove_checkpoint():
+    if os.path.exists(CHECKPOINT):
+        os.remove(CHECKPOINT)
+
+
 def debug_text(pre, text=None):
     debug_print(pre+':::')
     if text:
@@ -127,119 +257,484 @@ def debug_text(pre, text=None):
     print()
 
 
-class CleanerProgressDialog(ProgressDialog):
+def clean_texts(cleaner, items: List[tuple], is_canceled, progress, memo: Optional[dict]=None) -> List[tuple]:
+    '''
+    clean the items (key, text)
+    return a list of (key, text, text normalized, text cleaned)
+    the text cleaned is None if the cleaning exceeded the time budget of the cleaner
     
-    def setup_progress(self, **kvargs):
+    memo is the map {text normalized: text cleaned} of the texts already cleaned in the chunk,
+    the identical texts (omnibus, formats of a same book...) are only cleaned once
+    
+    progress(num) is called at most every PROGRESS_INTERVAL
+    '''
+    if memo is None:
+        memo = {}
+    rslt = []
+    last = time.monotonic()
+    for num, (key, text) in enumerate(items, 1):
+        if is_canceled():
+            break
+        text_norm = normalize_comment(text)
+        if text_norm in memo:
+            text_out = memo[text_norm]
+        else:
+            try:
+                text_out = cleaner(text_norm)
+            except CommentTimeout:
+                text_out = None
+            memo[text_norm] = text_out
+        rslt.append((key, text, text_norm, text_out))
+        
+        now = time.monotonic()
+        if now - last >= PROGRESS_INTERVAL:
+            last = now
+            progress(num)
+    
+    return rslt
+
+
+class CleanerThread(QThread):
+    '''
+    clean the items outside the GUI thread, see clean_texts()
+    '''
+    
+    progress = pyqtSignal(int)
+    
+    def __init__(self, cleaner, items: List[tuple], memo: Optional[dict]=None):
+        QThread.__init__(self)
+        self.cleaner = cleaner
+        self.items = items
+        self.memo = memo
+        self.canceled = Event()
+        self.results = []
+        self.exception = None
+    
+    def run(self):
+        try:
+            self.results = clean_texts(self.cleaner, self.items, self.canceled.is_set, self.progress.emit, self.memo)
+        except Exception as e:
+            self.exception = e
+
+
+class CleanerBaseProgressDialog(ProgressDialog):
+    '''
+    common part of the comments and notes progress dialogs: the cleaning of the texts
+    
+    the texts are cleaned in a worker thread, in worker processes for the large selections,
+    or in the GUI thread for the Calibre comments editor
+    '''
+    
+    def setup_cleaner(self, prefs: dict, count: int, preview: Optional[CleaningPreview]=None):
+        
+        self.used_prefs = prefs
+        # dry run, the cleaned texts and their statistics are keep in the preview
+        self.preview = preview
+        # log of the job, the messages are only built for the enabled level
+        self.log = CleanerLog(PREFS[KEY.LOG_LEVEL], LOG_FILE if PREFS[KEY.LOG_FILE] else None, console=debug_print)
+        # seconds by comment, the slower comments are skipped
+        self.time_budget = PREFS[KEY.TIME_BUDGET] or None
+        # skip the comments already clean, see Cleaner.is_clean()
+        self.prefilter = None if PREFS[KEY.PREFILTER] == 'none' else PREFS[KEY.PREFILTER]
+        self.cleaner = self.base_cleaner = Cleaner(self.used_prefs, time_budget=self.time_budget,
+                                                   prefilter=self.prefilter)
+        
+        # statistics of the rules, all the texts must be cleaned in this process
+        self.profiler = None
+        if PREFS[KEY.PROFILE] != 'none':
+            self.profiler = RuleProfiler(self.base_cleaner)
+            self.profiler.start()
+        # the rules that changed each text for the preview, the profiler record them too
+        self.recorder = None
+        if self.preview:
+            self.recorder = self.profiler or RuleRecorder(self.base_cleaner)
+            self.recorder.start()
+            # inside the cache, the rules are only known for the texts really cleaned
+            self.cleaner = self.preview.wrap(self.cleaner, self.recorder)
+        
+        self.cache = None if self.profiler else open_cache(self.used_prefs)
+        if self.cache:
+            self.cleaner = self.cache.wrap(self.cleaner)
+        
+        # total count for the progress bar
+        self.progress_count = count
+        
+        # the Calibre comments editor need the GUI thread
+        self.gui_thread = self.used_prefs[KEY.FORMATTER] == 'calibre'
+        # parallel cleaning, the texts are cleaned by batch in worker processes
+        # the profiler and the preview record the rules in this process
+        self.parallel = (PREFS[KEY.PARALLEL] and not self.gui_thread and not self.profiler and not self.preview
+                            and self.prefilter != 'validate' and count >= PARALLEL_MIN_BOOKS)
         
-        self.used_prefs = PREFS.copy()
-        self.used_prefs.pop(KEY.NOTES_SETTINGS, None)
+        # texts already cleaned in the chunk {text normalized: text cleaned}, for the identical texts
+        self.memo = {}
+        self.texts_count = 0
+        # identical texts cleaned only once
+        self.duplicates = 0
         
-        # book comment map
-        self.books_comments_map = {'comments':{}}
+        # texts that exceeded the time budget
+        self.skipped = []
+        
+        # Exception
+        self.exception = None
+    
+    def end_cleaner(self):
+        
+        close_cache(self.cache)
+        
+        # the counters of the worker processes of the parallel cleaning are added to it
+        cleaner = self.base_cleaner
+        if self.duplicates:
+            self.log.print(SUMMARY, f'Identical texts: {self.duplicates} of {self.texts_count} texts cleaned only once '
+                                    f'({self.duplicates/self.texts_count:0.1%}).')
+        if cleaner.second_passes:
+            self.log.print(SUMMARY, f'Second passe: needed for {cleaner.second_passes} texts, '
+                        f'{cleaner.second_changes} changed by it.')
+        if cleaner.prefiltered:
+            self.log.print(SUMMARY, f'Prefilter: {cleaner.prefiltered} texts already clean.')
+        if self.prefilter == 'validate':
+            debug_print(f'Prefilter validation: {len(cleaner.prefilter_errors)} texts changed by the cleaning, '
+                        f'{cleaner.prefilter_missed} texts unchanged but not recognized.')
+            for text in cleaner.prefilter_errors:
+                debug_text('Changed by the cleaning', text)
+        
+        if self.recorder:
+            self.recorder.stop()
+        if self.profiler:
+            self.profiler.stop()
+        if self.profiler and PREFS[KEY.PROFILE] != 'none':
+            debug_print('Statistics of the cleaning rules:\n'+self.profiler.summary()+'\n')
+            if PREFS[KEY.PROFILE] == 'file':
+                try:
+                    self.profiler.write(PROFILE_FILE)
+                    debug_print('Statistics saved in:', PROFILE_FILE, '\n')
+                except Exception as e:
+                    debug_print('Unable to save the statistics:', e)
+        
+        if self.skipped and not self.wasCanceled() and not self.exception:
+            debug_print(f'{len(self.skipped)} texts skipped, time budget of {self.time_budget} seconds exceeded:')
+            for info in self.skipped:
+                debug_print('   ', info)
+            print()
+            warning_dialog(self, _('Time budget exceeded'),
+                _('{:d} texts took too long to be cleaned and were skipped.').format(len(self.skipped)),
+                det_msg='\n'.join(self.skipped), show=True)
+    
+    def clean_items(self, items: List[tuple], start: int=0, count: Optional[int]=None) -> List[tuple]:
+        '''
+        clean the items (key, text)
+        return a list of (key, text, text normalized, text cleaned)
+        
+        the progress bar go from start to start+count (default: all the progress count)
+        the text cleaned is None if the cleaning exceeded the time budget
+        '''
+        self.texts_count += len(items)
+        if self.parallel:
+            rslt = self.clean_parallel(items)
+        else:
+            rslt = self.clean_serial(items, start, count)
+        
+        # the memo only keep the texts of the chunk, it don't grow with the selection
+        self.duplicates += len(rslt) - len(self.memo)
+        self.memo.clear()
+        return rslt
+    
+    def clean_serial(self, items: List[tuple], start: int=0, count: Optional[int]=None) -> List[tuple]:
+        '''
+        clean the items in a worker thread, or in the GUI thread for the Calibre comments editor
+        '''
+        if count is None:
+            count = self.progress_count - start
+        
+        def progress(num):
+            self.set_value(start + num * count // len(items))
+        
+        if self.gui_thread:
+            def is_canceled():
+                QApplication.processEvents()
+                return self.wasCanceled()
+            return clean_texts(self.cleaner, items, is_canceled, progress, self.memo)
+        
+        thread = CleanerThread(self.cleaner, items, self.memo)
+        thread.progress.connect(progress)
+        thread.start()
+        while not thread.wait(PROGRESS_WAIT):
+            QApplication.processEvents()
+            if self.wasCanceled():
+                thread.canceled.set()
+        QApplication.processEvents()
+        
+        if thread.exception:
+            raise thread.exception
+        return thread.results
+    
+    def clean_parallel(self, items: List[tuple]) -> List[tuple]:
+        '''
+        clean the items (key, text) in a pool of worker processes,
+        one batch by worker, the identical texts are sent once
+        '''
+        rslt = []
+        # {text normalized: [(key, text, text normalized)]}
+        pending = {}
+        for key, text in items:
+            text_norm = normalize_comment(text)
+            if text_norm not in self.memo and text_norm not in pending:
+                text_out = self.cache.get(text_norm) if self.cache else None
+                if text_out is None:
+                    pending[text_norm] = []
+                else:
+                    self.memo[text_norm] = text_out
+            if text_norm in pending:
+                pending[text_norm].append((key, text, text_norm))
+            else:
+                rslt.append((key, text, text_norm, self.memo[text_norm]))
+        
+        if not pending:
+            return rslt
+        
+        # the texts are sent by index, the copies of each one are kept in this process
+        distinct = list(pending)
+        indexed = list(enumerate(distinct))
+        workers = max(1, min(os.cpu_count() or 1, len(indexed) // PARALLEL_MIN_BATCH))
+        size = -(-len(indexed) // workers)
+        batches = [indexed[i:i+size] for i in range(0, len(indexed), size)]
+        
+        self.log.print(SUMMARY, f'Cleaning {len(distinct)} texts in {len(batches)} processes…\n')
+        self.set_value(-1, text=_('Cleaning {:d} texts in {:d} processes…').format(len(distinct), len(batches)))
+        
+        abort = Event()
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            jobs = [executor.submit(fork_job, clean_batch.__module__, clean_batch.__name__,
+                                        args=(self.used_prefs, batch, self.time_budget, self.prefilter),
+                                        timeout=PARALLEL_TIMEOUT, abort=abort)
+                    for batch in batches]
+            waiting = set(jobs)
+            while waiting:
+                if self.wasCanceled():
+                    # the running workers are killed by the abort event, the others never start
+                    # the end of the "with" wait the running ones, don't return inside it
+                    abort.set()
+                    for job in waiting:
+                        job.cancel()
+                    break
+                done, waiting = wait(waiting, timeout=PROGRESS_WAIT/1000, return_when=FIRST_COMPLETED)
+                QApplication.processEvents()
+        
+        if self.wasCanceled():
+            # only the texts already cleaned, like clean_texts()
+            return rslt
+        
+        for job in jobs:
+            results, counters = job.result()['result']
+            # the counters of the worker processes, for end_cleaner()
+            self.base_cleaner.add_counters(counters)
+            for idx, _text_norm, text_out in results:
+                text_norm = distinct[idx]
+                self.memo[text_norm] = text_out
+                if self.cache and text_out is not None:
+                    self.cache.set(text_norm, text_out)
+                # the texts of this process, a normalized text is the same object if unchanged
+                for key, text, text_norm in pending[text_norm]:
+                    rslt.append((key, text, text_norm, text_out))
+        
+        return rslt
+
+
+class CleanerProgressDialog(CleanerBaseProgressDialog):
+    
+    def setup_progress(self, resume=0, dry_run=False, confirmed=None, **kvargs):
+        
+        prefs = PREFS.copy()
+        prefs.pop(KEY.NOTES_SETTINGS, None)
+        self.setup_cleaner(prefs, len(self.book_ids), preview=CleaningPreview() if dry_run else None)
+        # preview of a dry run to write, the comments are not cleaned again
+        self.confirmed = confirmed
+        
+        # fields to clean
+        self.fields = ['comments']
         # book custom columns dic
         if self.used_prefs[KEY.CUSTOM_COLUMN]:
-            self.books_comments_map.update({cc:{} for cc in get_html(True)})
+            self.fields.extend(get_html(True))
+        
+        # commit in the library by chunk of books, the interrupted cleaning can be resumed
+        self.chunked = self.used_prefs[KEY.CHUNKED] and not dry_run and not confirmed
+        # count of books already committed by a previous cleaning
+        self.resume = resume
         
         # Count of cleaned comments
         self.books_clean = 0
-        # Exception
-        self.exception = None
     
     def end_progress(self):
         
+        self.end_cleaner()
+        
         if self.wasCanceled():
-            debug_print('Cleaning comments as cancelled. No change.')
+            if self.chunked and self.books_clean:
+                debug_print(f'Cleaning comments as cancelled. {self.books_clean} books already updated.')
+            else:
+                debug_print('Cleaning comments as cancelled. No change.')
         elif self.exception:
             debug_print('Cleaning comments as cancelled. An exception has occurred:')
             debug_print(self.exception)
             custom_exception_dialog(self.exception)
+        elif self.preview:
+            self.log.print(SUMMARY, 'Settings:', self.used_prefs, '\n')
+            self.log.print(SUMMARY, f'Preview of the cleaning for {self.book_count} books:')
+            self.log.print(SUMMARY, self.preview.summary())
+            self.log.print(SUMMARY, f'Preview execute in {self.time_execut:0.3f} seconds.\n')
         else:
-            debug_print('Settings:', self.used_prefs, '\n')
-            debug_print(f'Cleaning launched for {self.book_count} books.')
-            debug_print(f'Cleaning performed for {self.books_clean} comments.')
-            debug_print(f'Cleaning execute in {self.time_execut:0.3f} seconds.\n')
+            self.log.print(SUMMARY, 'Settings:', self.used_prefs, '\n')
+            self.log.print(SUMMARY, f'Cleaning launched for {self.book_count} books.')
+            self.log.print(SUMMARY, f'Cleaning performed for {self.books_clean} comments.')
+            self.log.print(SUMMARY, f'Cleaning execute in {self.time_execut:0.3f} seconds.\n')
+        
+        self.log.close()
     
     def job_progress(self):
         
-        debug_print(f'Launch Comments Cleaner for {self.book_count} books.')
-        debug_print(self.used_prefs)
-        print()
+        self.log.print(SUMMARY, f'Launch Comments Cleaner for {self.book_count} books.'
+                                + (' (parallel)' if self.parallel else ''))
+        self.log.print(SUMMARY, self.used_prefs, '\n')
         
         try:
             
-            for book_id in self.book_ids:
-                
-                if self.wasCanceled():
-                    return
-                
-                # update Progress
-                num = self.increment()
-                
-                # get the comment
-                
-                miA = self.dbAPI.get_proxy_metadata(book_id)
-                
-                # book_info = "title" (author & author) [book: num/book_count]{id: book_id}
-                book_info = '"{title}" ({authors}) [book: {num}/{book_count}]{{id: {book_id}}}'.format(
-                    title=miA.get('title'),
-                    authors=' & '.join(miA.get('authors')),
-                    num=num,
-                    book_count=self.book_count,
-                    book_id=book_id,
-                )
-                
-                # process the comments
-                for field in self.books_comments_map.keys():
-                    comment = miA.get(field)
-                    if comment is not None:
-                        debug_text(field+' for '+book_info, comment)
-                        comment_norm = normalize_comment(comment)
-                        comment_out = clean_comment(comment_norm, self.used_prefs)
-                        if comment == comment_out:
-                            debug_text('Unchanged '+field)
-                        else:
-                            if comment != comment_norm:
-                                debug_text('Normalize ' + field)
-                            if comment_norm != comment_out:
-                                debug_text(field+' out', comment_out)
-                            self.books_comments_map[field][book_id] = comment_out
-                    
-                    else:
-                        debug_text('Empty '+field+' '+book_info)
+            if self.confirmed:
+                self.write_books(self.confirmed_comments())
+                return
             
-            ids = set()
-            for ccbv in self.books_comments_map.values():
-                ids.update(ccbv.keys())
+            book_ids = list(self.book_ids)
+            if self.chunked:
+                library_id = self.dbAPI.library_id
+                if self.resume:
+                    self.log.print(SUMMARY, f'Resume the cleaning after {self.resume} books.\n')
+                chunks = range(self.resume, len(book_ids), CHUNK_SIZE)
+                size = CHUNK_SIZE
+            else:
+                chunks = [0]
+                size = len(book_ids)
             
-            books_edit_count = len(ids)
-            if books_edit_count > 0:
-                
-                debug_print(f'Update the database for {books_edit_count} books…\n')
-                self.set_value(-1, text=_('Update the library for {:d} books…').format(books_edit_count))
-                
-                self.books_clean = books_edit_count
-                
-                with self.dbAPI.write_lock, self.dbAPI.backend.conn:
-                    for field,id_val in self.books_comments_map.items():
-                        self.dbAPI.set_field(field,id_val)
+            for start in chunks:
+                books_comments_map = self.clean_books(book_ids[start:start+size], start)
+                if self.wasCanceled() or self.preview:
+                    return
                 
-                GUI.iactions['Edit Metadata'].refresh_gui(ids, covers_changed=False)
-            else:
-                debug_print('No book to update inside the database.\n')
+                self.write_books(books_comments_map)
+                if self.chunked:
+                    write_checkpoint(library_id, book_ids, start+size)
             
+            if self.chunked:
+                remove_checkpoint()
+        
         except Exception as e:
             self.exception = e
+    
+    def clean_books(self, book_ids: List[int], start: int) -> Dict[str, Dict[int, str]]:
+        '''
+        clean the comments of the books
+        return the map {field:{book_id:comment}} of the changed comments
+        '''
+        books_comments_map = {field:{} for field in self.fields}
+        
+        # read all the fields of the books in one go
+        fields_values = {
+            field:self.dbAPI.all_field_for(field, book_ids)
+            for field in ['title', 'authors', *self.fields]
+        }
+        
+        books_num = {book_id:num for num, book_id in enumerate(book_ids, start+1)}
+        
+        def book_info(book_id):
+            # book_info = "title" (author & author) [book: num/book_count]{id: book_id}
+            return '"{title}" ({authors}) [book: {num}/{book_count}]{{id: {book_id}}}'.format(
+                title=fields_values['title'][book_id],
+                authors=' & '.join(fields_values['authors'][book_id]),
+                num=books_num[book_id],
+                book_count=self.book_count,
+                book_id=book_id,
+            )
+        
+        log = self.log
+        items = []
+        for book_id in book_ids:
+            for field in self.fields:
+                comment = fields_values[field][book_id]
+                if comment is not None:
+                    items.append(((book_id, field), comment))
+                elif log.enabled(FULL):
+                    log.text(FULL, 'Empty '+field+' '+book_info(book_id))
+        
+        # process the comments
+        rslt = self.clean_items(items, start, len(book_ids))
+        
+        for (book_id, field), comment, comment_norm, comment_out in rslt:
+            if comment_out is None:
+                self.skipped.append(field+' for '+book_info(book_id))
+                log.text(FULL, 'Time budget exceeded, skipped '+self.skipped[-1], comment)
+            elif comment == comment_out:
+                if log.enabled(FULL):
+                    log.text(FULL, 'Unchanged '+field+' for '+book_info(book_id), comment)
+            else:
+                if log.enabled(FULL):
+                    log.text(FULL, field+' for '+book_info(book_id), comment)
+                    if comment_norm is not comment:
+                        log.text(FULL, 'Normalize ' + field)
+                    log.text(FULL, field+' out', comment_out)
+                elif log.enabled(CHANGED):
+                    log.diff(CHANGED, field+' changed for '+book_info(book_id), comment, comment_out)
+                books_comments_map[field][book_id] = comment_out
+            
+            if self.preview:
+                self.preview.add(book_id, partial(book_info, book_id), field, comment, comment_norm, comment_out)
+        
+        return books_comments_map
+    
+    def confirmed_comments(self) -> Dict[str, Dict[int, str]]:
+        '''
+        the map {field:{book_id:comment}} of the confirmed preview,
+        without the comments edited since the dry run
+        '''
+        books_comments_map = {}
+        for field, id_val in self.confirmed.changes().items():
+            current = self.dbAPI.all_field_for(field, list(id_val))
+            books_comments_map[field] = {
+                book_id:comment for book_id,comment in id_val.items()
+                if current.get(book_id) == self.confirmed.books[book_id][field][0]
+            }
+            edited = len(id_val) - len(books_comments_map[field])
+            if edited:
+                self.log.print(SUMMARY, f'{edited} {field} edited since the preview, not updated.')
+        return books_comments_map
+    
+    def write_books(self, books_comments_map: Dict[str, Dict[int, str]]):
+        
+        ids = set()
+        for ccbv in books_comments_map.values():
+            ids.update(ccbv.keys())
+        
+        books_edit_count = len(ids)
+        if books_edit_count > 0:
+            
+            self.log.print(SUMMARY, f'Update the database for {books_edit_count} books…\n')
+            self.set_value(-1, text=_('Update the library for {:d} books…').format(books_edit_count))
+            
+            with self.dbAPI.write_lock, self.dbAPI.backend.conn:
+                for field,id_val in books_comments_map.items():
+                    self.dbAPI.set_field(field,id_val)
+            
+            self.books_clean += books_edit_count
+            
+            GUI.iactions['Edit Metadata'].refresh_gui(ids, covers_changed=False)
+        else:
+            self.log.print(SUMMARY, 'No book to update inside the database.\n')
 
 
-class CleanerNoteProgressDialog(ProgressDialog):
+class CleanerNoteProgressDialog(CleanerBaseProgressDialog):
     
     icon = NOTES_ICON
     title = _('{PLUGIN_NAME} progress').format(PLUGIN_NAME='Notes Cleaner')
     
     def setup_progress(self, **kvargs):
         
-        self.used_prefs = PREFS[KEY.NOTES_SETTINGS].copy()
-        
         self.note_src = self.book_ids
         self.note_count = []
         for v in self.note_src.values():
@@ -247,12 +742,11 @@ class CleanerNoteProgressDialog(ProgressDialog):
         
         self.note_count = len(self.note_count)
         
+        self.setup_cleaner(PREFS[KEY.NOTES_SETTINGS].copy(), self.note_count)
+        
         self.note_clean = 0
         self.field_id_notes = defaultdict(dict)
         
-        # Exception
-        self.exception = None
-        
         return self.note_count
     
     def progress_text(self):
@@ -260,6 +754,8 @@ class CleanerNoteProgressDialog(ProgressDialog):
     
     def end_progress(self):
         
+        self.end_cleaner()
+        
         if self.wasCanceled():
             debug_print('Cleaning notes as cancelled. No change.')
         elif self.exception:
@@ -267,51 +763,71 @@ class CleanerNoteProgressDialog(ProgressDialog):
             debug_print(self.exception)
             custom_exception_dialog(self.exception)
         else:
-            debug_print('Settings:', self.used_prefs,'\n')
-            debug_print(f'Cleaning launched for {self.note_count} notes.')
-            debug_print(f'Cleaning performed for {self.note_clean} notes.')
-            debug_print(f'Cleaning execute in {self.time_execut:0.3f} seconds.\n')
+            self.log.print(SUMMARY, 'Settings:', self.used_prefs,'\n')
+            self.log.print(SUMMARY, f'Cleaning launched for {self.note_count} notes.')
+            self.log.print(SUMMARY, f'Cleaning performed for {self.note_clean} notes.')
+            self.log.print(SUMMARY, f'Cleaning execute in {self.time_execut:0.3f} seconds.\n')
+        
+        self.log.close()
     
     def job_progress(self):
-        debug_print(f'Launch Notes Cleaner for {self.note_count} notes.')
-        debug_print(self.used_prefs)
-        print()
+        self.log.print(SUMMARY, f'Launch Notes Cleaner for {self.note_count} notes.'
+                                + (' (parallel)' if self.parallel else ''))
+        self.log.print(SUMMARY, self.used_prefs, '\n')
         
         try:
             
-            for field,items in self.note_src.items():
-                for (value, item_id) in items:
+            log = self.log
+            notes_num = {}
+            notes_data = {}
+            
+            def note_info(field, item_id):
+                return (field+':'+self.dbAPI.get_item_name(field, item_id)
+                        +' [note: '+str(notes_num[(field, item_id)])+'/'+str(self.note_count)+']')
+            
+            items = []
+            num = 0
+            for field,items_id in self.note_src.items():
+                for (value, item_id) in items_id:
                     
                     if self.wasCanceled():
                         return
-                    
-                    # update Progress
-                    num = self.increment()
+                    num += 1
                     
                     # get the note
-                    item_name = self.dbAPI.get_item_name(field, item_id)
                     note_data = self.dbAPI.notes_data_for(field, item_id)
                     note = note_data.get('doc', None)
+                    notes_num[(field, item_id)] = num
                     
-                    note_info = field+':'+item_name+' [note: '+str(num)+'/'+str(self.note_count)+']'
-                    
-                    # process the note
                     if note is not None:
-                        debug_text('Note for '+note_info, note)
-                        note_norm = normalize_comment(note)
-                        note_out = clean_comment(note_norm, self.used_prefs)
-                        if note == note_out:
-                            debug_text('Unchanged note')
-                        else:
-                            if note != note_norm:
-                                debug_text('Normalize note')
-                            if note_norm != note_out:
-                                debug_text('Note out', note_out)
-                            note_data['doc'] = note_out
-                            self.field_id_notes[field][item_id] = note_data
-                    
-                    else:
-                        debug_text('Empty note '+note_info)
+                        notes_data[(field, item_id)] = note_data
+                        items.append(((field, item_id), note))
+                    elif log.enabled(FULL):
+                        log.text(FULL, 'Empty note '+note_info(field, item_id))
+            
+            # process the notes
+            rslt = self.clean_items(items)
+            if self.wasCanceled():
+                return
+            
+            for (field, item_id), note, note_norm, note_out in rslt:
+                if note_out is None:
+                    self.skipped.append('Note for '+note_info(field, item_id))
+                    log.text(FULL, 'Time budget exceeded, skipped '+self.skipped[-1], note)
+                elif note == note_out:
+                    if log.enabled(FULL):
+                        log.text(FULL, 'Unchanged note for '+note_info(field, item_id), note)
+                else:
+                    if log.enabled(FULL):
+                        log.text(FULL, 'Note for '+note_info(field, item_id), note)
+                        if note_norm is not note:
+                            log.text(FULL, 'Normalize note')
+                        log.text(FULL, 'Note out', note_out)
+                    elif log.enabled(CHANGED):
+                        log.diff(CHANGED, 'Note changed for '+note_info(field, item_id), note, note_out)
+                    note_data = notes_data[(field, item_id)]
+                    note_data['doc'] = note_out
+                    self.field_id_notes[field][item_id] = note_data
             
             ids = []
             for v in self.field_id_notes.values():
@@ -319,7 +835,7 @@ class CleanerNoteProgressDialog(ProgressDialog):
             note_edit_count = len(ids)
             if note_edit_count > 0:
                 
-                debug_print(f'Update the database for {note_edit_count} notes…\n')
+                self.log.print(SUMMARY, f'Update the database for {note_edit_count} notes…\n')
                 self.set_value(-1, text=_('Update the library for {:d} notes…').format(note_edit_count))
                 
                 with self.dbAPI.write_lock, self.dbAPI.backend.conn:
@@ -333,6 +849,6 @@ class CleanerNoteProgressDialog(ProgressDialog):
                             )
                 
                 self.note_clean = note_edit_count
-            
+        
         except Exception as e:
             self.exception = e
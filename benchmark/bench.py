@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# Benchmark of the cleaning, without Calibre.
+#
+#   python benchmark/bench.py [-o result.json] [--compare previous.json] [--scaling]
+#
+# The engine is loaded as a package, over some minimal stubs of Calibre:
+# Qt and common_utils are not stubbed, the engine must be imported without them.
+# The import time of the engine is measured in a new process.
+# The markdown() of Calibre is replaced by a tiny converter (or by python-markdown if installed)
+# and the Calibre comments editor by the built-in formatter.
+# The numbers are only comparable between runs of this harness, on the same machine.
+#
+# --scaling time a Word export (a span with a font-weight by word) of growing size,
+# the time by KB must stay about the same if the cleaning is linear.
+
+import argparse
+import builtins
+import importlib
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import types
+from typing import Dict, List
+
+from corpus import corpus, word_document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'calibre_plugins.comments_cleaner'
+
+# changes applied to the _defaults for each preset
+PRESETS = {
+    'default': {},
+    'notes': None,  # the defaults of the notes
+    'tokenizer': {'Engine': 'tokenizer'},
+    'markdown': {'Markdown': 'always'},
+    'del_formatting': {'DelFormatting': True},
+}
+
+
+class Stub:
+    '''
+    placeholder of the Qt and Calibre classes, only need to be subclassed
+    '''
+    def __init__(self, *args, **kargs):
+        pass
+
+
+class StubModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return type(name, (Stub,), {})
+
+
+def stub_module(name: str, **attrs) -> types.ModuleType:
+    m = StubModule(name)
+    m.__path__ = []
+    m.__dict__.update(attrs)
+    sys.modules[name] = m
+    return m
+
+
+def markdown(text: str) -> str:
+    '''
+    minimal Markdown: paragraphs, headings, lists, bold and italic
+    '''
+    rslt = []
+    for block in re.split(r'\n\s*\n', text.strip()):
+        lines = block.splitlines()
+        if not lines:
+            # empty or blank text
+            continue
+        if all(re.match(r'\s*([-*+]|\d+\.)\s', l) for l in lines):
+            tag = 'ol' if re.match(r'\s*\d', lines[0]) else 'ul'
+            items = ''.join('<li>'+re.sub(r'^\s*([-*+]|\d+\.)\s+', '', l)+'</li>\n' for l in lines)
+            rslt.append(f'<{tag}>\n{items}</{tag}>')
+        elif re.match(r'#{1,6}\s', block):
+            level = len(block) - len(block.lstrip('#'))
+            rslt.append(f'<h{level}>{block[level:].strip()}</h{level}>')
+        else:
+            rslt.append('<p>'+'<br />\n'.join(lines)+'</p>')
+    text = '\n'.join(rslt)
+    text = re.sub(r'\*\*(\S(?:.*?\S)?)\*\*', r'<strong>\1</strong>', text)
+    text = re.sub(r'\*(\S(?:.*?\S)?)\*', r'<em>\1</em>', text)
+    return text
+
+
+try:
+    import markdown as _markdown
+    markdown = _markdown.markdown  # noqa: F811
+except ImportError:
+    pass
+
+
+def load_plugin():
+    '''
+    import the engine of the plugin, return comments_cleaner and settings
+    '''
+    builtins._ = lambda text: text
+    builtins.load_translations = lambda: None
+    
+    stub_module('calibre')
+    stub_module('calibre.constants', numeric_version=(8, 0, 0))
+    stub_module('calibre.library')
+    stub_module('calibre.library.comments', markdown=markdown)
+    
+    stub_module('calibre_plugins')
+    plugin = types.ModuleType(PACKAGE)
+    plugin.__path__ = [ROOT]
+    sys.modules[PACKAGE] = plugin
+    
+    cc = importlib.import_module(PACKAGE+'.comments_cleaner')
+    settings = importlib.import_module(PACKAGE+'.settings')
+    
+    # the Calibre comments editor need a GUI
+    cc.calibre_format = cc.format_html
+    cc.calibre_remove_format = cc.remove_format
+    return cc, settings
+
+
+def import_time(repeat: int) -> dict:
+    '''
+    time of the import of the engine in a new process (best of repeat), in milliseconds
+    and the count of the imported modules
+    '''
+    code = (
+        'import sys, time\n'
+        'import bench\n'
+        'count = len(sys.modules)\n'
+        'start = time.perf_counter()\n'
+        'bench.load_plugin()\n'
+        'print(time.perf_counter() - start, len(sys.modules) - count)\n'
+    )
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      text=True)
+        elapsed, modules = out.split()
+        times.append(float(elapsed))
+    return {'ms': round(min(times)*1000, 3), 'modules': int(modules)}
+
+
+def percentile(values: List[float], p: float) -> float:
+    '''
+    nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return 0.0
+    idx = max(0, min(len(values)-1, round(p/100*len(values))-1))
+    return values[idx]
+
+
+def stats(times: List[float]) -> Dict[str, float]:
+    '''
+    times in seconds, the latencies are in milliseconds
+    '''
+    times = sorted(times)
+    total = sum(times)
+    return {
+        'count': len(times),
+        'total': round(total, 4),
+        'per_second': round(len(times)/total, 1) if total else 0.0,
+        'p50': round(percentile(times, 50)*1000, 3),
+        'p90': round(percentile(times, 90)*1000, 3),
+        'p99': round(percentile(times, 99)*1000, 3),
+        'max': round(times[-1]*1000, 3) if times else 0.0,
+    }
+
+
+def run_preset(cleaner, texts: Dict[str, List[str]], repeat: int) -> dict:
+    rslt = {'errors': 0, 'categories': {}}
+    every = []
+    for category, lst in texts.items():
+        # warm-up, also exclude the comments that raise
+        ok = []
+        for text in lst:
+            try:
+                cleaner(text)
+                ok.append(text)
+            except Exception:
+                rslt['errors'] += 1
+        
+        times = []
+        for _ in range(repeat):
+            for text in ok:
+                start = time.perf_counter()
+                cleaner(text)
+                times.append(time.perf_counter() - start)
+        rslt['categories'][category] = stats(times)
+        every.extend(times)
+    
+    rslt['overall'] = stats(every)
+    return rslt
+
+
+def scaling(cleaner, normalize, seed: int, sizes: List[int]) -> List[dict]:
+    '''
+    time of the cleaning of a Word export of growing size (count of paragraphs)
+    for a linear cleaning, the time by KB stay the same
+    '''
+    rslt = []
+    for count in sizes:
+        text = normalize(word_document(random.Random(f'{seed}-scaling'), count))
+        cleaner(text)
+        start = time.perf_counter()
+        cleaner(text)
+        elapsed = time.perf_counter() - start
+        rslt.append({
+            'paragraphs': count,
+            'size': len(text),
+            'ms': round(elapsed*1000, 3),
+            'us_by_kb': round(elapsed*1_000_000 / (len(text)/1024), 1),
+        })
+    return rslt
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                        stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return ''
+
+
+def compare(previous: dict, current: dict):
+    '''
+    print the change of the throughput and the median latency
+    '''
+    print(f'\nCompared to {previous["meta"].get("revision") or "previous run"}:')
+    if previous.get('import') and current.get('import'):
+        old, new = previous['import'], current['import']
+        print(f'  {"import":<26} {old["ms"]:0.1f} -> {new["ms"]:0.1f} ms   '
+              f'{old["modules"]} -> {new["modules"]} modules')
+    for preset, rslt in current['results'].items():
+        old = previous['results'].get(preset)
+        if not old:
+            continue
+        for category, new in [('overall', rslt['overall']), *rslt['categories'].items()]:
+            prev = old['overall'] if category == 'overall' else old['categories'].get(category)
+            if not prev or not prev['per_second']:
+                continue
+            speed = new['per_second'] / prev['per_second']
+            print(f'  {preset:<15} {category:<10} x{speed:0.2f} comments/s   '
+                  f'p50 {prev["p50"]:0.3f} -> {new["p50"]:0.3f} ms')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the Comments Cleaner')
+    parser.add_argument('-o', '--output', help='write the results in this JSON file')
+    parser.add_argument('-c', '--compare', help='JSON file of a previous run to compare')
+    parser.add_argument('-p', '--preset', action='append', choices=list(PRESETS), help='run only these presets')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timed passes over the corpus')
+    parser.add_argument('-s', '--scale', type=float, default=1, help='multiply the size of the corpus')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--scaling', type=int, nargs='*', metavar='COUNT',
+                        help='also time a Word export of this count of paragraphs (default: 10 20 40 80 160)')
+    args = parser.parse_args(argv)
+    
+    cc, settings = load_plugin()
+    texts = corpus(args.scale, args.seed)
+    texts = {k: [cc.normalize_comment(t) for t in v] for k,v in texts.items()}
+    
+    rslt = {
+        'meta': {
+            'revision': git_revision(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'scale': args.scale,
+            'seed': args.seed,
+            'corpus': {k: len(v) for k,v in texts.items()},
+        },
+        'results': {},
+    }
+    
+    rslt['import'] = import_time(args.repeat)
+    print(f'{"import":<15} {rslt["import"]["ms"]:>10.1f} ms   {rslt["import"]["modules"]} modules')
+    
+    for preset in args.preset or PRESETS:
+        if PRESETS[preset] is None:
+            prefs = dict(settings._prefs_defaults[settings.KEY.NOTES_SETTINGS])
+        else:
+            prefs = dict(settings._defaults)
+            prefs.update(PRESETS[preset])
+        
+        start = time.perf_counter()
+        cleaner = cc.Cleaner(prefs)
+        setup = time.perf_counter() - start
+        
+        r = run_preset(cleaner, texts, args.repeat)
+        r['setup'] = round(setup*1000, 3)
+        rslt['results'][preset] = r
+        
+        o = r['overall']
+        print(f'{preset:<15} {o["per_second"]:>10.1f} comments/s   p50 {o["p50"]:0.3f}   p90 {o["p90"]:0.3f}   '
+              f'p99 {o["p99"]:0.3f}   max {o["max"]:0.1f} ms   errors {r["errors"]}')
+        for category, s in r['categories'].items():
+            print(f'    {category:<11} {s["per_second"]:>10.1f} comments/s   '
+                  f'p50 {s["p50"]:0.3f}   p99 {s["p99"]:0.3f} ms')
+        
+        if args.scaling is not None:
+            r['scaling'] = scaling(cleaner, cc.normalize_comment, args.seed, args.scaling or [10, 20, 40, 80, 160])
+            first = r['scaling'][0]['us_by_kb']
+            for s in r['scaling']:
+                print(f'    scaling {s["paragraphs"]:>5} paragraphs {s["size"]/1024:>8.1f} KB {s["ms"]:>10.1f} ms   '
+                      f'{s["us_by_kb"]:>8.1f} µs/KB   x{s["us_by_kb"]/first:0.2f}')
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(rslt, f, indent=2)
+    
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), rslt)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# Representative comments for the benchmark.
+# The corpus is generated from a fixed seed, so two runs use exactly the same texts
+# without shipping megabytes of scraped descriptions in the repository.
+
+import random
+from typing import Dict, List
+
+NBSP = '\xA0'
+
+WORDS = (
+    'the lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+    'commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum eu fugiat nulla pariatur '
+    'café naïve élève œuvre straße'
+).split()
+
+# comments written by hand, the odd cases seen in the libraries
+SAMPLES = {
+    'retailer': [
+        ('<div class="book-description"><p><b>Praise for the book:</b></p><p>"Amazing." &mdash;<i>Times</i></p>'
+         '<p><br></p><p>Another <span style="font-weight: 700;">bold span</span>.</p></div>'),
+        '<DIV CLASS="x"><P ALIGN="CENTER">Hey <FONT COLOR="red">red</FONT></P></DIV>',
+        '<html><head><title>T</title><meta charset="utf-8"></head><body><p>Body text</p></body></html>',
+        '<p class="desc" id="p1" data-x="1" xml:lang="fr">Texte en français</p><p>&nbsp;</p><p></p><p>Fin</p>',
+        '<script>alert(1)</script><style>.x{}</style><p>after script</p>',
+    ],
+    'qt_br': [
+        'Some text<br><br>Other text<br>third line<br/><br />fourth',
+        '<p>line one<br>line two<br><br><br>line three</p>',
+        '<p><em>lead<br></em><br><strong><br>x</strong></p>',
+    ],
+    'plain': [
+        'Plain text comment.\n\nSecond paragraph -- with dash.\nLine two.',
+        '1984 was a year.\n1985 was another one.',
+    ],
+    'markdown': [
+        'A comment with **bold** and *italic*\n\n# Title\n\n- item 1\n- item 2\n\n1. one\n2. two',
+    ],
+    'huge': [],
+    'word': [
+        ('<p class="MsoNormal"><b><span style="font-size:12.0pt;font-family:&quot;Calibri&quot;;mso-bidi-font-weight:'
+         'normal">Title</span></b><o:p></o:p></p>'),
+    ],
+    'notes': [
+        '<p>img <img src="a.png" alt="b" width="10"/> here</p><img src="c.png"></img>',
+        '<p style="float: left; margin: 2px">float</p><p style="text-indent: 1em; text-align: justify-all">ind</p>',
+    ],
+}
+
+
+def words(r: random.Random, count: int) -> str:
+    return ' '.join(r.choice(WORDS) for _ in range(count))
+
+
+def sentence(r: random.Random) -> str:
+    s = words(r, r.randint(5, 25))
+    return s[0].upper() + s[1:] + r.choice(['.', '.', '.', '!', '?', '...'])
+
+
+def paragraph(r: random.Random) -> str:
+    return ' '.join(sentence(r) for _ in range(r.randint(1, 6)))
+
+
+def css(r: random.Random) -> str:
+    lst = [
+        'margin: 0px', 'color: #333333', 'font-family: Arial, sans-serif', 'line-height: 1.4',
+        f'font-weight: {r.choice([400, 450, 600, 700, "bold", "normal"])}', 'font-style: italic',
+        'text-align: justify', 'text-align:center', 'text-decoration: underline', 'float: right',
+    ]
+    return '; '.join(r.sample(lst, r.randint(1, 4)))
+
+
+def inline(r: random.Random, text: str) -> str:
+    '''
+    decorate some words of the text with the inline tags of the retailers
+    '''
+    rslt = []
+    for w in text.split(' '):
+        x = r.random()
+        if x < 0.04:
+            w = f'<b>{w}</b>'
+        elif x < 0.08:
+            w = f'<i>{w}</i>'
+        elif x < 0.11:
+            w = f'<span style="{css(r)}">{w}</span>'
+        elif x < 0.12:
+            w = f'<a href="https://example.com/{r.randint(1, 999)}" class="link">{w}</a>'
+        elif x < 0.13:
+            w = f'<FONT COLOR="#{r.randint(0, 0xFFFFFF):06x}">{w}</FONT>'
+        elif x < 0.14:
+            w += '&nbsp;'
+        rslt.append(w)
+    return ' '.join(rslt)
+
+
+def retailer(r: random.Random) -> str:
+    '''
+    HTML scraped from the web pages of the retailers:
+    nested <div>, classes, inline CSS, entities and empty paragraphs
+    '''
+    paras = []
+    if r.random() < 0.5:
+        paras.append(f'<h3 style="font-weight: bold">{words(r, 4).title()}</h3>')
+    for _ in range(r.randint(1, 6)):
+        x = r.random()
+        if x < 0.1:
+            paras.append('<p>&nbsp;</p>')
+        elif x < 0.2:
+            paras.append('<ul>' + ''.join(f'<li style="{css(r)}">{sentence(r)}</li>' for _ in range(3)) + '</ul>')
+        else:
+            paras.append(f'<p class="p{r.randint(1, 9)}" style="{css(r)}">{inline(r, paragraph(r))}</p>')
+    body = '\n'.join(paras)
+    if r.random() < 0.5:
+        body = f'<div id="description" class="product-description" data-n="{r.randint(1, 99)}">{body}</div>'
+    return f'<div>{body}</div>'
+
+
+def qt_br(r: random.Random) -> str:
+    '''
+    HTML with only <br> to separate the paragraphs, or a Qt rich text document
+    '''
+    lines = []
+    for _ in range(r.randint(2, 10)):
+        lines.append(sentence(r))
+        lines.append(r.choice(['<br>', '<br><br>', '<br/>', '<br />\n', '<br><br><br>']))
+    text = ''.join(lines)
+    if r.random() < 0.3:
+        style = ('margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; '
+                 '-qt-block-indent:0; text-indent:0px;')
+        text = (
+            '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" "http://www.w3.org/TR/REC-html40/strict.dtd">'
+            '<html><head><meta name="qrichtext" content="1" /><style type="text/css">p, li { white-space: pre-wrap; }'
+            '</style></head><body style=" font-family:\'Sans\'; font-size:9pt; font-weight:400; font-style:normal;">'
+            f'<p style="{style}">{text}</p></body></html>'
+        )
+    return text
+
+
+def plain(r: random.Random) -> str:
+    '''
+    raw text, paragraphs separated by blank lines
+    '''
+    sep = r.choice(['\n\n', '\n', '\r\n\r\n'])
+    return sep.join(paragraph(r) for _ in range(r.randint(1, 6)))
+
+
+def markdown(r: random.Random) -> str:
+    '''
+    plain text with a Markdown syntax
+    '''
+    blocks = [f'# {words(r, 3).title()}']
+    for _ in range(r.randint(2, 6)):
+        x = r.random()
+        if x < 0.3:
+            blocks.append('\n'.join(f'- {words(r, r.randint(2, 6))}' for _ in range(r.randint(2, 5))))
+        elif x < 0.4:
+            blocks.append('\n'.join(f'{i}. {words(r, 4)}' for i in range(1, 4)))
+        else:
+            text = paragraph(r).split(' ')
+            i = r.randrange(len(text))
+            text[i] = f'**{text[i]}**'
+            i = r.randrange(len(text))
+            text[i] = f'*{text[i]}*'
+            blocks.append(' '.join(text))
+    return '\n\n'.join(blocks)
+
+
+def huge(r: random.Random) -> str:
+    '''
+    a very long description (omnibus, anthologies) around 100 KB
+    '''
+    paras = []
+    size = 0
+    while size < 100_000:
+        p = f'<p style="{css(r)}">{inline(r, paragraph(r))}</p>'
+        paras.append(p)
+        size += len(p)
+    return '<div>' + ''.join(paras) + '</div>'
+
+
+def word_document(r: random.Random, count: int) -> str:
+    '''
+    HTML exported by Word: count paragraphs of spans, each one with its own font-weight
+    '''
+    paras = []
+    for _ in range(count):
+        spans = []
+        for w in paragraph(r).split(' '):
+            size = f'{r.randint(9, 14)}.{r.randint(0, 9)}pt'
+            weight = r.choice([r.randint(100, 900), 'normal', 'bold'])
+            spans.append(f'<span style="font-size:{size};font-family:Calibri;font-weight:{weight};'
+                         f'mso-bidi-font-weight:normal">{w} </span>')
+        paras.append('<p class="MsoNormal" style="margin-bottom:0cm;line-height:normal">'
+                      + ''.join(spans) + '<o:p></o:p></p>')
+    return '<div class="WordSection1">' + '\n'.join(paras) + '</div>'
+
+
+def word(r: random.Random) -> str:
+    '''
+    a description pasted from Word, a span with a font-weight for each word
+    '''
+    return word_document(r, r.randint(2, 8))
+
+
+def notes(r: random.Random) -> str:
+    '''
+    notes of the authors/series, with images and floating blocks
+    '''
+    paras = []
+    if r.random() < 0.6:
+        paras.append(f'<p style="float: left; margin-right: 1em"><img src="res/{r.randint(1, 99)}.jpg" '
+                     f'alt="{words(r, 2)}" width="{r.randint(50, 200)}"></p>')
+    for _ in range(r.randint(1, 4)):
+        paras.append(f'<p>{inline(r, paragraph(r))}</p>')
+    if r.random() < 0.3:
+        paras.append(f'<p><a href="https://en.wikipedia.org/wiki/{words(r, 1)}">Wikipedia</a></p>')
+    return ''.join(paras)
+
+
+GENERATORS = {
+    'retailer': retailer,
+    'qt_br': qt_br,
+    'plain': plain,
+    'markdown': markdown,
+    'huge': huge,
+    'word': word,
+    'notes': notes,
+}
+
+# number of generated comments by category
+SIZES = {
+    'retailer': 120,
+    'qt_br': 60,
+    'plain': 60,
+    'markdown': 40,
+    'huge': 3,
+    'word': 10,
+    'notes': 40,
+}
+
+
+def corpus(scale: float=1, seed: int=2020) -> Dict[str, List[str]]:
+    '''
+    the comments of the benchmark by category
+    scale multiply the number of generated comments (at least one by category)
+    '''
+    rslt = {}
+    for name, generator in GENERATORS.items():
+        r = random.Random(f'{seed}-{name}')
+        texts = list(SAMPLES[name])
+        texts.extend(generator(r) for _ in range(max(1, round(SIZES[name]*scale))))
+        rslt[name] = texts
+    return rslt
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Callable, Optional
+
+# max number of results keep in the cache
+MAX_ENTRIES = 100_000
+
+
+def fingerprint(*values) -> str:
+    '''
+    hash of the values (prefs, version...) that change the result of the cleaning
+    '''
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    '''
+    Persistent cache of the cleaned comments, in a SQLite database.
+    
+    The results are keyed by the hash of the input text and the fingerprint
+    of the used settings, a change of the settings or of the plugin version
+    invalidate the previous results (they are never hit, then removed by the eviction).
+    The least recently used results are removed over max_entries.
+    
+    The writes are grouped and done in close().
+    '''
+    
+    def __init__(self, path: str, fingerprint: str, max_entries: int=MAX_ENTRIES):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._used = set()
+        
+        # used by the cleaning thread, but never by two threads at the same time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, '
+            'result TEXT NOT NULL, '
+            'used INTEGER NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self.conn.commit()
+    
+    def key(self, text: str) -> str:
+        return hashlib.sha1((self.fingerprint + '\0' + text).encode('utf-8')).hexdigest()
+    
+    def get(self, text: str) -> Optional[str]:
+        key = self.key(text)
+        rslt = self._new.get(key)
+        if rslt is None:
+            row = self.conn.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+            if row:
+                rslt = row[0]
+                self._used.add(key)
+        
+        if rslt is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rslt
+    
+    def set(self, text: str, result: str):
+        self._new[self.key(text)] = result
+    
+    def wrap(self, func: Callable[[str], str]) -> Callable[[str], str]:
+        '''
+        return func with a lookup in the cache
+        '''
+        def cached(text: str) -> str:
+            rslt = self.get(text)
+            if rslt is None:
+                rslt = func(text)
+                self.set(text, rslt)
+            return rslt
+        return cached
+    
+    def close(self):
+        '''
+        write the new results, update the used ones and apply the eviction
+        '''
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany('UPDATE results SET used = ? WHERE key = ?',
+                                    ((now, k) for k in self._used))
+            self.conn.executemany('INSERT OR REPLACE INTO results (key, result, used) VALUES (?, ?, ?)',
+                                    ((k, v, now) for k,v in self._new.items()))
+            count = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute('DELETE FROM results WHERE key IN '
+                                    '(SELECT key FROM results ORDER BY used LIMIT ?)', (count - self.max_entries,))
+        self.conn.close()
+        self._new.clear()
+        self._used.clear()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# Cleaning of a library from the command line, without the GUI (headless server, scheduled task):
+#
+#   calibre-debug -r "Comments Cleaner" -- [--library PATH] [--search EXPR] [--jobs N] ...
+#
+# The comments are cleaned with the settings of the plugin, and saved in the library by chunks of books.
+# The summary of the job is printed as JSON on stdout, the log on stderr.
+# The Calibre comments editor need a GUI, the built-in formatter is always used.
+# Nothing here import Qt: the settings are read from settings.py and the stored JSON, not config.PREFS.
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from calibre.library import db as open_library
+from calibre.utils.config import JSONConfig
+from calibre.utils.config import prefs as calibre_prefs
+from calibre.utils.ipc.simple_worker import fork_job
+
+from . import ActionCommentsCleaner
+from .comments_cleaner import COUNTERS, clean_batch, normalize_comment
+from .log import CHANGED, FULL, LEVELS, SUMMARY, CleanerLog
+from .settings import KEY, _defaults, _prefs_defaults, notes_settings
+
+# books by transaction
+CHUNK_SIZE = 500
+# below, the start of a worker process cost more than the cleaning
+PARALLEL_MIN_BATCH = 250
+# seconds, for a batch
+PARALLEL_TIMEOUT = 3600
+
+SETTINGS = ('comments', 'notes', 'default')
+
+# prefilter of the settings for the cleaning, see Cleaner
+# the validation report the errors of the Cleaner of the job, not available with the worker processes
+PREFILTER = {
+    'skip': 'skip',
+    'validate': None,
+    'none': None,
+}
+
+
+def console(*args):
+    print(*args, file=sys.stderr)
+
+
+def html_fields(dbAPI) -> List[str]:
+    '''
+    the custom columns of HTML comments
+    '''
+    rslt = []
+    for field in dbAPI.field_metadata.custom_field_keys():
+        fm = dbAPI.field_metadata[field]
+        if fm['datatype'] == 'comments' and fm.get('display', {}).get('interpret_as', 'html') == 'html':
+            rslt.append(field)
+    return rslt
+
+
+def stored_prefs() -> dict:
+    '''
+    the settings of the plugin saved by the GUI, over the defaults
+    same content as config.PREFS, that need Qt
+    '''
+    stored = JSONConfig('plugins/'+ActionCommentsCleaner.name)
+    prefs = copy.deepcopy(_prefs_defaults)
+    for key in prefs:
+        if key in stored:
+            if key == KEY.NOTES_SETTINGS:
+                prefs[key] = notes_settings(stored[key])
+            else:
+                prefs[key] = stored[key]
+    return prefs
+
+
+def job_prefs(stored: dict, settings: str, path: Optional[str]=None) -> dict:
+    '''
+    the settings of the cleaning: the comments or notes settings of the plugin, or the defaults
+    the keys of the JSON file path replace them
+    '''
+    if settings == 'notes':
+        prefs = stored[KEY.NOTES_SETTINGS].copy()
+    elif settings == 'default':
+        prefs = _defaults.copy()
+    else:
+        prefs = {k:stored[k] for k in _defaults}
+    
+    if path:
+        with open(path, encoding='utf-8') as f:
+            prefs.update(json.load(f))
+    
+    unknown = set(prefs) - set(_defaults)
+    if unknown:
+        raise ValueError('Unknown settings: '+', '.join(sorted(unknown)))
+    
+    prefs[KEY.FORMATTER] = 'headless'
+    return prefs
+
+
+def clean_texts(prefs: dict, texts: List[str], jobs: int, time_budget: Optional[float],
+                prefilter: Optional[str], counters: Optional[Counter]=None) -> List[Optional[str]]:
+    '''
+    clean the texts, in jobs worker processes if there are enough texts
+    return the texts cleaned, in the same order (None if exceeded the time budget)
+    the Cleaner.counters() of the workers are added in counters
+    '''
+    items = list(enumerate(texts))
+    workers = max(1, min(jobs, len(items) // PARALLEL_MIN_BATCH))
+    if workers == 1:
+        results = [clean_batch(prefs, items, time_budget, prefilter)]
+    else:
+        size = -(-len(items) // workers)
+        batches = [items[i:i+size] for i in range(0, len(items), size)]
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            futures = [executor.submit(fork_job, clean_batch.__module__, clean_batch.__name__,
+                                        args=(prefs, batch, time_budget, prefilter), timeout=PARALLEL_TIMEOUT)
+                       for batch in batches]
+            results = [f.result()['result'] for f in futures]
+    
+    rslt = [None] * len(items)
+    for result, result_counters in results:
+        if counters is not None:
+            counters.update(result_counters)
+        for idx, _text_norm, text_out in result:
+            rslt[idx] = text_out
+    return rslt
+
+
+class LibraryCleaner:
+    '''
+    clean the comments of the books of a library, by chunks of books
+    '''
+    
+    def __init__(self, dbAPI, prefs: dict, fields: List[str], log: CleanerLog, jobs: int=1,
+                 time_budget: Optional[float]=None, prefilter: Optional[str]=None, chunk_size: int=CHUNK_SIZE):
+        self.dbAPI = dbAPI
+        self.prefs = prefs
+        self.fields = fields
+        self.log = log
+        self.jobs = jobs
+        self.time_budget = time_budget
+        self.prefilter = prefilter
+        self.chunk_size = chunk_size
+        
+        # texts already cleaned in the chunk {text normalized: text cleaned}, for the identical texts
+        self.memo = {}
+        # identical texts cleaned only once
+        self.duplicates = 0
+        # Cleaner.counters() of the job
+        self.counters = Counter()
+        self.texts = 0
+        self.changed = 0
+        self.skipped = []
+        self.books_updated = 0
+        self.chunks = 0
+    
+    def book_info(self, book_id: int) -> str:
+        return '"{title}" ({authors}){{id: {book_id}}}'.format(
+            title=self.dbAPI.field_for('title', book_id),
+            authors=' & '.join(self.dbAPI.field_for('authors', book_id)),
+            book_id=book_id,
+        )
+    
+    def clean_books(self, book_ids: List[int]):
+        for start in range(0, len(book_ids), self.chunk_size):
+            self.clean_chunk(book_ids[start:start+self.chunk_size])
+            self.log.print(SUMMARY, f'{min(start+self.chunk_size, len(book_ids))}/{len(book_ids)} books processed.')
+    
+    def clean_chunk(self, book_ids: List[int]):
+        log = self.log
+        fields_values = {field:self.dbAPI.all_field_for(field, book_ids) for field in self.fields}
+        
+        # (book_id, field, text, text normalized) of the chunk
+        items = []
+        pending = {}
+        for book_id in book_ids:
+            for field in self.fields:
+                text = fields_values[field][book_id]
+                if text is None:
+                    continue
+                text_norm = normalize_comment(text)
+                items.append((book_id, field, text, text_norm))
+                if text_norm not in self.memo:
+                    pending[text_norm] = None
+        
+        self.texts += len(items)
+        if pending:
+            distinct = list(pending)
+            for text_norm, text_out in zip(distinct, clean_texts(self.prefs, distinct, self.jobs,
+                                                                 self.time_budget, self.prefilter, self.counters)):
+                self.memo[text_norm] = text_out
+        
+        books_comments_map = {field:{} for field in self.fields}
+        for book_id, field, text, text_norm in items:
+            text_out = self.memo[text_norm]
+            if text_out is None:
+                self.skipped.append(field+' for '+self.book_info(book_id))
+                log.text(FULL, 'Time budget exceeded, skipped '+self.skipped[-1], text)
+            elif text == text_out:
+                if log.enabled(FULL):
+                    log.text(FULL, 'Unchanged '+field+' for '+self.book_info(book_id), text)
+            else:
+                if log.enabled(FULL):
+                    log.text(FULL, field+' for '+self.book_info(book_id), text)
+                    log.text(FULL, field+' out', text_out)
+                elif log.enabled(CHANGED):
+                    log.diff(CHANGED, field+' changed for '+self.book_info(book_id), text, text_out)
+                books_comments_map[field][book_id] = text_out
+                self.changed += 1
+        
+        ids = set()
+        for id_val in books_comments_map.values():
+            ids.update(id_val)
+        if ids:
+            with self.dbAPI.write_lock, self.dbAPI.backend.conn:
+                for field,id_val in books_comments_map.items():
+                    if id_val:
+                        self.dbAPI.set_field(field, id_val)
+            self.books_updated += len(ids)
+        self.chunks += 1
+        
+        # the memo only keep the texts of the chunk, it don't grow with the library
+        self.duplicates += len(items) - len(self.memo)
+        self.memo.clear()
+
+
+def parse_args(argv: List[str], stored: dict) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='calibre-debug -r "Comments Cleaner" --',
+                                     description='Clean the comments of the books of a library, without the GUI.')
+    parser.add_argument('-l', '--library', help='path of the library (default: the current library of Calibre)')
+    parser.add_argument('-s', '--search', default='', help='search expression of the books to clean (default: all)')
+    parser.add_argument('--settings', choices=SETTINGS, default='comments',
+                        help='use the comments or the notes settings of the plugin, or the default settings')
+    parser.add_argument('--prefs', metavar='FILE', help='JSON file of settings that replace the chosen ones')
+    parser.add_argument('-f', '--field', action='append', dest='fields', metavar='FIELD',
+                        help='field to clean (default: comments, and the custom HTML columns if enabled)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='books saved by transaction')
+    parser.add_argument('--time-budget', type=float, default=stored[KEY.TIME_BUDGET],
+                        help='maximum seconds to clean a comment (0: no limit)')
+    parser.add_argument('--log-level', choices=LEVELS, default=stored[KEY.LOG_LEVEL],
+                        help='level of the log on stderr (default: the level of the plugin)')
+    parser.add_argument('--log-file', help='write the log in this rotating file instead of stderr')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    '''
+    entry point of ActionCommentsCleaner.cli_main()
+    print the summary of the job as JSON, return the exit code
+    '''
+    stored = stored_prefs()
+    args = parse_args(argv, stored)
+    log = CleanerLog(args.log_level, args.log_file, console=console)
+    library = os.path.abspath(args.library or calibre_prefs['library_path'])
+    summary = {
+        'library': library,
+        'search': args.search,
+    }
+    start = time.monotonic()
+    try:
+        prefs = job_prefs(stored, args.settings, args.prefs)
+        dbAPI = open_library(library).new_api
+        
+        fields = args.fields or ['comments']
+        if not args.fields and stored[KEY.CUSTOM_COLUMN]:
+            fields.extend(html_fields(dbAPI))
+        book_ids = sorted(dbAPI.search(args.search)) if args.search else sorted(dbAPI.all_book_ids())
+        
+        log.print(SUMMARY, f'Launch Comments Cleaner for {len(book_ids)} books of {library}.')
+        log.print(SUMMARY, prefs, '\n')
+        if stored[KEY.PREFILTER] == 'validate':
+            log.print(SUMMARY, 'The validation of the prefilter is not available here, all the comments are cleaned.\n')
+        
+        cleaner = LibraryCleaner(dbAPI, prefs, fields, log,
+            jobs=max(1, args.jobs),
+            time_budget=args.time_budget or None,
+            prefilter=PREFILTER[stored[KEY.PREFILTER]],
+            chunk_size=max(1, args.chunk_size),
+        )
+        try:
+            cleaner.clean_books(book_ids)
+        finally:
+            summary.update({
+                'fields': fields,
+                'books': len(book_ids),
+                'texts': cleaner.texts,
+                'duplicates': cleaner.duplicates,
+                'changed': cleaner.changed,
+                'skipped': cleaner.skipped,
+                'books_updated': cleaner.books_updated,
+                'chunks': cleaner.chunks,
+                **{name:cleaner.counters[name] for name in COUNTERS},
+                'settings': prefs,
+            })
+        dbAPI.close()
+        rslt = 0
+    except Exception as e:
+        console('The cleaning failed:', repr(e))
+        summary['error'] = repr(e)
+        rslt = 1
+    
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    log.close()
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return rslt
@@ -4,13 +4,17 @@ __license__   = 'GPL v3'
 __copyright__ = '2020, un_pogaz <un.pogaz@gmail.com>'
 
 
+import re
+import threading
+import time
 import unicodedata
-from typing import Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 from calibre.library.comments import markdown
 
-from .common_utils import regex
-from .config import CALIBRE_VERSIONS_BOLD, CSS_DEFAULT, KEY, css_clean_rules
+from .html_formatter import format_html, remove_format
+from .html_tokenizer import Tag, tokenize
+from .settings import CALIBRE_VERSIONS_BOLD, CSS_DEFAULT, KEY, css_clean_rules
 
 NBSP = '\xA0'
 
@@ -87,9 +91,14 @@ ATTRIBUTES = [
 
 # fix a imcompatibility betwen multiple Calibre version
 if CALIBRE_VERSIONS_BOLD:
-    FONT_WEIGHT = 'font-weight: 700'
+    FONT_WEIGHT_BOLD = '700'
 else:
-    FONT_WEIGHT = 'font-weight: 600'
+    FONT_WEIGHT_BOLD = '600'
+FONT_WEIGHT = 'font-weight: '+FONT_WEIGHT_BOLD
+
+
+# same flags that the regex of common_utils
+FLAGS = re.ASCII + re.MULTILINE + re.DOTALL
 
 
 def _set_prefs(prefs):
@@ -100,185 +109,567 @@ def _set_prefs(prefs):
     return prefs
 
 
-def clean_caps_tags(text: str) -> str:
-    
-    for find in regex.searchall(r'<(?P<start>/?)(?P<name>\w+)(?P<attributes>| [^>]*)(?P<end>/?)>', text):
-        start = find.start()
-        end = find.end()
-        find = find.groupdict()
-        if find['name'] != find['name'].lower():
-            
-            find['name'] = find['name'].lower()
-            attributes = find['attributes']
-            for atr in ATTRIBUTES:
-                find['attributes'] = find['attributes'].replace(atr.upper()+'=', atr+'=')
-            find['attributes'] = attributes
-            
-            new_tag = '<'+find['start']+find['name']+find['attributes']+find['end']+'>'
-            text = text[:start] + new_tag + text[end:]
+class RuleLoopError(Exception):
+    def __init__(self, pattern: str, repl: str):
+        Exception.__init__(self, 'the pattern and substitution string caused an infinite loop', pattern, repl)
+
+
+class CommentTimeout(Exception):
+    def __init__(self, budget: float):
+        Exception.__init__(self, f'the cleaning of the comment exceeded the time budget of {budget} seconds')
+        self.budget = budget
+
+
+# deadline of the comment in cleaning, by thread (see Cleaner.__call__)
+_budget = threading.local()
+
+
+def check_budget():
+    '''
+    raise CommentTimeout if the comment in cleaning exceeded its time budget
     
+    the rules can't be interrupted, the budget is checked between them
+    '''
+    deadline = getattr(_budget, 'deadline', None)
+    if deadline and time.perf_counter() > deadline:
+        raise CommentTimeout(_budget.budget)
+
+
+def loop(pattern: re.Pattern, repl: str, text: str) -> str:
+    '''
+    apply the substitution until the pattern don't match anymore
+    same as regex.loop() but for a compiled pattern
+    '''
+    i = 0
+    while pattern.search(text):
+        if i > 1000:
+            raise RuleLoopError(pattern.pattern, repl)
+        check_budget()
+        text = pattern.sub(repl, text)
+        i += 1
     return text
 
 
-# Cleannig based on Calibre 4 and above (QtWebEngine)
-def clean_basic(text: str) -> str:
+def loop_before(pattern: re.Pattern, repl: str, end: re.Pattern, text: str) -> str:
+    '''
+    same as loop(), but the pattern is only applied before the last match of end,
+    the part of the pattern that must be there for a match
     
-    text = XMLformat(text)
+    so the lazy content (.*?) before it is always closed, and a pass is linear
+    '''
+    i = 0
+    while True:
+        last = None
+        for last in end.finditer(text):
+            pass
+        if last is None:
+            return text
+        head = text[:last.end()]
+        if not pattern.search(head):
+            return text
+        if i > 1000:
+            raise RuleLoopError(pattern.pattern, repl)
+        check_budget()
+        text = pattern.sub(repl, head) + text[last.end():]
+        i += 1
+
+
+class Rule:
+    '''
+    A precompiled substitution, equivalent to regex.loop(pattern, repl, text)
+    or regex.simple(pattern, repl, text) if simple is True
+    '''
+    
+    __slots__ = ('regex', 'repl', 'simple')
+    
+    def __init__(self, pattern: str, repl: Union[str, Callable[[re.Match], str]], simple: bool=False):
+        self.regex = re.compile(pattern, FLAGS)
+        self.repl = repl
+        self.simple = simple
+    
+    def __repr__(self) -> str:
+        return f'Rule({self.regex.pattern!r}, {self.repl!r})'
+    
+    def __call__(self, text: str) -> str:
+        if self.simple:
+            return self.regex.sub(self.repl, text)
+        return loop(self.regex, self.repl, text)
+    
+    def sub(self, text: str) -> str:
+        '''
+        a single substitution, even if not simple
+        '''
+        return self.regex.sub(self.repl, text)
+    
+    def search(self, text: str) -> Optional[re.Match]:
+        return self.regex.search(text)
+
+
+class Step:
+    '''
+    A step of the cleaning that is not a Rule, a function of the text
+    named, to be recorded by the profiler like the rules
+    '''
+    
+    __slots__ = ('func', 'name')
+    
+    def __init__(self, func: Callable[[str], str], name: Optional[str]=None):
+        self.func = func
+        self.name = name or func.__name__
     
+    def __repr__(self) -> str:
+        return f'Step({self.name})'
+    
+    def __call__(self, text: str) -> str:
+        return self.func(text)
+
+
+def rules(*lst: Tuple[str, str]) -> Tuple[Rule, ...]:
+    return tuple(Rule(pattern, repl) for pattern, repl in lst)
+
+
+def apply_rules(steps: Iterable[Callable[[str], str]], text: str) -> str:
+    check_budget()
+    for step in steps:
+        text = step(text)
+    return text
+
+
+# About the cost of the rules
+# A lazy content like (.*?) or ((?:(?!</p>).)*?) is scanned from each possible start up to the end
+# of the text when the end of the pattern is missing (unclosed tag), that is quadratic on a malformed
+# comment, and worse for the nested groups. So the content of the rules that match a block exclude
+# also the tag that open this kind of block: a scan stop at the next opening tag, where start the
+# next possible match. Each character is scanned by a bounded number of attempts, linear for a pass.
+# A nested structure is then resolved from the inside out, one level by pass of the loop.
+# Except where a other opening tag can be in the content: <center> and <script> end at the first
+# closing tag like in HTML, bounded by the paragraph, and the <div> rules use loop_before().
+
+# content of a paragraph, without <p> or </p>
+_rgx_in_p = r'(?:(?!</?p[ >]).)'
+
+
+# the tag names and the known attribut names with a uppercase letter
+CAPS_TAGS = re.compile(
+    r'(?<=<)/?\w*[A-Z]\w*(?=(?: [^>]*)?/?>)'
+    r'|(?<= )(?=[a-z]*[A-Z])(?i:'+'|'.join(ATTRIBUTES)+r')(?==[^<>]*>)',
+    FLAGS,
+)
+
+
+@Step
+def clean_caps_tags(text: str) -> str:
+    '''
+    lowercase the tag names and the known attributs, in a single pass
+    '''
+    return CAPS_TAGS.sub(lambda m: m.group(0).lower(), text)
+
+
+BASIC_TAGS_RULES = rules(
     # convert tag
-    text = regex.loop(r'<(/?)(?:i|cite|dfn|var)(| [^>]*)>', r'<\1em\2>', text)
-    text = regex.loop(r'<(/?)(?:b)(| [^>]*)>',              r'<\1strong\2>', text)
-    text = regex.loop(r'<(/?)(?:del|strike)(| [^>]*)>',     r'<\1s\2>', text)
+    (r'<(/?)(?:i|cite|dfn|var)(| [^>]*)>', r'<\1em\2>'),
+    (r'<(/?)(?:b)(| [^>]*)>',              r'<\1strong\2>'),
+    (r'<(/?)(?:del|strike)(| [^>]*)>',     r'<\1s\2>'),
     
-    text = regex.loop(r'<(/?)(?:blockquote|dd|dt|pre)(| [^>]*)>', r'<\1p\2>', text)
+    (r'<(/?)(?:blockquote|dd|dt|pre)(| [^>]*)>', r'<\1p\2>'),
     
     # convert tag with content
-    text = regex.loop(r'<(center)(| [^>]*)>((?:(?!</p>|</div>).)*?)</\1>', r'<p align="center" \2>\3</p>', text)
+    # like in HTML, the content end at the first closing tag, even after a other opening tag
+    (r'<(center)(| [^>]*)>((?:(?!</p>|</div>).)*?)</\1>', r'<p align="center" \2>\3</p>'),
     
     # invalid tag with content
-    text = regex.loop(r'<(script|style|head|title)(| [^>]*)>((?!</p>|</div>).)*?</\1>', r'', text)
+    (r'<(script|style|head|title)(| [^>]*)>((?!</p>|</div>).)*?</\1>', r''),
     
     # remove invalid tag
-    text = regex.loop(r'</?(?!'+ '|'.join(TAGS) +r')\w+(| [^>]*)/?>', r'', text)
+    (r'</?(?!'+ '|'.join(TAGS) +r')\w+(| [^>]*)/?>', r''),
     
     # remove namespaced attribut
-    text = regex.loop(r' [\w\-]+:[\w\-]+="[^"]*"', r'', text)
+    (r' [\w\-]+:[\w\-]+="[^"]*"', r''),
     
     # remove invalid attribut
-    text = regex.loop(r' (?!'+ '|'.join(ATTRIBUTES) +r')[\w\-]+="[^"]*"', r'', text)
+    (r' (?!'+ '|'.join(ATTRIBUTES) +r')[\w\-]+="[^"]*"', r''),
     
     # filtre not desired tag
-    text = regex.loop(r'</?(font|html|body|section|form|dl)(| [^>]*)>', r'', text)
-    text = regex.loop(r'</?(address|big|code|kbd|meta|nobr|qt|samp|small|tt)(| [^>]*)>', r'', text)
+    (r'</?(font|html|body|section|form|dl)(| [^>]*)>', r''),
+    (r'</?(address|big|code|kbd|meta|nobr|qt|samp|small|tt)(| [^>]*)>', r''),
     
     # clean img
-    text = regex.loop(r'<img([^>]*)/>', r'<img\1>', text)
-    text = regex.loop(r'</img[^>]*>', r'', text)
+    (r'<img([^>]*)/>', r'<img\1>'),
+    (r'</img[^>]*>', r''),
     
     # invalid attribut tag
-    text = regex.loop(r'<((?!a)\w+)(| [^>]*) href="[^"]*"(| [^>]*)>', r'<\1\2\3>', text)
-    text = regex.loop(r'<((?!p|div|h\d|li|ol|ul)\w+)(| [^>]*) align="[^"]*"(| [^>]*)>', r'<\1\2\3>', text)
+    (r'<((?!a)\w+)(| [^>]*) href="[^"]*"(| [^>]*)>', r'<\1\2\3>'),
+    (r'<((?!p|div|h\d|li|ol|ul)\w+)(| [^>]*) align="[^"]*"(| [^>]*)>', r'<\1\2\3>'),
     
     # clean space in attribut
-    text = regex.loop(r' ([\w\-]+)="\s+([^"]*)"', r' \1="\2"', text)
-    text = regex.loop(r' ([\w\-]+)="([^"]*)\s+"', r' \1="\2"', text)
+    (r' ([\w\-]+)="\s+([^"]*)"', r' \1="\2"'),
+    (r' ([\w\-]+)="([^"]*)\s+"', r' \1="\2"'),
     
     # management of <br>
-    text = regex.loop(r'<(b|h)r[^>]+>', r'<\1r>', text)
-    text = regex.loop(r'</(b|h)r[^>]+>', r'', text)
-    text = regex.loop(r'(\s|'+NBSP+r')+<(b|h)r>', r'<\2r>', text)
-    text = regex.loop(r'<(b|h)r>(\s|'+NBSP+r')+', r'<\1r>', text)
-    text = regex.loop(r'<((?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*))><(b|h)r>', r'<\2r><\1>', text)
-    text = regex.loop(r'<(b|h)r></(em|strong|sup|sub|u|s|span|a)>', r'</\2><\1r>', text)
-    
-    # empty inline
-    inlineSpace = r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>\s+</\1>'
-    inlineEmpty = r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)></\1>'
-    # same inline
-    sameSpace = r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>([^<]*)</\1>\s+<\1\2>'
-    sameEmpty = r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>([^<]*)</\1><\1\2>'
-    
-    while (regex.search(inlineSpace, text) or
-        regex.search(inlineEmpty, text) or
-        regex.search(sameSpace, text) or
-        regex.search(sameEmpty, text)):
-        
-        text = regex.loop(inlineSpace, r' ', text)
-        text = regex.loop(inlineEmpty, r'', text)
-        
-        text = regex.loop(sameSpace, r'<\1\2>\3 ', text)
-        text = regex.loop(sameEmpty, r'<\1\2>\3', text)
+    (r'<(b|h)r[^>]+>', r'<\1r>'),
+    (r'</(b|h)r[^>]+>', r''),
+    (r'(\s|'+NBSP+r')+<(b|h)r>', r'<\2r>'),
+    (r'<(b|h)r>(\s|'+NBSP+r')+', r'<\1r>'),
+)
+
+
+@Step
+def _clean_basic_tags(text: str) -> str:
+    # tags and attributs part of clean_basic() for the regex engine
+    # see clean_tags() for the tokenizer engine
+    return apply_rules(BASIC_TAGS_RULES, text)
+
+
+# tags converted by clean_basic()
+CONVERT_TAGS = {
+    'i': 'em', 'cite': 'em', 'dfn': 'em', 'var': 'em',
+    'b': 'strong',
+    'del': 's', 'strike': 's',
+    'blockquote': 'p', 'dd': 'p', 'dt': 'p', 'pre': 'p',
+}
+# tags removed by clean_basic(), but not there content
+FILTER_TAGS = {
+    'font', 'html', 'body', 'section', 'form', 'dl',
+    'address', 'big', 'code', 'kbd', 'meta', 'nobr', 'qt', 'samp', 'small', 'tt',
+}
+# same as \s (ASCII)
+SPACES_ASCII = ' \t\n\r\f\v'
+# same as \s (ASCII) + NBSP
+SPACES = SPACES_ASCII + NBSP
+
+TAGS_PREFIX = tuple(TAGS)
+
+# tags with content, before the convertion of the tags
+# so </p> include the tags that will be converted to <p>
+TOKENIZER_CONTENT_RULES = rules(
+    (r'<(center)(| [^>]*)>((?:(?!</(?:p|blockquote|dd|dt|pre)>|</div>).)*?)</\1>', r'<p align="center" \2>\3</p>'),
+    (r'<(script|style|head|title)(| [^>]*)>((?!</(?:p|blockquote|dd|dt|pre)>|</div>).)*?</\1>', r''),
+)
+
+TEXT_ATTRIBUTS_RULES = rules(
+    # remove namespaced attribut
+    (r' [\w\-]+:[\w\-]+="[^"]*"', r''),
+    # remove invalid attribut
+    (r' (?!'+ '|'.join(ATTRIBUTES) +r')[\w\-]+="[^"]*"', r''),
+)
+
+SPACE_ATTRIBUTS_RULES = rules(
+    # clean space in attribut
+    (r' ([\w\-]+)="\s+([^"]*)"', r' \1="\2"'),
+    (r' ([\w\-]+)="([^"]*)\s+"', r' \1="\2"'),
+)
+
+# invalid attribut tag, applied on the attributes of a single tag
+TAG_HREF = Rule(r'\A(| [^>]*) href="[^"]*"(| [^>]*)\Z', r'\1\2')
+TAG_ALIGN = Rule(r'\A(| [^>]*) align="[^"]*"(| [^>]*)\Z', r'\1\2')
+
+
+@Step
+def clean_tags(text: str) -> str:
+    '''
+    tokenizer engine of clean_basic(), do the same work that _clean_basic_tags()
+    but in a single walk over the tags, in place of a regex.loop() by rule
+    '''
     
-    # space inline
-    text = regex.loop(r'\s+((?:<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>)+)\s+', r' \1', text)
-    text = regex.loop(r'\s+((?:</(em|strong|sup|sub|u|s|span|a)>)+)\s+', r'\1 ', text)
+    text = apply_rules(TOKENIZER_CONTENT_RULES, text)
+    
+    rslt = []
+    # text merged over the removed invalid tags
+    raw = []
+    # text merged over the filtered tags
+    pending = []
+    # the previous tag is a <br>
+    strip_next = False
+    
+    def flush_raw():
+        if raw:
+            pending.append(_clean_text_attributs(''.join(raw)))
+            raw.clear()
+    
+    def flush():
+        nonlocal strip_next
+        flush_raw()
+        if pending:
+            t = ''.join(pending)
+            pending.clear()
+            if '="' in t:
+                t = apply_rules(SPACE_ATTRIBUTS_RULES, t)
+            if strip_next:
+                t = t.lstrip(SPACES)
+            if t:
+                rslt.append(t)
+        strip_next = False
+    
+    def append_br(tag: str):
+        nonlocal strip_next
+        flush()
+        # space before <br>
+        while rslt:
+            t = rslt[-1].rstrip(SPACES)
+            if t:
+                rslt[-1] = t
+                break
+            rslt.pop()
+        rslt.append(tag)
+        strip_next = True
+    
+    for tag in tokenize(text):
+        if not isinstance(tag, Tag):
+            raw.append(tag)
+            continue
+        
+        name = tag.name
+        is_br = name[:2] in ('br', 'hr')
+        
+        if not tag.is_self_closing():
+            # not a tag for the most of the rules
+            if is_br:
+                if tag.close:
+                    flush_raw()
+                else:
+                    append_br('<'+name[:2]+'>')
+            elif name.startswith('img'):
+                if tag.close:
+                    flush_raw()
+                else:
+                    tag.attributes = tag.attributes.rstrip('/')
+                    raw.append(str(tag))
+            else:
+                raw.append(str(tag))
+            continue
+        
+        # convert tag
+        if name in CONVERT_TAGS and tag.is_simple():
+            tag.name = name = CONVERT_TAGS[name]
+        
+        # remove invalid tag
+        if not name.startswith(TAGS_PREFIX):
+            continue
+        
+        flush_raw()
+        
+        if '="' in tag.attributes:
+            tag.attributes = _clean_text_attributs(tag.attributes)
+        
+        # filtre not desired tag
+        if name in FILTER_TAGS and tag.is_simple():
+            continue
+        
+        # clean img
+        if name.startswith('img'):
+            if tag.close:
+                continue
+            tag.attributes = tag.attributes.rstrip('/')
+        
+        if not tag.close and '="' in tag.attributes:
+            # invalid attribut tag
+            if not name.startswith('a') and ' href="' in tag.attributes:
+                tag.attributes = TAG_HREF(tag.attributes)
+            if (' align="' in tag.attributes and not name.startswith(('p', 'div', 'li', 'ol', 'ul'))
+                    and not (name[0] == 'h' and name[1:2].isdigit())):
+                tag.attributes = TAG_ALIGN(tag.attributes)
+            
+            tag.attributes = apply_rules(SPACE_ATTRIBUTS_RULES, tag.attributes)
+        
+        # management of <br>
+        if is_br and (name[2:] or tag.attributes):
+            if tag.close:
+                continue
+            tag.name = name[:2]
+            tag.attributes = ''
+        
+        if not tag.close and tag.name in ('br', 'hr') and not tag.attributes:
+            append_br(str(tag))
+        else:
+            flush()
+            rslt.append(str(tag))
     
-    # empty block
-    text = regex.loop(r'\s*<(p|div|h\d|li|ol|ul)(| [^>]*)>\s*</\1>', r'', text)
-    text = regex.loop(r'\s*<(p|div|h\d|li|ol|ul)(| [^>]*)/>', r'', text)
+    flush()
+    return ''.join(rslt)
+
+
+def _clean_text_attributs(text: str) -> str:
+    if '="' in text:
+        text = apply_rules(TEXT_ATTRIBUTS_RULES, text)
+    return text
+
+
+# the known attributs first, in this order, then the others
+ATTRIBUTES_ORDER = {atr:idx for idx,atr in enumerate(sorted(ATTRIBUTES))}
+
+TAG_ATTRIBUTS = re.compile(r'<(\w[\w\-]*)(\s[^<>]*?)(/?)>', FLAGS)
+ATTRIBUT = re.compile(r'\s+([\w\-:]+)="([^"]*)"|\s+\Z', FLAGS)
+
+# for the tags that are not only made of name="value"
+EMPTY_ATTRIBUT = Rule(r' ([\w\-]+)="\s*"', r'')
+ORDERED_ATTRIBUTS_RULES = rules(*[
+    (r'<(\w+)\s+([\w\-]+=[^>]*)\s+'+atr+r'="([^"]*)"', r'<\1 '+atr+r'="\3" \2') for atr in reversed(sorted(ATTRIBUTES))
+])
+
+
+def parse_attributs(attributes: str) -> Optional[Dict[str, str]]:
+    '''
+    the attributs ' name="value"' of a tag, by name in the order of the text
+    the empty attributs are removed and the values of a duplicate attribut are merged
+    None if the attributes are not only made of name="value"
+    '''
+    rslt = {}
+    pos = 0
+    end = len(attributes)
+    while pos < end:
+        m = ATTRIBUT.match(attributes, pos)
+        if not m:
+            return None
+        pos = m.end()
+        name, value = m.groups()
+        if not name or not value.strip():
+            continue
+        if name in rslt:
+            rslt[name] += ' '+value
+        else:
+            rslt[name] = value
+    return rslt
+
+
+def format_attributs(attributs: Dict[str, str]) -> str:
+    names = sorted(attributs, key=lambda name: ATTRIBUTES_ORDER.get(name, len(ATTRIBUTES_ORDER)))
+    return ''.join(' '+name+'="'+attributs[name]+'"' for name in names)
+
+
+def _ordered_tag(m: re.Match) -> str:
+    attributs = parse_attributs(m.group(2))
+    if attributs is None:
+        return apply_rules(ORDERED_ATTRIBUTS_RULES, EMPTY_ATTRIBUT(m.group(0)))
+    return '<'+m.group(1)+format_attributs(attributs)+m.group(3)+'>'
+
+
+@Step
+def ordered_attributs(text: str) -> str:
+    '''
+    order the attributs of all the tags, remove the empty ones and merge the duplicates
+    the attributs of each tag are parsed once, in a single pass over the text
+    '''
+    return TAG_ATTRIBUTS.sub(_ordered_tag, text)
+
+
+BASIC_BR_INLINE_RULES = rules(
+    # <br> inside inline
+    (r'<((?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*))><(b|h)r>', r'<\2r><\1>'),
+    (r'<(b|h)r></(em|strong|sup|sub|u|s|span|a)>', r'</\2><\1r>'),
+)
+
+# empty inline
+INLINE_SPACE = Rule(r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>\s+</\1>', r' ')
+INLINE_EMPTY = Rule(r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)></\1>', r'')
+# same inline
+SAME_SPACE = Rule(r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>([^<]*)</\1>\s+<\1\2>', r'<\1\2>\3 ')
+SAME_EMPTY = Rule(r'<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>([^<]*)</\1><\1\2>', r'<\1\2>\3')
+
+INLINE_RULES = (INLINE_SPACE, INLINE_EMPTY, SAME_SPACE, SAME_EMPTY)
+
+
+@Step
+def clean_inline(text: str) -> str:
+    # empty and same inline, until none left
+    while (INLINE_SPACE.search(text) or
+        INLINE_EMPTY.search(text) or
+        SAME_SPACE.search(text) or
+        SAME_EMPTY.search(text)):
+        
+        text = apply_rules(INLINE_RULES, text)
     
-    # double space and tab in <p>
-    text = regex.loop(r'(<(p|h\d|li)(| [^>]*)>(?:(?!</\2).)*?)(\t|\n|\s{2,})', r'\1 ', text)
+    return text
+
+
+_rgx_p = r'((?:</?(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)(</?(?:p|div|h\d|li)(?:| [^>]*)>)((?:</?(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)'
+_rgx_br = r'((?:</(?:em|strong|sup|sub|u|s|span|a)>)*)(<br>)((?:<(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)'
+
+# double space and tab in <p>, all the spaces of the block in one pass
+BLOCK_SPACES = re.compile(r'\s{2,}|\t|\n', FLAGS)
+BLOCK_SPACES_RULE = Rule(r'(<(p|h\d|li)(?:| [^>]*)>)((?:(?!</\2).)*)',
+                         lambda m: m.group(1) + BLOCK_SPACES.sub(' ', m.group(3)), simple=True)
+
+BASIC_RULES = rules(
+    # space inline
+    (r'\s+((?:<(em|strong|sup|sub|u|s|span|a)(| [^>]*)>)+)\s+', r' \1'),
+    (r'\s+((?:</(em|strong|sup|sub|u|s|span|a)>)+)\s+', r'\1 '),
     
+    # empty block
+    (r'\s*<(p|div|h\d|li|ol|ul)(| [^>]*)>\s*</\1>', r''),
+    (r'\s*<(p|div|h\d|li|ol|ul)(| [^>]*)/>', r''),
+) + (
+    BLOCK_SPACES_RULE,
+) + rules(
     # space and <br> before/after <p>
-    rgx = r'((?:</?(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)(</?(?:p|div|h\d|li)(?:| [^>]*)>)((?:</?(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)'
-    text = regex.loop(r'(?:\s|'+NBSP+r'|<br>)*'+rgx+r'(?:\s|'+NBSP+r'|<br>)+', r'\1\2\3', text)
-    text = regex.loop(r'(?:\s|'+NBSP+r'|<br>)+'+rgx+r'(?:\s|'+NBSP+r'|<br>)*', r'\1\2\3', text)
+    (r'(?:\s|'+NBSP+r'|<br>)*'+_rgx_p+r'(?:\s|'+NBSP+r'|<br>)+', r'\1\2\3'),
+    (r'(?:\s|'+NBSP+r'|<br>)+'+_rgx_p+r'(?:\s|'+NBSP+r'|<br>)*', r'\1\2\3'),
     # restore empty <p>
-    text = regex.loop(r'<(p|div|h\d|li)(| [^>]*)>(<(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*(?:<br>)*(</(?:em|strong|sup|sub|u|s|span|a)>)*</\1>', r'<\1\2>'+NBSP+r'</\1>', text)
+    (r'<(p|div|h\d|li)(| [^>]*)>(<(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*(?:<br>)*(</(?:em|strong|sup|sub|u|s|span|a)>)*</\1>', r'<\1\2>'+NBSP+r'</\1>'),
     
     # space with inline before/after <br>
-    rgx = r'((?:</(?:em|strong|sup|sub|u|s|span|a)>)*)(<br>)((?:<(?:em|strong|sup|sub|u|s|span|a)(?:| [^>]*)>)*)'
-    text = regex.loop(r'(?:\s|'+NBSP+r')*'+rgx+r'(?:\s|'+NBSP+r')+', r'\1\2\3', text)
-    text = regex.loop(r'(?:\s|'+NBSP+r')+'+rgx+r'(?:\s|'+NBSP+r')*', r'\1\2\3', text)
+    (r'(?:\s|'+NBSP+r')*'+_rgx_br+r'(?:\s|'+NBSP+r')+', r'\1\2\3'),
+    (r'(?:\s|'+NBSP+r')+'+_rgx_br+r'(?:\s|'+NBSP+r')*', r'\1\2\3'),
     
     # space line return for lists
-    text = regex.loop(r'><(p|div|h\d|li|ol|ul)', r'>\n<\1', text)
-    text = regex.loop(r'<(ol|ul)(| [^>]*)>\s+<li', r'<\1\2><li', text)
-    text = regex.loop(r'</li>\s+</(ol|ul)>', r'</li></\1>', text)
+    (r'><(p|div|h\d|li|ol|ul)', r'>\n<\1'),
+    (r'<(ol|ul)(| [^>]*)>\s+<li', r'<\1\2><li'),
+    (r'</li>\s+</(ol|ul)>', r'</li></\1>'),
     
     # style: del double
-    text = regex.loop(r' style="([^"]*);\s*;([^"]*)"', r' style="\1;\2"', text)
+    (r' style="([^"]*);\s*;([^"]*)"', r' style="\1;\2"'),
     # style: clean space before :
-    text = regex.loop(r' style="([^"]*)\s+(;|:)([^"]*)"', r' style="\1\2\3"', text)
+    (r' style="([^"]*)\s+(;|:)([^"]*)"', r' style="\1\2\3"'),
     # style: clean space after :
-    text = regex.loop(r' style="([^"]*(?:;|:))\s{2,}([^"]*)"', r' style="\1 \2"', text)
+    (r' style="([^"]*(?:;|:))\s{2,}([^"]*)"', r' style="\1 \2"'),
     # style: insert space after :
-    text = regex.loop(r' style="([^"]*(?:;|:))([^ ][^"]*)"', r' style="\1 \2"', text)
+    (r' style="([^"]*(?:;|:))([^ ][^"]*)"', r' style="\1 \2"'),
     # style: remove last
-    text = regex.loop(r' style="([^"]*);\s*"', r' style="\1"', text)
-    
-    # remove empty attribut
-    text = regex.loop(r' ([\w\-]+)="\s*"', r'', text)
-    
+    (r' style="([^"]*);\s*"', r' style="\1"'),
+) + (
+    # remove empty attribut, and order them
+    ordered_attributs,
+) + rules(
     # strip <span>
-    text = regex.loop(r'<span\s*>(((?!<span).)*?)</span>', r'\1', text)
-    text = regex.loop(r'<span\s*>(((?!<span).)*?(<span[^>]*>((?!</?span).)*?</span>((?!</?span).)*?)+)</span>', r'\1', text)
+    (r'<span\s*>(((?!<span).)*?)</span>', r'\1'),
+    (r'<span\s*>(((?!<span).)*?(<span[^>]*>((?!</?span).)*?</span>((?!</?span).)*?)+)</span>', r'\1'),
     
     # empty hyperlink
-    text = regex.loop(r'<a\s*>(.*?)</a>', r'\1', text)
+    (r'<a\s*>(.*?)</a>', r'\1'),
     
     ## replaces the invalid triple point
-    # text = regex.simple(r'\.\s*\.\s*\.', r'…', text)
-    text = regex.loop(r'\.\s+\.\s*\.', r'…', text)
-    text = regex.loop(r'\.\s*\.\s+\.', r'…', text)
-    
-    text = XMLformat(text)
-    
-    text = ordered_attributs(text)
-    
-    return text
+    # (r'\.\s*\.\s*\.', r'…'),
+    (r'\.\s+\.\s*\.', r'…'),
+    (r'\.\s*\.\s+\.', r'…'),
+)
 
 
+STANDARD_STYLE = Rule(r' style="([^"]*[^";])"', r' style="\1;"')
+
+
+@Step
 def standard_style(text: str) -> str:
     # style standardization:  insert ; at the end
-    text = regex.loop(r' style="([^"]*[^";])"', r' style="\1;"', text)
+    text = STANDARD_STYLE(text)
     # style standardization: insert space at the start
     text = text.replace(' style="', ' style=" ')
     
     return text
 
 
-# Ordered the attributs
-def ordered_attributs(text: str) -> str:
-    
-    for atr in reversed(sorted(ATTRIBUTES)):
-        text = regex.loop(r'<(\w+)\s+([\w\-]+=[^>]*)\s+'+atr+r'="([^"]*)"', r'<\1 '+atr+r'="\3" \2', text)
+XML_RULES = rules(
+    # XML format
+    (r'<([^<>]+)(?:\s{2,}|\n|\t)([^<>]+)>', r'<\1 \2>'),
+    (r'\s+(|/|\?)\s*>', r'\1>'),
+    (r'<\s*(|/|!|\?)\s+', r'<\1'),
     
-    return text
+    (r"='([^']*)'", r'="\1"'),
+)
 
 
+@Step
 def XMLformat(text: str) -> str:
     text = '\n'.join([l.rstrip() for l in text.splitlines()])
-    
-    # XML format
-    text = regex.loop(r'<([^<>]+)(?:\s{2,}|\n|\t)([^<>]+)>', r'<\1 \2>', text)
-    text = regex.loop(r'\s+(|/|\?)\s*>', r'\1>', text)
-    text = regex.loop(r'<\s*(|/|!|\?)\s+', r'<\1', text)
-    
-    text = regex.loop(r"='([^']*)'", r'="\1"', text)
-    
-    return text
+    return apply_rules(XML_RULES, text)
 
 
 def calibre_editor():
@@ -295,6 +686,8 @@ def calibre_format(text: str) -> str:
     '''
     pass the comment in the Calibre comment editor
     fix some last errors, better interpolarity Calibre <> plugin
+    
+    need the GUI thread, html_formatter.format_html() do the same without Qt
     '''
     ce = calibre_editor()
     ce.html = text
@@ -309,385 +702,1052 @@ def calibre_remove_format(text: str) -> str:
     return ce.html.strip()
 
 
+def check_formatter(texts: Iterable[str]) -> List[Tuple[str, str, str]]:
+    '''
+    compare the built-in formatter to the Calibre comments editor
+    return the list of (text, calibre, built-in) that are different
+    
+    need the GUI thread, run it from calibre-debug -g or the console of the plugin
+    '''
+    rslt = []
+    for text in texts:
+        ce, bi = calibre_format(text), format_html(text)
+        if ce != bi:
+            rslt.append((text, ce, bi))
+        ce, bi = calibre_remove_format(text), remove_format(text)
+        if ce != bi:
+            rslt.append((text, ce, bi))
+    return rslt
+
+
 def normalize_comment(text: str) -> str:
+    '''
+    the canonical form NFC of the text
+    the same object if it's already NFC, check it with "is" instead of comparing the texts
+    '''
+    if unicodedata.is_normalized('NFC', text):
+        return text
     return unicodedata.normalize('NFC', text)
 
 
-# main function
-def clean_comment(text: str, prefs: Optional[dict]=None) -> str:
-    prefs = _set_prefs(prefs)
+# the line breaks of Windows and the old Mac OS
+NEWLINES = Step(lambda text: text.replace('\r\n', '\n').replace('\r', '\n'), 'newlines')
+
+HAS_TAG = re.compile(r'<\w+(| [^>]*)/?>', FLAGS)
+HAS_PARA = re.compile(r'<(p|div)(| [^>]*)>', FLAGS)
+BASIC_HTML_BR = Rule(r'\s*<br(| [^>]*)/?>\s*', '\n\n')  # Calibre format
+
+ROOT_DIV = re.compile(r'<div(| [^>]*)>\s*<(p|div|h\d)(| [^>]*)>', FLAGS)
+
+BLOCK_TAG = re.compile(r'<(/?)(p|h\d)(| [^>]*)>', FLAGS)
+
+
+@Step
+def unnest_blocks(text: str) -> str:
+    '''
+    split the <p> and <h1-6> nested in another one, in a single walk over these tags:
+        <p1>a<p2>b</p>c</p>  =>  <p1>a</p><p2>b</p><p1>c</p>
+    the outer block is removed where it contains only spaces:
+        <p1> <p2>b</p> </p>  =>  <p2>b</p>
+    a block that open inside another close it, like in HTML, so a unclosed <p> end at the next one
+    
+    the result is the same as the previous regex rules, that were applied one after the other:
+    - a heading is only split of a paragraph (and the reverse) if it's alone in it,
+      else it stay inside, as text:
+        <p1> <h3>a</h3> </p>  =>  <h3>a</h3>
+        <p1> <h3>a</h3>b</p>  =>  <p1> <h3>a</h3>b</p>
+    - when the outer block contain several blocks, the spaces after the last one stay in a empty block,
+      and if there is some text before them, the spaces between them too:
+        <p1> <p2>b</p> <p3>c</p> </p>  =>  <p2>b</p><p3>c</p><p1> </p>
+        <p1>a<p2>b</p> <p3>c</p> </p>  =>  <p1>a</p><p2>b</p><p1> </p><p3>c</p><p1> </p>
+    - a unclosed outer block stay open before its last block:
+        <p1>a<p2>b</p> <p3>c</p>d  =>  <p1>a</p><p2>b</p><p1> <p3>c</p>d
+    only some malformed nesting (a paragraph in a heading in a paragraph) can still give a other result
+    '''
+    rslt = []
+    # open blocks: [name, tag, written, nested, spaces, headings, split, last]
+    # written: the open tag is in rslt, else it's written before the next text
+    # nested: count of blocks it contained, the outer block is not keep if it contains only spaces
+    # headings: [position in rslt, spaces, count] of the open tag while it contains only headings,
+    #           the tag is inserted there if it's not a single heading
+    # split: had some text before a nested block, the spaces between the next ones are keep
+    # last: [position in rslt, spaces, closed, (position of the open tag)] before the last nested block
+    #       and of the text after it, for a unclosed block
+    stack = []
+    # headings keep as text inside a paragraph (and the reverse), see below
+    as_text = []
+    
+    def write_headings(top: list):
+        idx, spaces, count = top[5]
+        rslt[idx:idx] = [top[1], *spaces]
+        rslt.extend(top[4])
+        top[2] = True
+        top[4].clear()
+        top[5] = None
+    
+    def add_text(t: str):
+        if not t:
+            return
+        if stack and not stack[-1][2]:
+            top = stack[-1]
+            if not t.strip(SPACES_ASCII):
+                top[4].append(t)
+                return
+            if top[5]:
+                write_headings(top)
+            else:
+                if top[7]:
+                    top[7].append(len(rslt))
+                rslt.append(top[1])
+                rslt.extend(top[4])
+            top[2] = True
+            top[4].clear()
+        rslt.append(t)
+    
+    def close_top():
+        top = stack.pop()
+        name, tag, written, nested, spaces, headings, split, last = top
+        if headings and headings[2] > 1:
+            write_headings(top)
+            written = True
+        if written:
+            rslt.append('</'+name+'>')
+        elif not headings and (not nested or nested > 1):
+            # not a nested block, keep it as it
+            # or the spaces after the last nested one (a single heading is alone, not keep)
+            rslt.append(tag)
+            rslt.extend(spaces)
+            rslt.append('</'+name+'>')
+        if stack:
+            # text after the inner block
+            stack[-1][2] = False
+    
+    pos = 0
+    for m in BLOCK_TAG.finditer(text):
+        add_text(text[pos:m.start()])
+        pos = m.end()
+        name = m.group(2)
+        
+        if not m.group(1):
+            if stack:
+                top = stack[-1]
+                if name[0] == 'h' or top[0][0] == 'h':
+                    if top[2] or top[3]:
+                        # a heading with some text or block around, not a nested paragraph
+                        as_text.append(name)
+                        add_text(m.group(0))
+                        continue
+                    if top[5]:
+                        rslt.extend(top[4])
+                        top[5][2] += 1
+                    else:
+                        top[5] = [len(rslt), list(top[4]), 1]
+                    top[4].clear()
+                    stack.append([name, m.group(0), False, 0, [], None, False, None])
+                    continue
+                
+                if top[5]:
+                    write_headings(top)
+                closed = True
+                if top[2]:
+                    rslt.append('</'+top[0]+'>')
+                    top[2] = False
+                    top[6] = True
+                elif top[3] and top[6]:
+                    # the spaces between the blocks
+                    rslt.append(top[1])
+                    rslt.extend(top[4])
+                    rslt.append('</'+top[0]+'>')
+                else:
+                    closed = False
+                top[7] = [len(rslt), list(top[4]), closed]
+                top[3] += 1
+                top[4].clear()
+            stack.append([name, m.group(0), False, 0, [], None, False, None])
+            continue
+        
+        if as_text and as_text[-1] == name:
+            as_text.pop()
+            add_text(m.group(0))
+            continue
+        if not any(b[0] == name for b in stack):
+            # close tag without block
+            add_text(m.group(0))
+            continue
+        while stack[-1][0] != name:
+            close_top()
+        close_top()
+    
+    add_text(text[pos:])
+    
+    # unclosed blocks, keep them as it
+    for name, tag, written, nested, spaces, headings, split, last in stack:
+        if not written and not nested and not headings:
+            rslt.append(tag)
+            rslt.extend(spaces)
+    # or open before there last block, the inner ones first
+    for name, tag, written, nested, spaces, headings, split, last in reversed(stack):
+        if last:
+            idx, spaces, closed, *text_after = last
+            if text_after:
+                rslt[text_after[0]] = ''
+            if closed:
+                rslt[idx-1] = ''
+            else:
+                rslt[idx:idx] = [tag, *spaces]
+    
+    return ''.join(rslt)
+
+
+# a <p> or <h1-6> block, without nested block (see unnest_blocks)
+BLOCK_SEGMENT = re.compile(r'<(p|h\d)(?:| [^>]*)>(?:(?!</?(?:p|h\d)[ >]).)*</\1>', FLAGS)
+
+
+def apply_block_rules(steps: Iterable[Rule], text: str) -> str:
+    '''
+    same as apply_rules() for the rules that match only inside a <p> or <h1-6> block
     
-    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    the first substitution is done on the whole text, then the loop continue
+    on each block that still match, not on the whole text at each iteration
+    '''
+    check_budget()
+    for rule in steps:
+        if not rule.search(text):
+            continue
+        text = rule.sub(text)
+        if rule.simple or not rule.search(text):
+            continue
+        text = BLOCK_SEGMENT.sub(lambda m, rule=rule: rule(m.group(0)), text)
+        # a match outside the blocks (malformed text)
+        text = rule(text)
+    return text
+
+
+# the content of the <div> rules can contain other <div>, the first <div> keep the attributs of the outer ones
+# they are only applied before the last closing tag they need, see loop_before()
+EMPTY_DIV = re.compile(r'<div(| [^>]*)>'+NBSP+r'</div>', FLAGS)
+DEL_EMPTY_DIV = re.compile(r'<div(| [^>]*)>(.*?)<div(| [^>]*)>'+NBSP+r'</div>', FLAGS)
+CLOSE_DIV = re.compile(r'</div>', FLAGS)
+DIV_IN_DIV = re.compile(r'<div(| [^>]*)>(.*?)<div(| [^>]*)>(.*?)</div>', FLAGS)
+
+
+@Step
+def del_empty_div(text: str) -> str:
+    return loop_before(DEL_EMPTY_DIV, r'<div>\2', EMPTY_DIV, text)
+
+
+@Step
+def div_in_div(text: str) -> str:
+    # Convert <div> after a <div> in <p>
+    return loop_before(DIV_IN_DIV, r'<div>\2<p\3>\4</p>', CLOSE_DIV, text)
+
+
+PASSE_RULES = (
+    # Del empty <div>
+    del_empty_div,
+    
+    # Convert <div> after a <div> in <p>
+    div_in_div,
+    
+    # <p> in <p>
+    unnest_blocks,
+) + rules(
+    # Del empty <p> at the start/end
+    (r'<div(?:| [^>]*)>\s*<(p|h\d)(| [^>]*)>'+NBSP+r'</\1>', r'<div>'),
+    (r'<(p|h\d)(| [^>]*)>'+NBSP+r'</\1>\s*</div>', r'</div>'),
+    
+    # Convert empty <table>to empty <p>
+    (r'<table(| [^>]*)>(?:\s*<tbody>)?\s*(?:<tr(?:| [^>]*)>(?:\s*<td(| [^>]*)>\s*</td>)+\s*</tr>)+(?:\s*</tbody>)?\s*</table>', r'<p\1\2>'+NBSP+r'</p>'),
+    
+    # Convert <table> with only 1 row and 1 cell to <p>
+    (r'<table(| [^>]*)>(?:\s*<tbody>)?\s*<tr(?:| [^>]*)>\s*<td(| [^>]*)>((?:(?!</?(?:table|tr|td)[ >]).)*?)</td>\s*</tr>(?:\s*</tbody>)?\s*</table>', r'<p\1\2>\3</p>'),
+) + (
+    # Merge duplicate attributs
+    ordered_attributs,
+)
+
+# remove explicit weight formatting in headings
+HEADINGS_WEIGHT = Rule(r'<(h\d)([^>]*) style="([^"]*)font-weight: [\w\d]+([^"]*)"([^>]*)>', r'<\1\2 style="\3\4"\5>')
+
+# rules inside a <p> or <h1-6>, see apply_block_rules()
+FORMAT_BLOCK_RULES = rules(
+    # Del <sup>/<sub> paragraphe
+    (r'<(p|h\d)(| [^>]*)>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\3>\s*</\1>', r'<\1\2>\4</\1>'),
+    (r'<(p|h\d)(| [^>]*)>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\3>\s*<br>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\5>\s*</\1>', r'<\1\2>\4<br>\6</\1>'),
+    
+    # <br> in same tag
+    (r'<((\w+)(?:| [^>]*))>((?:(?:<br>)|[^<>])*?)</\2><br><\1>', r'<\1>\3<br>'),
+)
+
+FORMAT_RULES = rules(
+    # del attibuts for <div> with <p>
+    (r'<div[^>]+>\s*<(p|h\d)', r'<div>\n<\1'),
     
-    text = clean_caps_tags(text)
+    # clean text full heading
+    (r'^\s*<div>\s*<h(\d)(| [^>]*)>((?:(?:<br>)|[^<>])*?)</h\1>\s*</div>\s*$', r'<div><p\2>\3</p></div>'),
     
-    # if plain text (no tag)
-    if not regex.search(r'<\w+(| [^>]*)/?>', text):
-        text = convert_plain(text)
+    # clean text full bold
+    (r'^\s*<div>\s*<p([^>]*?)font-weight:\s*\d+([^>]*?)>((?:(?:<br>)|[^<>])*?)</p>\s*</div>\s*$', r'<div><p\1\2>\3</p></div>'),
     
-    # if basic html text
-    # html without <p> or <div> (qt style)
-    if regex.search(r'<\w+(| [^>]*)/?>', text) and not regex.search(r'<(p|div)(| [^>]*)>', text):
-        text = regex.loop(r'\s*<br(| [^>]*)/?>\s*', '\n\n', text)  # Calibre format
-        text = convert_plain(text)
+    (r'^\s*<div>\s*<p([^>]*?)><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong></p>\s*</div>\s*$', r'<div><p\1><span\2>\3</span></p></div>'),
+    (r'^\s*<div>\s*<p([^>]*?)><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong><br><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong></p>\s*</div>\s*$', r'<div><p\1><span\2>\3</span><br><span\4>\5</span></p></div>'),
     
-    # double passe
-    # Empirical tests have shown that it was necessary for some very rare and specific cases.
-    for passe in range(2):
-        
-        text = clean_basic(text)
-        
-        # If <div> is not the racine tag
-        if not regex.search(r'<div(| [^>]*)>\s*<(p|div|h\d)(| [^>]*)>', text):
-            text = '<div>'+text+'</div>'
-        
-        # Del empty <div>
-        text = regex.loop(r'<div(| [^>]*)>(.*?)<div(| [^>]*)>'+NBSP+r'</div>', r'<div>\2', text)
+    (r'^\s*<div>\s*<p([^>]*?)><(\w+)([^>]*?)font-weight:\s*\d+([^>]*?)>((?:(?:<br>)|[^<>])*?)</\2></p>\s*</div>\s*$',
+        r'<div><p\1><\2\3\4>\5</\2></p></div>'),
+    (r'^\s*<div>\s*<p([^>]*?)font-weight:\s*\d+([^>]*?)><(\w+)([^>]*?)>((?:(?:<br>)|[^<>])*?)</\3></p>\s*</div>\s*$',
+        r'<div><p\1\2><\3\4>\5</\3></p></div>'),
+)
+
+FINAL_RULES = rules(
+    # fix weight
+    *([(r' style="([^"]*)'+FONT_WEIGHT+r'([^"]*)"', r' style="\1font-weight: bold\2"')] if CALIBRE_VERSIONS_BOLD else []),
+    
+    (r'<p( [^>]*)style="[^"]*"([^>]*)>'+NBSP+r'</p>', r'<p\1\2>'+NBSP+r'</p>'),
+)
+
+ALIGN_RULES = rules(
+    # insert align left for all
+    # (simple, see below)
+    
+    # delete align left if another exist
+    (r'<(p|div|li|h1|h2|h3|h4|h5|h6) align="left"( align="[^"]*")', r'<\1\2'),
+    
+    # swap text-align to align
+    (r' align="[^"]*"([^>]*) style="([^"]*) text-align:\s*([^;]*)\s*;([^"]*)"', r' align="\3"\1 style="\2\4"'),
+    
+    # clean space in attribut
+    (r' align="\s+([^"]*)"', r' align="\1"'),
+    (r' align="([^"]*)\s+"', r' align="\1"'),
+    
+    # align valide value
+    (r' align="justify-all"', r' align="justify"'),
+    (r' align="(?!left|justify|center|right)[^"]*"', r' align="left"'),
+    
+    # apply cascading heritage for list
+    (r'<(ol|ul) align="left"', r'<\1'),
+) + (
+    # all the items of the list in one pass
+    Rule(r'(<(ol|ul) align="([^"]*)"[^>]*>)((?:(?!</\2>).)*)',
+         lambda m: m.group(1) + m.group(4).replace('<li align="left"', '<li align="'+m.group(3)+'"'), simple=True),
+) + rules(
+    (r'<(ol|ul) align="([^"]*)"', r'<\1'),
+)
+ALIGN_LEFT = Rule(r'<(p|div|li|h1|h2|h3|h4|h5|h6)', r'<\1 align="left"', simple=True)
+
+ALIGN_END_RULES = rules(
+    # del text-align
+    (r' style="([^"]*) text-align:([^;]*);([^"]*)"', r' style="\1\3"'),
+    
+    # del justify for <h1>
+    (r'<(h\d) align="justify"', r'<\1'),
+    
+    # del text-align left (default value)
+    (r' align="left"', r''),
+)
+
+# the style attributs and the CSS declarations, see Cleaner.clean_style()
+STYLE_ATTRIBUT = re.compile(r' style="([^"]*)"', FLAGS)
+# a ; or a space before a new "name:", in case of a missing ;
+CSS_SEPARATOR = re.compile(r';|\s(?=[\w\-]+\s*:)', FLAGS)
+CSS_DECLARATION = re.compile(r'\s*([\w\-]+)\s*:\s*(.*?)\s*', FLAGS)
+
+# font-weight
+WEIGHT_NUMBER = re.compile(r'(\d+)(?:\.\d+)?', FLAGS)
+WEIGHT_DEL_TAG = Rule(r'<(/?)strong(| [^>]*)>', r'<\1span\2>')
+
+# font-style
+ITALIC_OBLIQUE = re.compile(r'oblique(?:\s+\d+deg)?', FLAGS)
+ITALIC_DEL_TAG = Rule(r'<(/?)em(| [^>]*)>', r'<\1span\2>')
+
+# text-decoration
+DECORATION_CLEAN = re.compile(r' (?:none|blink|overline|inherit|initial|unset)', FLAGS)
+UNDERLINE_DEL = re.compile(r' underline', FLAGS)
+UNDERLINE_DEL_TAG = Rule(r'<(/?)u(| [^>]*)>', r'<\1span\2>')
+STRIKE_DEL = re.compile(r' line-through', FLAGS)
+STRIKE_DEL_TAG = Rule(r'<(/?)s(| [^>]*)>', r'<\1span\2>')
+
+DECORATION_RULES = rules(
+    (r'<(p|h\d)(| [^>]*)( style="[^"]* text-decoration:[^;]*) underline([^;]*;[^"]*"[^>]*)>(.*?)</\1>',    r'<\1\2\3\4><u>\5</u></\1>'),
+    (r'<(p|h\d)(| [^>]*)( style="[^"]* text-decoration:[^;]*) line-through([^;]*;[^"]*"[^>]*)>(.*?)</\1>', r'<\1\2\3\4><s>\5</s></\1>'),
+    
+    (r' style="([^"]*) text-decoration:\s*;([^"]*)"', r' style="\1\2"'),
+)
+
+PLAIN_MARKDOWN_RULES = rules(
+    (r'^(\d{4})(\.|:)', r'\1\0\2'),
+    (r'\n(\d{4})(\.|:)', r'\n\1\0\2'),
+)
+PLAIN_MARKDOWN_END_RULES = rules(
+    (r'\0', r''),
+    (r'>\n+<', '><'),
+    (r'<br(| [^>]*)/?>\s+', r'<br>'),
+    (r'\s+<br(| [^>]*)/?>', r'<br>'),
+)
+# Convert two hyphens to emdash
+PLAIN_DASH = Step(lambda text: text.replace('--', '—'), 'plain_dash')
+PLAIN_BR = Rule(r'<br(| [^>]*)/?>', r'\n')
+PLAIN_PARA = Rule(r'\n{2,}', r'</p><p>')
+PLAIN_DIV = Step(lambda text: '<div><p>' + PLAIN_PARA(text) + '</p></div>', 'plain_div')
+PLAIN_RULES = rules(
+    (r'<p>\s*<p>', r'<p>'),
+    (r'</p>\s*</p>', r'</p>'),
+    (r'\n', r'<br>'),
+    (r'(<p>|<br>)\s+', r'\1'),
+    (r'\s+(<p>|<br>)', r'\1'),
+)
+
+# a text already clean, see Cleaner.is_clean()
+_rgx_inline = r'(?:em|strong|sup|sub|u|s|span|a)'
+_rgx_inline_tags = r'(?:</?'+_rgx_inline+r'(?:| [^>]*)>)*'
+_rgx_block = r'(?:p|h[1-6]|li)'
+
+# a text that the cleaning would change, whatever the prefs
+NOT_CLEAN = re.compile('|'.join([
+    # spaces
+    r'\s\s|\t|\n(?!<(?:p|h[1-6]|ul|ol|li)[ >])',
+    r'&(?!(?:amp|lt|gt);)',
+    # spaces and <br> at the start/end of a block, <br> near a tag or another <br>
+    r'<'+_rgx_block+r'(?:| [^>]*)>'+_rgx_inline_tags+r'(?:\s|'+NBSP+r'|<br>)',
+    r'(?:\s|'+NBSP+r'|<br>)'+_rgx_inline_tags+r'</'+_rgx_block+r'>',
+    r'[\s>]<br>|<br>[\s<]',
+    # empty block, except the empty paragraphs (see EMPTY_PARA)
+    r'<('+_rgx_block+r')(?:| [^>]*)>(?!'+NBSP+r'</p>)(?:<[^>]*>|'+NBSP+r')*</\1>',
+    r'<(ul|ol)>\s*</\1>',
+    # space inline, empty inline, same inline
+    r'\s(?:<'+_rgx_inline+r'(?:| [^>]*)>)+\s',
+    r'\s(?:</'+_rgx_inline+r'>)+\s',
+    r'<('+_rgx_inline+r')(?:| [^>]*)>[\s'+NBSP+r']*</\1>',
+    r'</('+_rgx_inline+r')>\s*<\1[ >]',
+    # <sup>/<sub> paragraphe
+    r'<(?:p|h[1-6])(?:| [^>]*)>\s*<su[pb][ >]',
+    # style moved or removed
+    r' style="[^"]*text-align',
+    r'<(?:p|h[1-6])[^>]* style="[^"]*text-decoration',
+    r'<h[1-6][^>]* style="[^"]*font-weight',
+    # invalid triple point, single quote attribut
+    r'\.\s+\.\s*\.|\.\s*\.\s+\.',
+    r"='",
+]), FLAGS)
+
+# a empty paragraph, between two paragraphs not empty
+EMPTY_PARA = re.compile(r'\n<p(?:| align="[^"]*")>'+NBSP+r'</p>', FLAGS)
+EMPTY_PARA_NOT_CLEAN = re.compile(
+    r'(?<!</p>)\n<p(?:| [^>]*)>'+NBSP+r'</p>|<p(?:| [^>]*)>'+NBSP+r'</p>(?!\n<p(?:| [^>]*)>(?!'+NBSP+r'</p>))'
+    r'|<p [^>]*style="[^>]*>'+NBSP+r'</p>',
+    FLAGS,
+)
+
+# counters of the Cleaner, summed over the worker processes
+COUNTERS = ('second_passes', 'second_changes', 'prefiltered', 'prefilter_missed')
+
+
+class Cleaner:
+    '''
+    The cleaning pipeline, specialised for a set of prefs.
+    
+    The rules are compiled and the options resolved only once,
+    build it at the start of a job then call it for each comment:
+        cleaner = Cleaner(prefs)
+        text = cleaner(text)
+    
+    With a time_budget (seconds), a comment that take longer raise CommentTimeout.
+    
+    With prefilter 'skip', the comments already clean (see is_clean()) are returned as it,
+    with 'validate' they are cleaned anyway and the ones changed kept in prefilter_errors.
+    
+    second_passes and second_changes count the comments that needed the second passe
+    and the ones really changed by it, for the debug log. See counters() for the parallel cleaning.
+    '''
+    
+    def __init__(self, prefs: Optional[dict]=None, time_budget: Optional[float]=None,
+                    prefilter: Optional[str]=None):
+        self.prefs = prefs = _set_prefs(prefs)
+        self.time_budget = time_budget
         
-        # Convert <div> after a <div> in <p>
-        text = regex.loop(r'<div(| [^>]*)>(.*?)<div(| [^>]*)>(.*?)</div>', r'<div>\2<p\3>\4</p>', text)
+        self.second_passes = 0
+        self.second_changes = 0
         
-        # <p> in \s<p>\s
-        text = regex.loop(r'<(p|h\d)(| [^>]*)>\s*<(p|h\d)(| [^>]*)>((?:(?!</(?:p|h\d)>).)*?)</\3>\s*</\1>', r'<\3\4>\5</\3>', text)
-        # <p> in ??<p>\s
-        text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)<p(| [^>]*)>((?:(?!</p>).)*?)</p>\s*</p>', r'<p\1>\2</p><p\3>\4</p>', text)
-        # <p> in \s<p>??
-        text = regex.loop(r'<p(| [^>]*)>\s*<p(| [^>]*)>((?:(?!</p>).)*?)</p>((?:(?!</p>).)*?)</p>', r'<p\2>\3</p><p\1>\4</p>', text)
-        # <p> in ??<p>??
-        text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)<p(| [^>]*)>((?:(?!</p>).)*?)</p>((?:(?!</p>).)*?)</p>', r'<p\1>\2</p><p\3>\4</p><p\1>\5</p>', text)
+        # last text left unchanged by each step of clean_basic()
+        self.basic_fixpoints = {}
         
-        # Del empty <p> at the start/end
-        text = regex.loop(r'<div(?:| [^>]*)>\s*<(p|h\d)(| [^>]*)>'+NBSP+r'</\1>', r'<div>', text)
-        text = regex.loop(r'<(p|h\d)(| [^>]*)>'+NBSP+r'</\1>\s*</div>', r'</div>', text)
+        # skip the comments already clean, or check this skip
+        self.prefilter = prefilter
+        self.prefiltered = 0
+        self.prefilter_errors = []
+        self.prefilter_missed = 0
         
-        # Convert empty <table>to empty <p>
-        text = regex.loop(r'<table(| [^>]*)>(?:\s*<tbody>)?\s*(?:<tr(?:| [^>]*)>(?:\s*<td(| [^>]*)>\s*</td>)+\s*</tr>)+(?:\s*</tbody>)?\s*</table>', r'<p\1\2>'+NBSP+r'</p>', text)
+        if prefs[KEY.ENGINE] == 'tokenizer':
+            self.clean_tags = clean_tags
+        else:
+            self.clean_tags = _clean_basic_tags
         
-        # Convert <table> with only 1 row and 1 cell to <p>
-        text = regex.loop(r'<table(| [^>]*)>(?:\s*<tbody>)?\s*<tr(?:| [^>]*)>\s*<td(| [^>]*)>(.*?)</td>\s*</tr>(?:\s*</tbody>)?\s*</table>', r'<p\1\2>\3</p>', text)
+        if prefs[KEY.FORMATTER] == 'calibre':
+            self.format = Step(calibre_format)
+            self.remove_format = Step(calibre_remove_format)
+        else:
+            self.format = Step(format_html)
+            self.remove_format = Step(remove_format)
         
-        # Merge duplicate attributs
-        text = regex.loop(r' (\w+)="([^"]*)"([^>]*) \1="([^"]*)"', r' \1="\2 \4"\3', text)
+        # parse and clean the CSS of the style attributs
+        self.clean_css = Step(lambda text: STYLE_ATTRIBUT.sub(self._clean_style_attribut, text), 'clean_css')
         
-        # Markdown
-        if prefs[KEY.MARKDOWN] == 'always' and passe == 0:
-            text = clean_markdown(text)
+        self.plain_markdown = prefs[KEY.MARKDOWN] == 'try'
+        self.markdown = Step(markdown)
+        self.passe_markdown = prefs[KEY.MARKDOWN] == 'always'
         
+        # rules inside a <p>, see apply_block_rules()
+        block_rules = []
         # Multiple Line Return <br><br>
         if prefs[KEY.DOUBLE_BR] == 'new':
-            text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)(<br>){2,}', r'<p\1>\2</p><p\1>', text)
+            block_rules.append((r'<p(| [^>]*)>('+_rgx_in_p+r'*?)(<br>){2,}', r'<p\1>\2</p><p\1>'))
         elif prefs[KEY.DOUBLE_BR] == 'empty':
-            text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)(<br>){2,}', r'<p\1>\2</p><p\1>'+NBSP+r'</p><p\1>', text)
+            block_rules.append((r'<p(| [^>]*)>('+_rgx_in_p+r'*?)(<br>){2,}', r'<p\1>\2</p><p\1>'+NBSP+r'</p><p\1>'))
         
         # Single Line Return <br>
         if prefs[KEY.SINGLE_BR] == 'space':
-            text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)<br>((?:(?!</p>).)*?)</p>', r'<p\1>\2 \3</p>', text)
+            block_rules.append((r'<p(| [^>]*)>('+_rgx_in_p+r'*?)<br>('+_rgx_in_p+r'*?)</p>', r'<p\1>\2 \3</p>'))
         elif prefs[KEY.SINGLE_BR] == 'para':
-            text = regex.loop(r'<p(| [^>]*)>((?:(?!</p>).)*?)<br>((?:(?!</p>).)*?)</p>', r'<p\1>\2</p><p\1>\3</p>', text)
-            text = regex.loop(r'<p(| [^>]*)></p>', r'<p\1>'+NBSP+r'</p>', text)
+            block_rules.append((r'<p(| [^>]*)>('+_rgx_in_p+r'*?)<br>('+_rgx_in_p+r'*?)</p>', r'<p\1>\2</p><p\1>\3</p>'))
+            block_rules.append((r'<p(| [^>]*)></p>', r'<p\1>'+NBSP+r'</p>'))
+        
+        self.block_rules = rules(*block_rules)
         
+        text_rules = []
         # Empty paragraph
         if prefs[KEY.EMPTY_PARA] == 'merge':
-            text = regex.loop(r'(?:<p(| [^>]*)>'+NBSP+r'</p>\s*){2,}', r'<p\1>'+NBSP+r'</p>', text)
+            text_rules.append((r'(?:<p(| [^>]*)>'+NBSP+r'</p>\s*){2,}', r'<p\1>'+NBSP+r'</p>'))
         elif prefs[KEY.EMPTY_PARA] == 'del':
-            text = regex.loop(r'<p(| [^>]*)>'+NBSP+r'</p>', r'', text)
+            text_rules.append((r'<p(| [^>]*)>'+NBSP+r'</p>', r''))
         
         # Delete <img>
         if prefs[KEY.IMG_TAG] == 'del':
-            text = regex.loop(r'\s*<img(| [^>]*)>\s*', r' ', text)
-            text = regex.loop(r'\s*<(p|li|div)(| [^>]*)> </\1>\s*', r'', text)
+            text_rules.append((r'\s*<img(| [^>]*)>\s*', r' '))
+            text_rules.append((r'\s*<(p|li|div)(| [^>]*)> </\1>\s*', r''))
         
-        if prefs[KEY.DEL_FORMATTING]:
-            # Remove Formatting
-            text = calibre_remove_format(text)
-            
-        else:
-            # ID and CLASS attributs
-            if 'id' in prefs[KEY.ID_CLASS]:
-                text = regex.loop(r' id="[^"]*"', r'', text)
-            if 'class' in prefs[KEY.ID_CLASS]:
-                text = regex.loop(r' class="[^"]*"', r'', text)
-            
-            # Headings
-            if prefs[KEY.HEADINGS] == 'bolder':
-                text = regex.loop(r'<(h\d)([^>]*) style="((?:(?!font-weight)[^"])*)"([^>]*)>', r'<\1\2 style="\3; font-weight: bold"\4>', text)
-                text = regex.loop(r'<(h\d)((?:(?! style=)[^>])*)>', r'<\1\2 style="font-weight: bold;">', text)
-            if prefs[KEY.HEADINGS] == 'conv' or prefs[KEY.HEADINGS] == 'bolder':
-                text = regex.loop(r'<(/?)h\d(| [^>]*)>', r'<\1p\2>', text)
-            # remove explicit weight formatting in headings
-            text = regex.loop(r'<(h\d)([^>]*) style="([^"]*)font-weight: [\w\d]+([^"]*)"([^>]*)>', r'<\1\2 style="\3\4"\5>', text)
+        self.text_rules = rules(*text_rules)
+        
+        self.del_formatting = prefs[KEY.DEL_FORMATTING]
+        
+        format_rules = []
+        # ID and CLASS attributs
+        if 'id' in prefs[KEY.ID_CLASS]:
+            format_rules.append((r' id="[^"]*"', r''))
+        if 'class' in prefs[KEY.ID_CLASS]:
+            format_rules.append((r' class="[^"]*"', r''))
+        
+        # Headings
+        if prefs[KEY.HEADINGS] == 'bolder':
+            format_rules.append((r'<(h\d)([^>]*) style="((?:(?!font-weight)[^"])*)"([^>]*)>', r'<\1\2 style="\3; font-weight: bold"\4>'))
+            format_rules.append((r'<(h\d)((?:(?! style=)[^>])*)>', r'<\1\2 style="font-weight: bold;">'))
+        if prefs[KEY.HEADINGS] == 'conv' or prefs[KEY.HEADINGS] == 'bolder':
+            format_rules.append((r'<(/?)h\d(| [^>]*)>', r'<\1p\2>'))
+        
+        self.format_rules = rules(*format_rules) + (HEADINGS_WEIGHT,)
+        
+        # Hyperlink
+        if prefs[KEY.KEEP_URL] == 'del':
+            self.format_rules += rules((r'<a(?:| [^>]*)>(.*?)</a>', r'\1'))
+        
+        # set align
+        if prefs[KEY.FORCE_JUSTIFY] == 'del':
+            # del align
+            self.align_rules = rules((r' align="[^"]*"', r''))
+        else:  # empty / all / none
+            self.align_rules = (ALIGN_LEFT,) + ALIGN_RULES
+            if prefs[KEY.FORCE_JUSTIFY] == 'empty':
+                self.align_rules += rules((r' align="left"', r' align="justify"'))
+            elif prefs[KEY.FORCE_JUSTIFY] == 'all':
+                self.align_rules += rules((r' align="(left|center|right)"', r' align="justify"'))
+        self.align_rules += ALIGN_END_RULES
+        
+        # CSS declarations to keep, by name with there order, None for all
+        self.css_keep = None
+        if prefs[KEY.CSS_KEEP_ACTIVE]:
+            keep = css_clean_rules(CSS_DEFAULT +' '+ prefs[KEY.CSS_KEEP]).split(' ')
+            self.css_keep = {name:idx for idx,name in enumerate(keep)}
+        
+        self.round_weight = prefs[KEY.FONT_WEIGHT] == 'trunc' or prefs[KEY.FONT_WEIGHT] == 'bold'
+        self.bold_weight = prefs[KEY.FONT_WEIGHT] == 'bold'
+        self.del_weight = prefs[KEY.FONT_WEIGHT] == 'del'
+        self.del_italic = prefs[KEY.DEL_ITALIC]
+        self.del_under = prefs[KEY.DEL_UNDER]
+        self.del_strike = prefs[KEY.DEL_STRIKE]
+        
+        # the tags of the removed formatting
+        self.style_end_rules = ()
+        if self.del_weight:
+            self.style_end_rules += (WEIGHT_DEL_TAG,)
+        if self.del_italic:
+            self.style_end_rules += (ITALIC_DEL_TAG,)
+        if self.del_under:
+            self.style_end_rules += (UNDERLINE_DEL_TAG,)
+        if self.del_strike:
+            self.style_end_rules += (STRIKE_DEL_TAG,)
+        self.style_end_rules += DECORATION_RULES
+        
+        # clean the bold if all paragraphes are it
+        full_check = []
+        if prefs[KEY.FULL_BOLD]:
+            full_check.append('font-weight')
+        if prefs[KEY.FULL_ITALIC]:
+            full_check.append('font-style')
+        
+        self.full_check = []
+        for check in full_check:
+            # first check for p and li
+            # then check only p
+            for m in ['p|li', 'p']:
+                self.full_check.append((
+                    re.compile(rf'<({m})(| [^>]*)>', FLAGS),
+                    re.compile(rf'<({m})(| [^>]*){check}:([^>]*)>', FLAGS),
+                    Rule(rf'<({m})(| [^>]*){check}:[^;]*;([^>]*)>', r'<\1\2\3>'),
+                ))
+        
+        self.end_rules = ()
+        # del align for list <li>
+        if prefs[KEY.LIST_ALIGN] == 'del':
+            self.end_rules = rules((r'<(ol|ul|li)([^>]*) align="[^"]*"', r'<\1\2'))
+        
+        # the tags of a text already clean, see is_clean()
+        # only for the built-in formatter, the result of the Calibre comments editor is not known
+        self.known_tags = None
+        if prefs[KEY.FORMATTER] != 'calibre' and not self.del_formatting and not self.passe_markdown:
+            style = r'(?: style="[^"]*")?'
+            align_p = {
+                'all': r' align="justify"',
+                'empty': r' align="(?:justify|center|right)"',
+                'none': r'(?: align="(?:justify|center|right)")?',
+                'del': r'',
+            }[prefs[KEY.FORCE_JUSTIFY]]
+            align_h = r'' if prefs[KEY.FORCE_JUSTIFY] in ('all', 'del') else r'(?: align="(?:center|right)")?'
             
-            # Hyperlink
-            if prefs[KEY.KEEP_URL] == 'del':
-                text = regex.loop(r'<a(?:| [^>]*)>(.*?)</a>', r'\1', text)
+            inline = ['sup', 'sub', *[tag for tag, deleted in [
+                ('strong', self.del_weight), ('em', self.del_italic), ('u', self.del_under), ('s', self.del_strike),
+            ] if not deleted]]
+            tags = [
+                r'</(?:p|h[1-6]|ul|ol|li|em|strong|sup|sub|u|s|span|a)>',
+                r'<br>',
+                r'<p'+align_p+style+r'>',
+                r'<(?:'+'|'.join(inline)+r')'+style+r'>',
+                r'<span style="[^"]*">',
+            ]
+            if prefs[KEY.HEADINGS] == 'none':
+                tags.append(r'<h[1-6]'+align_h+style+r'>')
+            if prefs[KEY.LIST_ALIGN] == 'del':
+                tags.append(r'<(?:ul|ol)>')
+                tags.append(r'<li'+style+r'>')
+            if prefs[KEY.KEEP_URL] == 'keep':
+                tags.append(r'<a href="[^"]*">')
+            if prefs[KEY.IMG_TAG] == 'keep':
+                tags.append(r'<img src="[^"]*"(?: width="[^"]*")?(?: height="[^"]*")?>')
+            self.known_tags = re.compile('|'.join(tags), FLAGS)
+    
+    def counters(self) -> Dict[str, int]:
+        '''
+        the counters of the cleaning, returned by the worker processes of clean_batch()
+        the prefilter_errors are not in, the validation is never done in parallel
+        '''
+        return {name:getattr(self, name) for name in COUNTERS}
+    
+    def add_counters(self, counters: Dict[str, int]):
+        '''
+        add the counters of a other Cleaner, see counters()
+        '''
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+    
+    def __call__(self, text: str) -> str:
+        if self.prefilter and self.is_clean(text):
+            self.prefiltered += 1
+            if self.prefilter != 'validate':
+                return text
+            rslt = self.clean_budget(text)
+            if rslt != text:
+                self.prefilter_errors.append(text)
+            return rslt
+        
+        rslt = self.clean_budget(text)
+        if self.prefilter == 'validate' and rslt == text:
+            self.prefilter_missed += 1
+        return rslt
+    
+    def clean_budget(self, text: str) -> str:
+        if not self.time_budget:
+            return self.clean_comment(text)
+        
+        _budget.budget = self.time_budget
+        _budget.deadline = time.perf_counter() + self.time_budget
+        try:
+            return self.clean_comment(text)
+        finally:
+            _budget.deadline = None
+    
+    def is_clean(self, text: str) -> bool:
+        '''
+        True if the cleaning would return the text unchanged, without the cleaning:
+        a comment already cleaned with the same prefs, only the most common shape
+        of the result is recognized, the others return False
+        
+        the text must be normalized, like for the cleaning
+        '''
+        if not self.known_tags or not text.startswith('<div>\n<') or not text.endswith('</div>'):
+            return False
+        body = text[5:-6]
+        
+        # the empty paragraphs are checked apart
+        if NBSP+'</p>' in body:
+            if self.prefs[KEY.EMPTY_PARA] == 'del' or EMPTY_PARA_NOT_CLEAN.search(body):
+                return False
+            body = EMPTY_PARA.sub('', body)
+        
+        if NOT_CLEAN.search(body):
+            return False
+        
+        # only the known tags, with the attributs in order
+        rest = self.known_tags.sub('', body)
+        if '<' in rest or '>' in rest:
+            return False
+        
+        # a single block is cleaned by FORMAT_RULES (full bold, full heading)
+        if body.count('\n') == 1 and (body.startswith('\n<h') or 'font-weight' in body
+                                        or '><' in body.split('</', 1)[0]):
+            return False
+        
+        # the style attributs already cleaned
+        if ' style="' in body:
+            if apply_rules(FINAL_RULES, self.clean_css(body)) != body:
+                return False
+            for para, check, rule in self.full_check:
+                if len(para.findall(body)) == len(check.findall(body)):
+                    return False
+        
+        # the final formatting, like at the end of clean_comment()
+        rslt = self.format(text)
+        if self.full_check:
+            rslt = standard_style(rslt)
+        return apply_rules(self.end_rules, rslt) == text
+    
+    # main function
+    def clean_comment(self, text: str) -> str:
+        
+        text = NEWLINES(text)
+        
+        text = clean_caps_tags(text)
+        
+        # if plain text (no tag)
+        if not HAS_TAG.search(text):
+            text = self.convert_plain(text)
+        
+        # if basic html text
+        # html without <p> or <div> (qt style)
+        if HAS_TAG.search(text) and not HAS_PARA.search(text):
+            text = BASIC_HTML_BR(text)
+            text = self.convert_plain(text)
+        
+        # double passe
+        # Empirical tests have shown that it was necessary for some very rare and specific cases.
+        # The second passe is skipped if the first one reached a fixpoint (text unchanged),
+        # it would do exactly the same.
+        for passe in range(2):
             
-            text = clean_basic(text)
-            text = standard_style(text)
+            text_passe = text
             
-            text = clean_align(text, prefs)
+            text = self.clean_basic(text)
             
-            text = clean_style(text, prefs)
+            # If <div> is not the racine tag
+            if not ROOT_DIV.search(text):
+                text = '<div>'+text+'</div>'
             
-            # Del <sup>/<sub> paragraphe
-            text = regex.loop(r'<(p|h\d)(| [^>]*)>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\3>\s*</\1>', r'<\1\2>\4</\1>', text)
-            text = regex.loop(r'<(p|h\d)(| [^>]*)>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\3>\s*<br>\s*<su(p|b)>((?:(?:<br>)|[^<>])*?)</su\5>\s*</\1>', r'<\1\2>\4<br>\6</\1>', text)
+            text = apply_rules(PASSE_RULES, text)
             
-            # <br> in same tag
-            text = regex.loop(r'<((\w+)(?:| [^>]*))>((?:(?:<br>)|[^<>])*?)</\2><br><\1>', r'<\1>\3<br>', text)
+            # Markdown
+            if self.passe_markdown and passe == 0:
+                text_markdown = clean_markdown(text)
+                if text_markdown != text:
+                    # not the same steps for the second passe
+                    text_passe = None
+                text = text_markdown
             
-            # del attibuts for <div> with <p>
-            text = regex.loop(r'<div[^>]+>\s*<(p|h\d)', r'<div>\n<\1', text)
+            text = apply_block_rules(self.block_rules, text)
+            text = apply_rules(self.text_rules, text)
             
-            # clean text full heading
-            text = regex.loop(r'^\s*<div>\s*<h(\d)(| [^>]*)>((?:(?:<br>)|[^<>])*?)</h\1>\s*</div>\s*$', r'<div><p\2>\3</p></div>', text)
+            if self.del_formatting:
+                # Remove Formatting
+                text = self.remove_format(text)
             
-            # clean text full bold
-            text = regex.loop(r'^\s*<div>\s*<p([^>]*?)font-weight:\s*\d+([^>]*?)>((?:(?:<br>)|[^<>])*?)</p>\s*</div>\s*$', r'<div><p\1\2>\3</p></div>', text)
+            else:
+                text = apply_rules(self.format_rules, text)
+                
+                text = self.clean_basic(text)
+                text = standard_style(text)
+                
+                text = self.clean_align(text)
+                
+                text = self.clean_style(text)
+                
+                text = apply_block_rules(FORMAT_BLOCK_RULES, text)
+                text = apply_rules(FORMAT_RULES, text)
             
-            text = regex.loop(r'^\s*<div>\s*<p([^>]*?)><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong></p>\s*</div>\s*$', r'<div><p\1><span\2>\3</span></p></div>', text)
-            text = regex.loop(r'^\s*<div>\s*<p([^>]*?)><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong><br><strong([^>]*?)>((?:(?:<br>)|[^<>])*?)</strong></p>\s*</div>\s*$', r'<div><p\1><span\2>\3</span><br><span\4>\5</span></p></div>', text)
+            text = self.clean_basic(text)
             
-            text = regex.loop(r'^\s*<div>\s*<p([^>]*?)><(\w+)([^>]*?)font-weight:\s*\d+([^>]*?)>((?:(?:<br>)|[^<>])*?)</\2></p>\s*</div>\s*$',
-                r'<div><p\1><\2\3\4>\5</\2></p></div>', text)
-            text = regex.loop(r'^\s*<div>\s*<p([^>]*?)font-weight:\s*\d+([^>]*?)><(\w+)([^>]*?)>((?:(?:<br>)|[^<>])*?)</\3></p>\s*</div>\s*$',
-                r'<div><p\1\2><\3\4>\5</\3></p></div>', text)
+            if passe == 0:
+                if text == text_passe:
+                    break
+                self.second_passes += 1
+            elif text != text_passe:
+                self.second_changes += 1
         
-        text = clean_basic(text)
-    
-    # fix weight
-    if CALIBRE_VERSIONS_BOLD:
-        text = regex.loop(r' style="([^"]*)'+FONT_WEIGHT+r'([^"]*)"', r' style="\1font-weight: bold\2"', text)
-    
-    text = regex.loop(r'<p( [^>]*)style="[^"]*"([^>]*)>'+NBSP+r'</p>', r'<p\1\2>'+NBSP+r'</p>', text)
-    
-    text = calibre_format(text)
-    
-    # clean the bold if all paragraphes are it
-    full_check = []
-    if prefs[KEY.FULL_BOLD]:
-        full_check.append('font-weight')
-    if prefs[KEY.FULL_ITALIC]:
-        full_check.append('font-style')
-    
-    if full_check:
-        edited = False
-        text = standard_style(text)
-        for check in full_check:
-            # first check for p and li
-            # then check only p
-            for m in ['p|li', 'p']:
-                lst_para = tuple(regex.searchall(rf'<({m})(| [^>]*)>', text))
-                lst_bold = tuple(regex.searchall(rf'<({m})(| [^>]*){check}:([^>]*)>', text))
-                if len(lst_para) == len(lst_bold):
-                    text = regex.loop(rf'<({m})(| [^>]*){check}:[^;]*;([^>]*)>', r'<\1\2\3>', text)
+        text = apply_rules(FINAL_RULES, text)
+        
+        text = self.format(text)
+        
+        # clean the bold if all paragraphes are it
+        if self.full_check:
+            edited = False
+            text = standard_style(text)
+            for para, check, rule in self.full_check:
+                if len(para.findall(text)) == len(check.findall(text)):
+                    text = rule(text)
                     edited = True
+            
+            if edited:
+                text = self.clean_basic(text)
+                text = self.format(text)
         
-        if edited:
-            text = clean_basic(text)
-            text = calibre_format(text)
-    
-    # del align for list <li>
-    if prefs[KEY.LIST_ALIGN] == 'del':
-        text = regex.loop(r'<(ol|ul|li)([^>]*) align="[^"]*"', r'<\1\2', text)
-    
-    return text
-
-
-def clean_align(text: str, prefs: Optional[dict]=None) -> str:
-    prefs = _set_prefs(prefs)
+        text = apply_rules(self.end_rules, text)
+        
+        return text
     
-    text = ordered_attributs(text)
+    # Cleannig based on Calibre 4 and above (QtWebEngine)
+    def clean_basic(self, text: str) -> str:
+        
+        text = self.basic_step(XMLformat, text)
+        
+        text = self.basic_step(self.clean_tags, text)
+        
+        text = self.basic_step(BASIC_BR_INLINE_RULES, text)
+        
+        text = self.basic_step(clean_inline, text)
+        
+        text = self.basic_step(BASIC_RULES, text)
+        
+        return self.basic_step(XMLformat, text)
     
-    # set align
-    if prefs[KEY.FORCE_JUSTIFY] == 'del':
-        # del align
-        text = regex.loop(r' align="[^"]*"', r'', text)
+    def basic_step(self, step: Union[Callable[[str], str], Tuple[Rule, ...]], text: str) -> str:
+        '''
+        apply a step of clean_basic(), a function or rules
         
-    else:  # empty / all / none
+        clean_basic() is called many times by comment, mostly on a text that the steps
+        between have not changed: a step is skipped if it has already left this text unchanged
+        '''
+        if self.basic_fixpoints.get(step) == text:
+            return text
         
-        # insert align left for all
-        text = regex.simple(r'<(p|div|li|h1|h2|h3|h4|h5|h6)', r'<\1 align="left"', text)
+        if isinstance(step, tuple):
+            rslt = apply_rules(step, text)
+        else:
+            rslt = step(text)
+        if rslt == text:
+            self.basic_fixpoints[step] = text
+        return rslt
+    
+    def clean_align(self, text: str) -> str:
+        text = ordered_attributs(text)
+        return apply_rules(self.align_rules, text)
+    
+    def clean_style(self, text: str) -> str:
+        text = self.clean_css(text)
+        return apply_rules(self.style_end_rules, text)
+    
+    def _clean_style_attribut(self, m: re.Match) -> str:
+        '''
+        parse the declarations of a style attribut, filter and clean them, and write them back
+        '''
+        declarations = []
+        for declaration in CSS_SEPARATOR.split(m.group(1)):
+            d = CSS_DECLARATION.fullmatch(declaration)
+            if not d:
+                continue
+            name, value = d.groups()
+            if self.css_keep is not None and name not in self.css_keep:
+                continue
+            value = self.clean_declaration(name, value)
+            if value is not None:
+                declarations.append((name, value))
         
-        # delete align left if another exist
-        text = regex.loop(r'<(p|div|li|h1|h2|h3|h4|h5|h6) align="left"( align="[^"]*")', r'<\1\2', text)
+        if self.css_keep:
+            declarations.sort(key=lambda d: self.css_keep[d[0]])
+        return ' style="'+''.join(' '+name+': '+value+';' for name,value in declarations)+'"'
+    
+    def clean_declaration(self, name: str, value: str) -> Optional[str]:
+        '''
+        the value of a CSS declaration, None to remove it
+        '''
+        if name == 'font-weight':
+            return self.clean_weight(value)
         
-        # swap text-align to align
-        text = regex.loop(r' align="[^"]*"([^>]*) style="([^"]*) text-align:\s*([^;]*)\s*;([^"]*)"', r' align="\3"\1 style="\2\4"', text)
+        if name == 'font-style':
+            if self.del_italic or not value.startswith(('oblique', 'italic')):
+                return None
+            if ITALIC_OBLIQUE.fullmatch(value):
+                return 'italic'
+            return value
         
-        # clean space in attribut
-        text = regex.loop(r' align="\s+([^"]*)"', r' align="\1"', text)
-        text = regex.loop(r' align="([^"]*)\s+"', r' align="\1"', text)
+        if name == 'text-decoration':
+            value = loop(DECORATION_CLEAN, '', ' '+value)
+            if self.del_under:
+                value = UNDERLINE_DEL.sub('', value)
+            if self.del_strike:
+                value = STRIKE_DEL.sub('', value)
+            return value.strip() or None
         
-        # align valide value
-        text = regex.loop(r' align="justify-all"', r' align="justify"', text)
-        text = regex.loop(r' align="(?!left|justify|center|right)[^"]*"', r' align="left"', text)
+        return value
+    
+    def clean_weight(self, value: str) -> Optional[str]:
+        '''
+        bold, bolder or a number, rounded to the hundred (trunc/bold)
+        and only the bold kept (bold)
+        '''
+        if self.del_weight or not value.startswith(('bold', *'0123456789')):
+            return None
         
-        # apply cascading heritage for list
-        text = regex.loop(r'<(ol|ul) align="left"', r'<\1', text)
-        text = regex.loop(r'<(ol|ul) align="([^"]*)"([^>]*)>((?:(?!</\1>).)*)<li align="left"', r'<\1 align="\2"\3>\4<li align="\2"', text)
-        text = regex.loop(r'<(ol|ul) align="([^"]*)"', r'<\1', text)
+        if value == 'bold' or value == 'bolder':
+            value = FONT_WEIGHT_BOLD
+        m = WEIGHT_NUMBER.fullmatch(value)
+        if m:
+            digits = m.group(1)
+            if len(digits) > 3:
+                value = '900'
+            elif len(digits) < 3:
+                value = '100'
+            else:
+                value = digits
         
-        # set align
-        if prefs[KEY.FORCE_JUSTIFY] == 'empty':
-            text = regex.loop(r' align="left"', r' align="justify"', text)
-        elif prefs[KEY.FORCE_JUSTIFY] == 'all':
-            text = regex.loop(r' align="(left|center|right)"', r' align="justify"', text)
-    
-    # del text-align
-    text = regex.loop(r' style="([^"]*) text-align:([^;]*);([^"]*)"', r' style="\1\3"', text)
-    
-    # del justify for <h1>
-    text = regex.loop(r'<(h\d) align="justify"', r'<\1', text)
+        if len(value) != 3 or not value.isdigit():
+            return value
+        
+        if self.round_weight:
+            # 650 is rounded to 700, like 651
+            weight = int(value)
+            if weight % 10 == 0:
+                weight += 1
+            value = str(round(weight, -2))
+        
+        if self.bold_weight and len(value) == 3:
+            if value[0] in '6789':
+                return FONT_WEIGHT_BOLD
+            return None
+        return value
     
-    # del text-align left (default value)
-    text = regex.loop(r' align="left"', r'', text)
+    def convert_plain(self, text: str) -> str:
+        
+        text = PLAIN_DASH(text)
+        # Markdown
+        if self.plain_markdown:
+            text = apply_rules(PLAIN_MARKDOWN_RULES, text)
+            text = self.markdown(text)
+            text = apply_rules(PLAIN_MARKDOWN_END_RULES, text)
+        
+        text = PLAIN_BR(text)
+        text = PLAIN_DIV(text)
+        text = apply_rules(PLAIN_RULES, text)
+        
+        return self.format(text)
+
+
+def clean_comment(text: str, prefs: Optional[dict]=None) -> str:
+    return Cleaner(prefs)(text)
+
+
+def clean_batch(prefs: dict, items: List[Tuple[tuple, str]], time_budget: Optional[float]=None,
+                prefilter: Optional[str]=None) -> Tuple[List[Tuple[tuple, str, Optional[str]]], Dict[str, int]]:
+    '''
+    clean a batch of (key, comment)
+    return a list of (key, comment normalized, comment cleaned), and the Cleaner.counters()
+    the comment cleaned is None if it exceeded the time budget
     
-    return text
+    entry point of the worker processes of the parallel cleaning
+    '''
+    cleaner = Cleaner(prefs, time_budget=time_budget, prefilter=prefilter)
+    rslt = []
+    for key, comment in items:
+        comment_norm = normalize_comment(comment)
+        try:
+            comment_out = cleaner(comment_norm)
+        except CommentTimeout:
+            comment_out = None
+        rslt.append((key, comment_norm, comment_out))
+    return rslt, cleaner.counters()
+
+
+def clean_basic(text: str, prefs: Optional[dict]=None) -> str:
+    return Cleaner(prefs).clean_basic(text)
+
+
+def clean_align(text: str, prefs: Optional[dict]=None) -> str:
+    return Cleaner(prefs).clean_align(text)
 
 
 def clean_style(text: str, prefs: Optional[dict]=None) -> str:
-    prefs = _set_prefs(prefs)
-    
-    text = ordered_attributs(text)
-    
-    text = regex.loop(r' x-style="[^"]*"', r'', text)
-    text = text.replace(' style="', ' x-style="" style=" ')
-    
-    if prefs[KEY.CSS_KEEP_ACTIVE]:
-        for rule in css_clean_rules(CSS_DEFAULT +' '+ prefs[KEY.CSS_KEEP]).split(' '):
-            text = regex.loop(r' x-style="([^"]*)" style="([^"]*) '+rule+r'\s*:\s*([^;]*?)\s*;([^"]*)"', r' x-style="\1 '+rule+r': \3;" style="\2 \4"', text)
-    else:
-        text = regex.loop(r' x-style="([^"]*)" style="([^"]*) ([\w\-]+?)\s*:\s*([^;]*?)\s*;([^"]*)"', r' x-style="\1 \3: \4;" style="\2 \5"', text)
-    
-    text = regex.loop(r' x-style="([^"]*)" style="[^"]*"', r' style="\1"', text)
-    text = regex.loop(r' x-style="[^"]*"', r'', text)
-    
-    # font-weight
-    text = regex.loop(r' style="([^"]*) font-weight: (?!bold|bolder|\d+)[^;]*;([^"]*)"', r' style="\1\2"', text)
-    text = regex.loop(r' style="([^"]*) font-weight: (bold|bolder);([^"]*)"', r' style="\1 '+FONT_WEIGHT+r';\3"', text)
-    text = regex.loop(r' style="([^"]*) font-weight: (\d{4,})(?:\.\d+)?;([^"]*)"', r' style="\1 font-weight: 900;\3"', text)
-    text = regex.loop(r' style="([^"]*) font-weight: (\d{1,2})(?:\.\d+)?;([^"]*)"', r' style="\1 font-weight: 100;\3"', text)
-    text = regex.simple(r' style="([^"]*) font-weight: (\d{3})(?:\.\d+)?;([^"]*)"', r' style="\1 font-weight: \2;\3"', text)
-    
-    if prefs[KEY.FONT_WEIGHT] == 'trunc' or prefs[KEY.FONT_WEIGHT] == 'bold':
-        
-        text = regex.loop(r' style="([^"]*) font-weight: (?P<name>\d\d)0;([^"]*)"', r' style="\1 font-weight: \g<name>1;\3"', text)
-        regx = r' style="([^"]*) font-weight: (?P<name>\d\d[1-9]);([^"]*)"'
-        while regex.search(regx, text):
-            
-            m = regex.search(regx, text)
-            d = m.group('name')
-            rpl = regex.loop(regx, r' style="\1 font-weight: '+str(int(round(int(d),-2)))+r';\3"', m.group(0))
-            text = text.replace(m.group(0), rpl)
-    
-    if prefs[KEY.FONT_WEIGHT] == 'bold':
-        text = regex.loop(r' style="([^"]*) font-weight: [6-9]\d\d;([^"]*)"', r' style="\1 font-weight: xxx;\2"', text)
-        text = regex.loop(r' style="([^"]*) font-weight: [1-5]\d\d;([^"]*)"', r' style="\1\2"', text)
-        text = regex.loop(r' style="([^"]*) font-weight: xxx;([^"]*)"', r' style="\1 '+FONT_WEIGHT+r';\2"', text)
-        
-    elif prefs[KEY.FONT_WEIGHT] == 'del':
-        text = regex.loop(r'<(/?)strong(| [^>]*)>', r'<\1span\2>', text)
-        text = regex.loop(r' style="([^"]*) font-weight:[^;]*;([^"]*)"', r' style="\1\2"', text)
-    
-    # font-style
-    text = regex.loop(r' style="([^"]*) font-style: (?!oblique|italic)[^;]*;([^"]*)"', r' style="\1\2"', text)
-    if prefs[KEY.DEL_ITALIC]:
-        text = regex.loop(r'<(/?)em(| [^>]*)>', r'<\1span\2>', text)
-        text = regex.loop(r' style="([^"]*) font-style:[^;]*;([^"]*)"', r' style="\1\2"', text)
-    else:
-        text = regex.loop(r' style="([^"]*) font-style: (oblique(?:\s+\d+deg)?);([^"]*)"', r' style="\1 font-style: italic;\3"', text)
-    
-    # text-decoration
-    text = regex.loop(r' style="([^"]* text-decoration:[^;]*) (?:none|blink|overline|inherit|initial|unset)([^;]*;[^"]*)"', r' style="\1\2"', text)
-    
-    if prefs[KEY.DEL_UNDER]:
-        text = regex.loop(r'<(/?)u(| [^>]*)>', r'<\1span\2>', text)
-        text = regex.loop(r' style="([^"]* text-decoration:[^;]*) underline([^;]*;[^"]*)"', r' style="\1\2"', text)
-    if prefs[KEY.DEL_STRIKE]:
-        text = regex.loop(r'<(/?)s(| [^>]*)>', r'<\1span\2>', text)
-        text = regex.loop(r' style="([^"]* text-decoration:[^;]*) line-through([^;]*;[^"]*)"', r' style="\1\2"', text)
-    
-    text = regex.loop(r'<(p|h\d)(| [^>]*)( style="[^"]* text-decoration:[^;]*) underline([^;]*;[^"]*"[^>]*)>(.*?)</\1>',    r'<\1\2\3\4><u>\5</u></\1>', text)
-    text = regex.loop(r'<(p|h\d)(| [^>]*)( style="[^"]* text-decoration:[^;]*) line-through([^;]*;[^"]*"[^>]*)>(.*?)</\1>', r'<\1\2\3\4><s>\5</s></\1>', text)
-    
-    text = regex.loop(r' style="([^"]*) text-decoration:\s*;([^"]*)"', r' style="\1\2"', text)
-    
-    return text
+    return Cleaner(prefs).clean_style(text)
 
 
 def convert_plain(text: str, prefs: Optional[dict]=None) -> str:
-    prefs = _set_prefs(prefs)
-    
-    # Convert two hyphens to emdash
-    text = text.replace('--', '—')
-    # Markdown
-    if prefs[KEY.MARKDOWN] == 'try':
-        text = regex.loop(r'^(\d{4})(\.|:)', r'\1\0\2', text)
-        text = regex.loop(r'\n(\d{4})(\.|:)', r'\n\1\0\2', text)
-        text = markdown(text)
-        text = regex.loop(r'\0', r'', text)
-        text = regex.loop(r'>\n+<', '><', text)
-        text = regex.loop(r'<br(| [^>]*)/?>\s+', r'<br>', text)
-        text = regex.loop(r'\s+<br(| [^>]*)/?>', r'<br>', text)
-    
-    text = regex.loop(r'<br(| [^>]*)/?>', r'\n', text)
-    text = '<div><p>' + regex.loop(r'\n{2,}', r'</p><p>', text) + '</p></div>'
-    text = regex.loop(r'<p>\s*<p>', r'<p>', text)
-    text = regex.loop(r'</p>\s*</p>', r'</p>', text)
-    text = regex.loop(r'\n', r'<br>', text)
-    text = regex.loop(r'(<p>|<br>)\s+', r'\1', text)
-    text = regex.loop(r'\s+(<p>|<br>)', r'\1', text)
-    
-    return calibre_format(text)
+    return Cleaner(prefs).convert_plain(text)
 
 
-# Try to convert Markdown to HTML
-def clean_markdown(text: str) -> str:  # key word: TRY!
+MARKDOWN_RULES = rules(
     # image
-    text = regex.loop(r'!\[((?:(?!<br>|</p>).)*?)\]\(((?:(?!<br>|</p>).)*?)\)', r'<img alt"\1" src="\2">', text)
+    (r'!\[((?:(?!<br>|</p>).)*?)\]\(((?:(?!<br>|</p>).)*?)\)', r'<img alt"\1" src="\2">'),
     # hyperlink
-    text = regex.loop(r'\[((?:(?!<br>|</p>).)*?)\]\(((?:(?!<br>|</p>).)*?)\)', r'<a href="\2">\1</a>', text)
+    (r'\[((?:(?!<br>|</p>).)*?)\]\(((?:(?!<br>|</p>).)*?)\)', r'<a href="\2">\1</a>'),
     
     # heading 1, 2
-    for h, n in [('=', '1'),('-', '2')]:
-        text = regex.loop(r'(<br>|</p><p>)(.*?)(<br>)'+h+r'{2,}(<br>|</p><p>)', r'</p><h'+n+r'>\2</h'+n+r'><p>', text)
-        text = regex.loop(r'(<br>|</p><p>)(.*?)(<br>)'+h+r'{2,}(</p>)'        , r'</p><h'+n+r'>\2</h'+n+r'>'   , text)
-        text = regex.loop(         r'(<p>)(.*?)(<br>)'+h+r'{2,}(<br>|</p><p>)',     r'<h'+n+r'>\2</h'+n+r'><p>', text)
-        text = regex.loop(         r'(<p>)(.*?)(<br>)'+h+r'{2,}(</p>)'        ,     r'<h'+n+r'>\2</h'+n+r'>'   , text)
+    *[rule for h, n in [('=', '1'),('-', '2')] for rule in [
+        (r'(<br>|</p><p>)((?:(?!<br>|</?p>).)*?)(<br>)'+h+r'{2,}(<br>|</p><p>)', r'</p><h'+n+r'>\2</h'+n+r'><p>'),
+        (r'(<br>|</p><p>)((?:(?!<br>|</?p>).)*?)(<br>)'+h+r'{2,}(</p>)'        , r'</p><h'+n+r'>\2</h'+n+r'>'),
+        (         r'(<p>)((?:(?!<br>|</?p>).)*?)(<br>)'+h+r'{2,}(<br>|</p><p>)',     r'<h'+n+r'>\2</h'+n+r'><p>'),
+        (         r'(<p>)((?:(?!<br>|</?p>).)*?)(<br>)'+h+r'{2,}(</p>)'        ,     r'<h'+n+r'>\2</h'+n+r'>'),
+    ]],
     
     # heading
-    for h in range(1, 7):
-        h = str(h)
-        text = regex.loop(r'(<br>|</p><p>)#{'+h+r'}\s+(.*?)(<br>|</p><p>)', r'</p><h'+h+r'>\2</h'+h+r'><p>', text)
-        text = regex.loop(r'(<br>|</p><p>)#{'+h+r'}\s+(.*?)(</p>)'        , r'</p><h'+h+r'>\2</h'+h+r'>'   , text)
-        text = regex.loop(         r'(<p>)#{'+h+r'}\s+(.*?)(<br>|</p><p>)',     r'<h'+h+r'>\2</h'+h+r'><p>', text)
-        text = regex.loop(         r'(<p>)#{'+h+r'}\s+(.*?)(</p>)'        ,     r'<h'+h+r'>\2</h'+h+r'>',    text)
+    *[rule for h in map(str, range(1, 7)) for rule in [
+        (r'(<br>|</p><p>)#{'+h+r'}\s+(.*?)(<br>|</p><p>)', r'</p><h'+h+r'>\2</h'+h+r'><p>'),
+        (r'(<br>|</p><p>)#{'+h+r'}\s+(.*?)(</p>)'        , r'</p><h'+h+r'>\2</h'+h+r'>'),
+        (         r'(<p>)#{'+h+r'}\s+(.*?)(<br>|</p><p>)',     r'<h'+h+r'>\2</h'+h+r'><p>'),
+        (         r'(<p>)#{'+h+r'}\s+(.*?)(</p>)'        ,     r'<h'+h+r'>\2</h'+h+r'>'),
+    ]],
     
     # u liste
-    text = regex.loop(r'(<br>|</p><p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)', r'</p><ul><li>\2</li></ul><p>', text)
-    text = regex.loop(r'(<br>|</p><p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        , r'</p><ul><li>\2</li></ul>'   , text)
-    text = regex.loop(         r'(<p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)'    , r'<ul><li>\2</li></ul><p>', text)
-    text = regex.loop(         r'(<p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'            , r'<ul><li>\2</li></ul>'   , text)
-    text = regex.loop(r'</li></ul><ul><li>', r'</li><li>', text)
+    (r'(<br>|</p><p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)', r'</p><ul><li>\2</li></ul><p>'),
+    (r'(<br>|</p><p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        , r'</p><ul><li>\2</li></ul>'),
+    (         r'(<p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)'    , r'<ul><li>\2</li></ul><p>'),
+    (         r'(<p>)(?:\*|-)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'            , r'<ul><li>\2</li></ul>'),
+    (r'</li></ul><ul><li>', r'</li><li>'),
     
     # o liste
-    text = regex.loop(r'(<br>|</p><p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)', r'</p><ol><li>\2</li></ol><p>', text)
-    text = regex.loop(r'(<br>|</p><p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        , r'</p><ol><li>\2</li></ol>'   , text)
-    text = regex.loop(         r'(<p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)',     r'<ol><li>\2</li></ol><p>', text)
-    text = regex.loop(         r'(<p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        ,     r'<ol><li>\2</li></ol>'   , text)
-    text = regex.loop(r'</li></ol><ol><li>', r'</li><li>', text)
+    (r'(<br>|</p><p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)', r'</p><ol><li>\2</li></ol><p>'),
+    (r'(<br>|</p><p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        , r'</p><ol><li>\2</li></ol>'),
+    (         r'(<p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(<br>|</p><p>)',     r'<ol><li>\2</li></ol><p>'),
+    (         r'(<p>)\d{1,2}(?:\)|\.)\s+((?:(?!<br>|</p>|</li>).)*?)(</p>)'        ,     r'<ol><li>\2</li></ol>'),
+    (r'</li></ol><ol><li>', r'</li><li>'),
     
     # <hr>
-    text = regex.loop(r'(<br>|</p><p>)(?:(-|\*|_)\s*){3,}(<br>|</p><p>)', r'</p><hr><p>', text)
-    text = regex.loop(r'(<br>|</p><p>)(?:(-|\*|_)\s*){3,}(</p>)'        , r'</p><hr>'   , text)
-    text = regex.loop(         r'(<p>)(?:(-|\*|_)\s*){3,}(<br>|</p><p>)',     r'<hr><p>', text)
+    (r'(<br>|</p><p>)(?:(-|\*|_)\s*){3,}(<br>|</p><p>)', r'</p><hr><p>'),
+    (r'(<br>|</p><p>)(?:(-|\*|_)\s*){3,}(</p>)'        , r'</p><hr>'),
+    (         r'(<p>)(?:(-|\*|_)\s*){3,}(<br>|</p><p>)',     r'<hr><p>'),
     
     # bold
-    text = regex.loop(r'([^\\])((?:_|\*){2})((?:(?!<br>|</p>).)*?[^\\])\2', r'\1<strong>\3</strong>', text)
+    (r'([^\\])((?:_|\*){2})((?:(?!<br>|</p>).)*?[^\\])\2', r'\1<strong>\3</strong>'),
     # italic
-    text = regex.loop(r'([^\\])((?:_|\*){1})((?:(?!<br>|</p>).)*?[^\\])\2', r'\1<em>\3</em>', text)
+    (r'([^\\])((?:_|\*){1})((?:(?!<br>|</p>).)*?[^\\])\2', r'\1<em>\3</em>'),
     
     #
-    text = regex.loop(r'\\(_|\*)', r'\1', text)
-    
-    return text
+    (r'\\(_|\*)', r'\1'),
+)
+
+
+# Try to convert Markdown to HTML
+@Step
+def clean_markdown(text: str) -> str:  # key word: TRY!
+    return apply_rules(MARKDOWN_RULES, text)
@@ -9,11 +9,13 @@ try:
 except NameError:
     pass  # load_translations() added in calibre 1.9
 
-from collections import OrderedDict
 
 try:
     from qt.core import (
+        QAbstractItemView,
         QCheckBox,
+        QComboBox,
+        QDialogButtonBox,
         QFormLayout,
         QGridLayout,
         QGroupBox,
@@ -23,13 +25,20 @@ try:
         QPushButton,
         QScrollArea,
         QSizePolicy,
+        QSpinBox,
         Qt,
+        QTableWidget,
+        QTableWidgetItem,
+        QTextBrowser,
         QVBoxLayout,
         QWidget,
     )
 except ImportError:
     from PyQt5.Qt import (
+        QAbstractItemView,
         QCheckBox,
+        QComboBox,
+        QDialogButtonBox,
         QFormLayout,
         QGridLayout,
         QGroupBox,
@@ -39,168 +48,59 @@ except ImportError:
         QPushButton,
         QScrollArea,
         QSizePolicy,
+        QSpinBox,
         Qt,
+        QTableWidget,
+        QTableWidgetItem,
+        QTextBrowser,
         QVBoxLayout,
         QWidget,
     )
 
 from calibre.gui2.widgets2 import Dialog
 
-from .common_utils import CALIBRE_VERSION, GUI, PREFS_json, debug_print, get_icon, regex
+from .common_utils import CALIBRE_VERSION, GUI, PREFS_json, debug_print, get_icon
 from .common_utils.dialogs import KeyboardConfigDialogButton
 from .common_utils.widgets import ImageTitleLayout, KeyValueComboBox, SelectNotesWidget
+from .settings import (
+    CALIBRE_HAS_NOTES,
+    CSS_DEFAULT,
+    DOUBLE_BR,
+    EMPTY_PARA,
+    ENGINE,
+    FONT_WEIGHT,
+    FORCE_JUSTIFY,
+    FORMATTER,
+    HEADINGS,
+    ID_CLASS,
+    IMG_TAG,
+    KEEP_URL,
+    KEY,
+    LIST_ALIGN,
+    LOG_LEVEL,
+    MARKDOWN,
+    PREFILTER,
+    PROFILE,
+    SINGLE_BR,
+    _prefs_defaults,
+    css_clean_rules,
+    notes_settings,
+)
 
 PLUGIN_ICON = 'images/plugin.png'
 NOTES_ICON = 'images/notes.png'
 
 
-class KEY:
-    KEEP_URL = 'KeepUrl'
-    HEADINGS = 'Headings'
-    FONT_WEIGHT = 'FontWeight'
-    DEL_ITALIC = 'RemoveItalic'
-    DEL_UNDER = 'RemoveUnderline'
-    DEL_STRIKE = 'RemoveStrikethrough'
-    FORCE_JUSTIFY = 'ForceJustify'
-    LIST_ALIGN = 'ListAlign'
-    ID_CLASS = 'ID_Class'
-    FULL_BOLD = 'FullBold'
-    FULL_ITALIC = 'FullItalic'
-    CSS_KEEP_ACTIVE = 'CSStoKeepActive'
-    CSS_KEEP = 'CSStoKeep'
-    
-    DEL_FORMATTING = 'RemoveFormatting'
-    
-    MARKDOWN = 'Markdown'
-    DOUBLE_BR = 'DoubleBR'
-    SINGLE_BR = 'SingleBR'
-    EMPTY_PARA = 'EmptyParagraph'
-    IMG_TAG = 'ImgTag'
-    
-    CUSTOM_COLUMN = 'CustomColumn'
-    
-    NOTES_SETTINGS = 'NotesSettings'
-
-
-KEEP_URL = OrderedDict([
-                    ('keep', _('Keep URL')),
-                    ('del', _('Delete URL'))])
-
-HEADINGS = OrderedDict([
-                        ('conv', _('Converte to a paragraph')),
-                        ('bolder', _('Converte to a paragraph but keep the bold')),
-                        ('none', _('No change'))])
-
-FONT_WEIGHT = OrderedDict([
-                        ('trunc', _('Round the Weights value to the hundred')),
-                        ('bold', _("Round to Bold (value 'bold')")),
-                        ('none', _('Do not change the Weights')),
-                        ('del', _('Delete Weights'))])
-FONT_WEIGHT_ALT = _('Round to Bold (value 600)')
-
-FORCE_JUSTIFY = OrderedDict([
-                        ('all', _('Force the justification (replace "center" and "right")')),
-                        ('empty', _('Justification for indeterminate text (keep "center" and "right")')),
-                        ('none', _('No change')),
-                        ('del', _('Delete all alignment'))])
-
-LIST_ALIGN = OrderedDict([
-                    ('keep', _("Use the 'Justification' setting")),
-                    ('del', _('Delete the alignment in lists'))])
-
-ID_CLASS = OrderedDict([
-                        ('id', _('Delete "id" attribut')),
-                        ('class', _('Delete "class" attribut')),
-                        ('id_class', _('Delete "id" and "class" attribut')),
-                        ('none', _('No change'))])
-
-
-MARKDOWN = OrderedDict([
-                        ('always', _('Convert in all comments (not recomanded)')),
-                        ('try', _('Convert only from a plain text comment')),
-                        ('none', _('No change'))])
-
-DOUBLE_BR = OrderedDict([
-                        ('empty', _('Create a empty paragraph')),
-                        ('new', _('Create a new paragraph')),
-                        ('none', _('No change'))])
-
-SINGLE_BR = OrderedDict([
-                        ('para', _('Create a new paragraph')),
-                        ('space', _('Replace with space')),
-                        ('none', _('No change'))])
-
-EMPTY_PARA = OrderedDict([
-                        ('merge', _('Merge in a single empty paragraph')),
-                        ('none', _('No change')),
-                        ('del', _('Delete empty paragraph'))])
-
-IMG_TAG = OrderedDict([
-                    ('keep', _('Keep images')),
-                    ('del', _('Delete images'))])
-
-
-# Set defaults
-_defaults = {}
-_defaults[KEY.KEEP_URL] = 'keep'
-_defaults[KEY.HEADINGS] = 'none'
-_defaults[KEY.FONT_WEIGHT] = 'bold'
-_defaults[KEY.DEL_ITALIC] = False
-_defaults[KEY.DEL_UNDER] = False
-_defaults[KEY.DEL_STRIKE] = False
-_defaults[KEY.FULL_BOLD] = True
-_defaults[KEY.FULL_ITALIC] = False
-_defaults[KEY.FORCE_JUSTIFY] = 'empty'
-_defaults[KEY.LIST_ALIGN] = 'del'
-_defaults[KEY.ID_CLASS] = 'id_class'
-_defaults[KEY.CSS_KEEP_ACTIVE] = True
-_defaults[KEY.CSS_KEEP] = ''
-
-_defaults[KEY.DEL_FORMATTING] = False
-
-_defaults[KEY.MARKDOWN] = 'try'
-_defaults[KEY.DOUBLE_BR] = 'new'
-_defaults[KEY.SINGLE_BR] = 'none'
-_defaults[KEY.EMPTY_PARA] = 'merge'
-_defaults[KEY.IMG_TAG] = 'del'
-
 # This is where all preferences for this plugin are stored
 PREFS = PREFS_json()
-PREFS.defaults = _defaults.copy()
-PREFS.defaults[KEY.CUSTOM_COLUMN] = False
-PREFS.defaults[KEY.NOTES_SETTINGS] = _defaults.copy()
-PREFS.defaults[KEY.NOTES_SETTINGS][KEY.IMG_TAG] = 'keep'
-PREFS.defaults[KEY.NOTES_SETTINGS][KEY.CSS_KEEP] = 'float'
+PREFS.defaults = _prefs_defaults
 
-CSS_DEFAULT = 'text-align font-weight font-style text-decoration'
+if CALIBRE_VERSION >= (6,0,0) and PREFS[KEY.FONT_WEIGHT] == 'trunc':
+    PREFS[KEY.FONT_WEIGHT] = 'bold'
 
-
-# fix a imcompatibility betwen multiple Calibre version
-CALIBRE_VERSIONS_BOLD = CALIBRE_VERSION < (4,0,0) or CALIBRE_VERSION >= (6,0,0)
-
-if not CALIBRE_VERSIONS_BOLD:
-    FONT_WEIGHT['bold'] = FONT_WEIGHT_ALT
-
-if CALIBRE_VERSION >= (6,0,0):
-    del FONT_WEIGHT['trunc']
-    if PREFS[KEY.FONT_WEIGHT] == 'trunc':
-        PREFS[KEY.FONT_WEIGHT] = 'bold'
-
-if CALIBRE_VERSION >= (7,0,0):
-    CALIBRE_HAS_NOTES = True
-else:
-    CALIBRE_HAS_NOTES = False
-
-
-def css_clean_rules(css: str) -> str:
-    # remove space and invalid character
-    css = regex.loop(r'[.*!()?+<>\\]', r'', css.lower())
-    css = regex.loop(r'([,;:\n\r]|\s{2,})', r' ', css)
-    css = regex.simple(r'^\s*(.*?)\s*$', r'\1', css)
-    # split to table, remove duplicate and sorted
-    css = sorted(set(css.split(' ')))
-    # return into string
-    return ' '.join(css)
+# the notes settings saved before a new setting don't have it
+if set(_prefs_defaults[KEY.NOTES_SETTINGS]) - set(PREFS[KEY.NOTES_SETTINGS]):
+    PREFS[KEY.NOTES_SETTINGS] = notes_settings(PREFS[KEY.NOTES_SETTINGS])
 
 
 class CommonOptions(QWidget):
@@ -351,6 +251,18 @@ class CommonOptions(QWidget):
         self.comboBoxIMG_TAG = KeyValueComboBox(IMG_TAG, prefs[KEY.IMG_TAG], parent=groupboxTEXT)
         layoutTEXT.addRow(_('Images:'), self.comboBoxIMG_TAG)
         self.comboBoxIMG_TAG.setSizePolicy(size_policy)
+        
+        self.comboBoxENGINE = KeyValueComboBox(ENGINE, prefs[KEY.ENGINE], parent=groupboxTEXT)
+        layoutTEXT.addRow(_('Cleaning engine:'), self.comboBoxENGINE)
+        self.comboBoxENGINE.setToolTip(_('The tokenizer engine produce the same result, '
+                                         'but clean the tags in a single pass'))
+        self.comboBoxENGINE.setSizePolicy(size_policy)
+        
+        self.comboBoxFORMATTER = KeyValueComboBox(FORMATTER, prefs[KEY.FORMATTER], parent=groupboxTEXT)
+        layoutTEXT.addRow(_('Final formatting:'), self.comboBoxFORMATTER)
+        self.comboBoxFORMATTER.setToolTip(_('The built-in formatter reproduce the output '
+                                            'of the Calibre comments editor without using it'))
+        self.comboBoxFORMATTER.setSizePolicy(size_policy)
     
     def get_option(self) -> dict:
         
@@ -381,6 +293,8 @@ class CommonOptions(QWidget):
         prefs[KEY.SINGLE_BR] = self.comboBoxSINGLE_BR.selected_key()
         prefs[KEY.EMPTY_PARA] = self.comboBoxEMPTY_PARA.selected_key()
         prefs[KEY.IMG_TAG] = self.comboBoxIMG_TAG.selected_key()
+        prefs[KEY.ENGINE] = self.comboBoxENGINE.selected_key()
+        prefs[KEY.FORMATTER] = self.comboBoxFORMATTER.selected_key()
         
         return prefs
 
@@ -415,6 +329,74 @@ class ConfigWidget(QWidget):
         self.checkBoxCUSTOM_COLUMN.setChecked(PREFS[KEY.CUSTOM_COLUMN])
         layout.addWidget(self.checkBoxCUSTOM_COLUMN)
         
+        # --- Parallel ---
+        self.checkBoxPARALLEL = QCheckBox(_('Use multiple processes for the large selections'), self)
+        self.checkBoxPARALLEL.setToolTip(_('Clean the comments in parallel on all processor cores.\n'
+                                           'Not used with the Calibre comments editor as final formatting.'))
+        self.checkBoxPARALLEL.setChecked(PREFS[KEY.PARALLEL])
+        layout.addWidget(self.checkBoxPARALLEL)
+        
+        # --- Cache ---
+        self.checkBoxCACHE = QCheckBox(_('Keep the results in a cache, for the comments already cleaned'), self)
+        self.checkBoxCACHE.setChecked(PREFS[KEY.CACHE])
+        layout.addWidget(self.checkBoxCACHE)
+        
+        # --- Chunked ---
+        self.checkBoxCHUNKED = QCheckBox(_('Save in the library by groups of books'), self)
+        self.checkBoxCHUNKED.setToolTip(_('Save the cleaned comments every 500 books.\n'
+                                          'An interrupted cleaning can be resumed.'))
+        self.checkBoxCHUNKED.setChecked(PREFS[KEY.CHUNKED])
+        layout.addWidget(self.checkBoxCHUNKED)
+        
+        # --- Profile ---
+        layoutPROFILE = QHBoxLayout()
+        layout.addLayout(layoutPROFILE)
+        layoutPROFILE.addWidget(QLabel(_('Statistics of the cleaning rules:'), self))
+        self.comboBoxPROFILE = KeyValueComboBox(PROFILE, PREFS[KEY.PROFILE], parent=self)
+        self.comboBoxPROFILE.setToolTip(_('Record the time and the changes of each cleaning rule (slower).\n'
+                                          'The cache and the multiple processes are not used.'))
+        layoutPROFILE.addWidget(self.comboBoxPROFILE)
+        layoutPROFILE.addStretch(-1)
+        
+        # --- Time budget ---
+        layoutTIME_BUDGET = QHBoxLayout()
+        layout.addLayout(layoutTIME_BUDGET)
+        layoutTIME_BUDGET.addWidget(QLabel(_('Maximum time to clean a comment:'), self))
+        self.spinBoxTIME_BUDGET = QSpinBox(self)
+        self.spinBoxTIME_BUDGET.setRange(0, 3600)
+        self.spinBoxTIME_BUDGET.setSuffix(_(' s'))
+        self.spinBoxTIME_BUDGET.setSpecialValueText(_('No limit'))
+        self.spinBoxTIME_BUDGET.setToolTip(_('A comment that take longer is skipped and reported at the end.'))
+        self.spinBoxTIME_BUDGET.setValue(PREFS[KEY.TIME_BUDGET])
+        layoutTIME_BUDGET.addWidget(self.spinBoxTIME_BUDGET)
+        layoutTIME_BUDGET.addStretch(-1)
+        
+        # --- Prefilter ---
+        layoutPREFILTER = QHBoxLayout()
+        layout.addLayout(layoutPREFILTER)
+        layoutPREFILTER.addWidget(QLabel(_('Comments already clean:'), self))
+        self.comboBoxPREFILTER = KeyValueComboBox(PREFILTER, PREFS[KEY.PREFILTER], parent=self)
+        self.comboBoxPREFILTER.setToolTip(_('Recognize the comments already cleaned with the same settings,\n'
+                                            'only with the built-in formatter. The check is done in a single process.'))
+        layoutPREFILTER.addWidget(self.comboBoxPREFILTER)
+        layoutPREFILTER.addStretch(-1)
+        
+        # --- Log ---
+        layoutLOG_LEVEL = QHBoxLayout()
+        layout.addLayout(layoutLOG_LEVEL)
+        layoutLOG_LEVEL.addWidget(QLabel(_('Debug log:'), self))
+        self.comboBoxLOG_LEVEL = KeyValueComboBox(LOG_LEVEL, PREFS[KEY.LOG_LEVEL], parent=self)
+        self.comboBoxLOG_LEVEL.setToolTip(_('The changes are shown as a diff of the lines of the comments.\n'
+                                            'A long log slow down the cleaning of the large selections.'))
+        layoutLOG_LEVEL.addWidget(self.comboBoxLOG_LEVEL)
+        layoutLOG_LEVEL.addStretch(-1)
+        
+        self.checkBoxLOG_FILE = QCheckBox(_('Write the log in a file instead of the debug log'), self)
+        self.checkBoxLOG_FILE.setToolTip(_('The file is in the plugins folder of the Calibre configuration,\n'
+                                           'the older logs are kept in 3 files of 5 MB.'))
+        self.checkBoxLOG_FILE.setChecked(PREFS[KEY.LOG_FILE])
+        layout.addWidget(self.checkBoxLOG_FILE)
+        
         # --- Buttons ---
         layout.addWidget(QLabel(' ', self))
         button_layout = QHBoxLayout()
@@ -432,6 +414,14 @@ class ConfigWidget(QWidget):
         with PREFS:
             prefs = self.options.get_option()
             prefs[KEY.CUSTOM_COLUMN] = self.checkBoxCUSTOM_COLUMN.isChecked()
+            prefs[KEY.PARALLEL] = self.checkBoxPARALLEL.isChecked()
+            prefs[KEY.CACHE] = self.checkBoxCACHE.isChecked()
+            prefs[KEY.CHUNKED] = self.checkBoxCHUNKED.isChecked()
+            prefs[KEY.PROFILE] = self.comboBoxPROFILE.selected_key()
+            prefs[KEY.TIME_BUDGET] = self.spinBoxTIME_BUDGET.value()
+            prefs[KEY.PREFILTER] = self.comboBoxPREFILTER.selected_key()
+            prefs[KEY.LOG_LEVEL] = self.comboBoxLOG_LEVEL.selected_key()
+            prefs[KEY.LOG_FILE] = self.checkBoxLOG_FILE.isChecked()
             PREFS.update(prefs)
         
         debug_print('Save settings:', prefs, '\n')
@@ -531,3 +521,61 @@ class SelectNotesDialog(Dialog):
     def accept(self):
         self.selected_notes = self.tree_view.get_selected()
         Dialog.accept(self)
+
+
+class PreviewDialog(Dialog):
+    '''
+    result of a dry run of the cleaning, see preview.CleaningPreview
+    the changes are written in the library if accepted
+    '''
+    def __init__(self, preview):
+        self.preview = preview
+        
+        Dialog.__init__(self,
+            title=_('Preview of the cleaning'),
+            name='plugin config dialog:User Action Interface:Preview of the cleaning',
+            parent=GUI,
+        )
+    
+    def setup_ui(self):
+        layout = QVBoxLayout(self)
+        
+        layout.addWidget(QLabel(self.preview.summary(), self))
+        
+        # --- changed books ---
+        rows = self.preview.rows()
+        self.table = QTableWidget(len(rows), 5, self)
+        self.table.setHorizontalHeaderLabels([
+            _('Book'), _('Fields'), _('Bytes removed'), _('Lines changed'), _('Rules'),
+        ])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        for row, (book_id, book_info, fields, removed, lines, rules) in enumerate(rows):
+            for col, value in enumerate((book_info, ', '.join(fields), removed, lines, ', '.join(rules))):
+                item = QTableWidgetItem(str(value))
+                if isinstance(value, int):
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+        self.table.resizeColumnsToContents()
+        layout.addWidget(self.table)
+        
+        # --- sample of the changes ---
+        layoutSAMPLE = QHBoxLayout()
+        layout.addLayout(layoutSAMPLE)
+        layoutSAMPLE.addWidget(QLabel(_('Sample of the changes:'), self))
+        self.comboBoxSAMPLE = QComboBox(self)
+        for book_id, field in self.preview.sample:
+            self.comboBoxSAMPLE.addItem(field+': '+self.preview.books_info[book_id])
+        self.comboBoxSAMPLE.currentIndexChanged.connect(self.show_diff)
+        layoutSAMPLE.addWidget(self.comboBoxSAMPLE, 1)
+        
+        self.textBrowserDIFF = QTextBrowser(self)
+        layout.addWidget(self.textBrowserDIFF)
+        self.show_diff(0)
+        
+        layout.addWidget(self.bb)
+        self.bb.button(QDialogButtonBox.Ok).setText(_('Apply the changes'))
+    
+    def show_diff(self, idx: int):
+        if 0 <= idx < len(self.preview.sample):
+            self.textBrowserDIFF.setHtml(self.preview.html_diff(*self.preview.sample[idx]))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# Pure Python replacement of the round-trip in the Calibre comments editor
+# for the HTML subset produced by the plugin.
+# Don't need Qt or the GUI thread, can be used in a worker or from the command line.
+#
+# What the editor do, and what is reproduced here:
+#   - the <div>, <body> and <html> are not blocks, only the paragraphs inside it
+#     (the text outside a paragraph is a new paragraph)
+#   - one block by line, all wrapped in a <div>:  <div>\n<p>a</p>\n<p>b</p></div>
+#   - the whitespaces are collapsed, and removed at the start/end of the blocks
+#   - the empty paragraphs contains a no-break space
+#   - the entities are replaced by their character, except &amp; &lt; &gt;
+#   - the CSS declarations are serialised as "name: value; name: value"
+#   - a <span> without attributs is removed, the unknown tags are removed
+
+import re
+from html import unescape
+from typing import List, Optional, Union
+
+from .html_tokenizer import Tag, tokenize
+
+NBSP = '\xA0'
+
+# root tags, only containers for the blocks
+ROOT_TAGS = {'html', 'body', 'div', 'qt'}
+# blocks containing some text
+BLOCK_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'address', 'dl', 'dt', 'dd', 'center'}
+LIST_TAGS = {'ul', 'ol'}
+VOID_TAGS = {'br', 'hr', 'img', 'meta'}
+# the table are keep as it
+TABLE_TAGS = {'table', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td'}
+INLINE_TAGS = {
+    'a', 'b', 'big', 'br', 'cite', 'code', 'dfn', 'em', 'font', 'i', 'img', 'kbd', 'nobr',
+    's', 'samp', 'small', 'span', 'strong', 'sub', 'sup', 'tt', 'u', 'var',
+}
+# the tags that don't contains text directly
+STRUCT_TAGS = LIST_TAGS | {'table', 'thead', 'tbody', 'tfoot', 'tr'}
+# the tags removed with their content
+DROP_TAGS = {'head', 'title', 'script', 'style'}
+
+# same whitespaces that the HTML, the no-break space is not a whitespace
+SPACES = re.compile(r'[ \t\n\r\f]+')
+ATTRIBUT = re.compile(r'''([^\s"'=/<>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?''')
+
+
+class Element:
+    '''
+    A minimal element tree, enough to rebuild the blocks of a comment.
+    '''
+    
+    __slots__ = ('attributes', 'children', 'name')
+    
+    def __init__(self, name: str, attributes: Optional[List[list]]=None):
+        self.name = name
+        self.attributes = attributes or []
+        self.children: List[Union[Element, str]] = []
+    
+    def has_content(self) -> bool:
+        for c in self.children:
+            if isinstance(c, str):
+                if c.strip(' \t\n\r\f'):
+                    return True
+            elif c.name in ('img', 'br') or c.has_content():
+                return True
+        return False
+
+
+def parse_attributes(attributes: str) -> List[list]:
+    rslt = []
+    for m in ATTRIBUT.finditer(attributes):
+        name = m.group(1).lower()
+        value = next((v for v in m.group(2, 3, 4) if v is not None), None)
+        if any(name == n for n,_ in rslt):
+            continue
+        rslt.append([name, None if value is None else unescape(value)])
+    return rslt
+
+
+def parse_style(style: str) -> List[tuple]:
+    '''
+    same as the parse_style() of the Calibre comments editor
+    '''
+    rslt = {}
+    for prop in style.split(';'):
+        k, sep, v = prop.partition(':')
+        k = k.strip().lower()
+        if sep and k:
+            rslt[k] = v.strip()
+    return list(rslt.items())
+
+
+def escape_text(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_attribut(text: str) -> str:
+    return escape_text(text).replace('"', '&quot;')
+
+
+def build_tree(text: str) -> Element:
+    '''
+    Build the list of the blocks of the comment.
+    The returned root contains only blocks: p/h1-6/..., ul/ol, table and hr.
+    '''
+    root = Element('div')
+    # stack of the open elements, [0] is always the root
+    stack = [root]
+    drop = None
+    
+    def current_block() -> Element:
+        # a text outside a block open a new paragraph
+        if len(stack) == 1:
+            p = Element('p')
+            root.children.append(p)
+            stack.append(p)
+        return stack[-1]
+    
+    def close(name: str) -> bool:
+        for i in range(len(stack)-1, 0, -1):
+            if stack[i].name == name:
+                del stack[i:]
+                return True
+            if stack[i].name in LIST_TAGS or stack[i].name == 'table':
+                # don't close a list or a table for a unbalanced tag
+                return False
+        return False
+    
+    def in_stack(names) -> bool:
+        return any(e.name in names for e in stack[1:])
+    
+    for token in tokenize(text):
+        if drop:
+            if isinstance(token, Tag) and token.close and token.name.lower() == drop:
+                drop = None
+            continue
+        
+        if isinstance(token, str):
+            token = unescape(token)
+            if (len(stack) == 1 or stack[-1].name in STRUCT_TAGS) and not token.strip(' \t\n\r\f'):
+                continue
+            current_block().children.append(token)
+            continue
+        
+        name = token.name.lower()
+        
+        if name in DROP_TAGS:
+            if not token.close and not token.attributes.endswith('/'):
+                drop = name
+            continue
+        
+        if in_stack(TABLE_TAGS) and (name in TABLE_TAGS or not token.close):
+            # inside a table, keep the structure as it
+            if token.close:
+                close(name)
+            else:
+                e = Element(name, parse_attributes(token.attributes))
+                stack[-1].children.append(e)
+                if name not in VOID_TAGS:
+                    stack.append(e)
+            continue
+        
+        if name in ROOT_TAGS:
+            # only a container, close the open blocks
+            if not in_stack(LIST_TAGS | TABLE_TAGS):
+                del stack[1:]
+            continue
+        
+        if name in BLOCK_TAGS or name in LIST_TAGS or name in ('li', 'table', 'hr'):
+            if token.close:
+                close(name)
+                continue
+            
+            e = Element(name, parse_attributes(token.attributes))
+            if name == 'li':
+                if not in_stack(LIST_TAGS):
+                    # list item outside a list
+                    e.name = 'p'
+                    del stack[1:]
+                else:
+                    while stack[-1].name not in LIST_TAGS:
+                        stack.pop()
+            elif name in LIST_TAGS and in_stack(('li',)):
+                # sub list
+                pass
+            elif in_stack(('li',)) and name in BLOCK_TAGS:
+                # paragraph inside a list item, only its content is keep
+                continue
+            else:
+                # a block close the previous one
+                del stack[1:]
+            
+            stack[-1].children.append(e)
+            if name != 'hr':
+                stack.append(e)
+            continue
+        
+        if name in INLINE_TAGS:
+            if token.close:
+                close(name)
+                continue
+            e = Element(name, parse_attributes(token.attributes))
+            current_block().children.append(e)
+            if name not in VOID_TAGS:
+                stack.append(e)
+            continue
+        
+        # unknown tag, removed but keep its content
+    
+    return root
+
+
+def serialize(e: Element, out: List[str]):
+    attributes = []
+    for k,v in e.attributes:
+        if k == 'style':
+            v = '; '.join(f'{n}: {d}' for n,d in parse_style(v or ''))
+            if not v:
+                continue
+        if v is None:
+            attributes.append(' '+k)
+        else:
+            attributes.append(f' {k}="{escape_attribut(v)}"')
+    
+    if e.name == 'span' and not attributes:
+        # lift the span without attributs
+        for c in e.children:
+            if isinstance(c, str):
+                out.append(escape_text(c))
+            else:
+                serialize(c, out)
+        return
+    
+    out.append('<'+e.name+''.join(attributes)+'>')
+    if e.name in VOID_TAGS:
+        return
+    
+    for i,c in enumerate(e.children):
+        if isinstance(c, str):
+            out.append(escape_text(c))
+        else:
+            if i and e.name in LIST_TAGS:
+                # one list item by line
+                out.append('\n')
+            serialize(c, out)
+    out.append('</'+e.name+'>')
+
+
+def clean_spaces(e: Element):
+    '''
+    collapse the whitespaces of the text inside the block,
+    and remove them at the start/end of the block and around the <br>
+    '''
+    if e.name == 'pre':
+        return
+    
+    # previous text, for the collapse across the inline tags
+    texts = []
+    space = True
+    
+    def walk(e: Element):
+        nonlocal space
+        for i,c in enumerate(e.children):
+            if isinstance(c, str):
+                c = SPACES.sub(' ', c)
+                if space:
+                    c = c.lstrip(' ')
+                if c:
+                    space = c[-1] == ' '
+                e.children[i] = c
+                texts.append((e, i))
+            elif c.name == 'br':
+                # remove the space before the <br>, and after it (see above)
+                strip_last()
+                space = True
+            elif c.name == 'img':
+                space = False
+            else:
+                walk(c)
+    
+    def strip_last():
+        for p, i in reversed(texts):
+            c = p.children[i].rstrip(' ')
+            p.children[i] = c
+            if c:
+                break
+    
+    walk(e)
+    strip_last()
+    
+    # remove the empty texts and inline tags
+    def drop_empty(e: Element):
+        for c in e.children:
+            if not isinstance(c, str):
+                drop_empty(c)
+        e.children = [c for c in e.children if c != '' and (
+            isinstance(c, str) or c.children or c.name in VOID_TAGS or c.name not in INLINE_TAGS)]
+    drop_empty(e)
+
+
+def format_html(text: str) -> str:
+    '''
+    Normalise the comment like the Calibre comments editor
+    (a "ce.html = text; text = ce.html" round-trip)
+    '''
+    root = build_tree(text)
+    
+    if not root.has_content():
+        return ''
+    
+    out = []
+    for block in root.children:
+        if block.name in BLOCK_TAGS or block.name == 'li':
+            clean_spaces(block)
+            if not block.has_content():
+                block.children = [NBSP]
+        elif block.name in LIST_TAGS:
+            for li in block.children:
+                if not isinstance(li, str):
+                    clean_spaces(li)
+        
+        out.append('\n')
+        serialize(block, out)
+    
+    return '<div>'+''.join(out)+'</div>'
+
+
+def remove_format(text: str) -> str:
+    '''
+    Remove all formatting, like the 'Remove formatting' action of the Calibre comments editor.
+    Keep only the paragraphs, line breaks and images.
+    '''
+    root = build_tree(text)
+    
+    def flatten(e: Element, out: list):
+        for c in e.children:
+            if isinstance(c, str) or c.name in ('br', 'img'):
+                out.append(c)
+            else:
+                flatten(c, out)
+    
+    blocks = []
+    for block in root.children:
+        if block.name == 'hr':
+            continue
+        items = block.children if block.name in LIST_TAGS else [block]
+        for item in items:
+            if isinstance(item, str):
+                continue
+            p = Element('p')
+            flatten(item, p.children)
+            for img in p.children:
+                if not isinstance(img, str):
+                    img.attributes = [a for a in img.attributes if a[0] in ('src', 'alt', 'width', 'height')]
+            blocks.append(p)
+    
+    root.children = blocks
+    out = []
+    for block in blocks:
+        clean_spaces(block)
+        if not block.has_content():
+            block.children = [NBSP]
+        out.append('\n')
+        serialize(block, out)
+    
+    if not root.has_content():
+        return ''
+    return '<div>'+''.join(out)+'</div>'
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+import re
+from typing import Iterator, Union
+
+# same definition of a tag that the regex of comments_cleaner
+# a tag containing a '<' or '>' in a attribut is not a tag (like for the regex)
+TAG_REGEX = re.compile(r'<(/?)(\w+)([^<>]*)>', re.ASCII)
+
+
+class Tag:
+    '''
+    A tag of the comment, splited in 3 parts:
+    <{close}{name}{attributes}>
+
+    attributes is the raw string after the name, including the leading space
+    and the trailing '/' of the self-closing tags.
+    '''
+
+    __slots__ = ('attributes', 'close', 'name')
+
+    def __init__(self, close: bool, name: str, attributes: str):
+        self.close = close
+        self.name = name
+        self.attributes = attributes
+
+    def __str__(self) -> str:
+        return '<' + ('/' if self.close else '') + self.name + self.attributes + '>'
+
+    def __repr__(self) -> str:
+        return f'Tag({self})'
+
+    def is_simple(self) -> bool:
+        '''
+        The attributes match the pattern "(| [^>]*)",
+        the shape expected by most of the rules.
+        '''
+        return not self.attributes or self.attributes[0] == ' '
+
+    def is_self_closing(self) -> bool:
+        '''
+        The attributes match the pattern "(| [^>]*)/?"
+        '''
+        return self.is_simple() or self.attributes == '/'
+
+
+def tokenize(text: str) -> Iterator[Union[str, Tag]]:
+    '''
+    Split the text in a sequence of text runs (str) and Tag.
+    The concatenation of the str() of each token rebuild the original text.
+    '''
+    pos = 0
+    for m in TAG_REGEX.finditer(text):
+        start = m.start()
+        if start > pos:
+            yield text[pos:start]
+        yield Tag(bool(m.group(1)), m.group(2), m.group(3))
+        pos = m.end()
+    if pos < len(text):
+        yield text[pos:]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+import difflib
+import logging
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Optional
+
+# the levels of the log, each one include the previous
+LEVELS = ('off', 'summary', 'changed', 'full')
+OFF, SUMMARY, CHANGED, FULL = range(len(LEVELS))
+
+# size of a log file, and number of old files keep
+FILE_SIZE = 5_000_000
+FILE_BACKUPS = 3
+
+# the logger of all the jobs, each job add its file handler and remove it in close()
+LOGGER = logging.getLogger(__name__)
+LOGGER.propagate = False
+LOGGER.setLevel(logging.INFO)
+
+
+class CleanerLog:
+    '''
+    The log of a cleaning job, by level:
+        off: nothing
+        summary: the summary of the job
+        changed: and the changed texts, with a diff
+        full: and all the texts, before and after
+    
+    The messages go in the debug log (console), or in a rotating file if a path is given.
+    Check enabled() before to build a costly message, so it's only formatted when needed:
+        if log.enabled(FULL):
+            log.text(FULL, 'Comments for '+book_info(book_id), text)
+    '''
+    
+    def __init__(self, level: str, path: Optional[str]=None, console: Callable[..., None]=print):
+        self.level = LEVELS.index(level) if level in LEVELS else SUMMARY
+        self.console = console
+        self.handler = None
+        if path and self.level:
+            self.handler = RotatingFileHandler(path, maxBytes=FILE_SIZE, backupCount=FILE_BACKUPS,
+                                               encoding='utf-8', delay=True)
+            self.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            # only the messages of this job, if a other one is running
+            self.handler.addFilter(lambda record: getattr(record, 'job', None) is self)
+            LOGGER.addHandler(self.handler)
+    
+    def log(self, message: str):
+        LOGGER.info(message, extra={'job': self})
+    
+    def enabled(self, level: int) -> bool:
+        return self.level >= level
+    
+    def print(self, level: int, *args):
+        if self.level < level:
+            return
+        if self.handler:
+            self.log(' '.join(map(str, args)))
+        else:
+            self.console(*args)
+    
+    def text(self, level: int, pre: str, text: Optional[str]=None):
+        '''
+        a title and a text, same as action.debug_text()
+        '''
+        if self.level < level:
+            return
+        if self.handler:
+            self.log(pre+':::' + ('\n'+text if text else ''))
+        else:
+            self.console(pre+':::' + ('\n'+text if text else '') + '\n')
+    
+    def diff(self, level: int, pre: str, text: str, text_out: str):
+        '''
+        a title and the diff between the texts, by line
+        '''
+        if self.level < level:
+            return
+        lines = difflib.unified_diff(text.splitlines(), text_out.splitlines(), 'before', 'after', n=1, lineterm='')
+        self.text(level, pre, '\n'.join(lines))
+    
+    def close(self):
+        if self.handler:
+            LOGGER.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+try:
+    load_translations()
+except NameError:
+    pass  # load_translations() added in calibre 1.9
+
+import difflib
+import random
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+# number of changed comments keep for the diff viewer
+SAMPLE_SIZE = 50
+
+DIFF_STYLE = '''
+table.diff {font-family: monospace; border: none}
+.diff_header {background-color: #e0e0e0}
+.diff_next {background-color: #c0c0c0}
+.diff_add {background-color: #aaffaa}
+.diff_chg {background-color: #ffff77}
+.diff_sub {background-color: #ffaaaa}
+'''
+
+
+class TextStats:
+    
+    __slots__ = ('lines', 'rules')
+    
+    def __init__(self, text: str, text_out: str, rules: Tuple[str, ...]):
+        # changed lines
+        self.lines = 0
+        if text != text_out:
+            matcher = difflib.SequenceMatcher(None, text.splitlines(), text_out.splitlines(), autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != 'equal':
+                    self.lines += max(i2-i1, j2-j1)
+        # labels of the rules that modified the comment
+        self.rules = rules
+
+
+class CleaningPreview:
+    '''
+    Result of a dry run of the cleaning: the cleaned comments are keep,
+    with the statistics of each one, and written in the library only if the preview is confirmed.
+    
+    The statistics of each distinct text are computed by the cleaning thread, see wrap().
+    The comments are added by book with add(), a random sample of the changed ones is keep for the diff viewer.
+    '''
+    
+    def __init__(self, sample_size: int=SAMPLE_SIZE, seed: Optional[int]=None):
+        # {text normalized: TextStats}
+        self.stats: Dict[str, TextStats] = {}
+        # {book_id: {field: (comment, comment cleaned, TextStats)}} of the changed comments
+        self.books: Dict[int, Dict[str, Tuple[str, str, TextStats]]] = {}
+        self.books_info: Dict[int, str] = {}
+        self.texts = 0
+        self.unchanged = 0
+        self.skipped = 0
+        # changed comments taken from the cache of the results, without their rules
+        self.cached = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.rules = Counter()
+        
+        self.sample_size = sample_size
+        self.sample: List[Tuple[int, str]] = []
+        self._changed = 0
+        self._random = random.Random(seed)
+    
+    def wrap(self, func: Callable[[str], str], recorder=None) -> Callable[[str], str]:
+        '''
+        return func that also record the statistics of the cleaned text
+        the rules are only known with a profiler.RuleRecorder, it need a single thread
+        '''
+        def previewed(text: str) -> str:
+            if recorder:
+                recorder.take_fired()
+            rslt = func(text)
+            self.stats[text] = TextStats(text, rslt, tuple(recorder.take_fired()) if recorder else ())
+            return rslt
+        return previewed
+    
+    def add(self, book_id: int, book_info: Callable[[], str], field: str,
+            text: str, text_norm: str, text_out: Optional[str]):
+        '''
+        add a comment of a book, text_out is None if it was skipped
+        book_info() is only called for the changed comments
+        '''
+        self.texts += 1
+        if text_out is None:
+            self.skipped += 1
+            return
+        
+        size = len(text.encode('utf-8'))
+        self.bytes_before += size
+        if text == text_out:
+            self.unchanged += 1
+            self.bytes_after += size
+            return
+        
+        stats = self.stats.get(text_norm)
+        if stats is None:
+            # not cleaned by the wrapped cleaner, from the cache
+            stats = self.stats[text_norm] = TextStats(text, text_out, ())
+            self.cached += 1
+        self.bytes_after += len(text_out.encode('utf-8'))
+        self.rules.update(stats.rules)
+        
+        if book_id not in self.books:
+            self.books[book_id] = {}
+            self.books_info[book_id] = book_info()
+        self.books[book_id][field] = (text, text_out, stats)
+        
+        # reservoir sampling of the changed comments
+        self._changed += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append((book_id, field))
+        else:
+            idx = self._random.randrange(self._changed)
+            if idx < self.sample_size:
+                self.sample[idx] = (book_id, field)
+    
+    def changed(self) -> int:
+        return sum(len(v) for v in self.books.values())
+    
+    def rows(self) -> List[tuple]:
+        '''
+        (book_id, book info, fields, bytes removed, changed lines, rules) of the changed books
+        '''
+        rslt = []
+        for book_id, fields in self.books.items():
+            removed = lines = 0
+            rules = set()
+            for text, text_out, stats in fields.values():
+                removed += len(text.encode('utf-8')) - len(text_out.encode('utf-8'))
+                lines += stats.lines
+                rules.update(stats.rules)
+            rslt.append((book_id, self.books_info[book_id], sorted(fields), removed, lines, sorted(rules)))
+        return rslt
+    
+    def summary(self) -> str:
+        removed = self.bytes_before - self.bytes_after
+        lines = []
+        lines.append(f'{len(self.books)} books changed, {self.changed()} of {self.texts} comments '
+                     f'({self.unchanged} unchanged, {self.skipped} skipped).')
+        lines.append(f'{removed/1024:0.1f} KB removed of {self.bytes_before/1024:0.1f} KB '
+                     f'({removed/self.bytes_before if self.bytes_before else 0:0.1%}).')
+        if self.rules:
+            lines.append('Rules that changed the most comments: '
+                         + ', '.join(f'{rule} ({count})' for rule, count in self.rules.most_common(5)))
+        if self.cached:
+            lines.append(f'{self.cached} changed texts taken from the cache of the results, their rules are unknown.')
+        return '\n'.join(lines)
+    
+    def changes(self) -> Dict[str, Dict[int, str]]:
+        '''
+        the map {field:{book_id:comment}} of the changed comments, same as CleanerProgressDialog.clean_books()
+        '''
+        rslt = {}
+        for book_id, fields in self.books.items():
+            for field, (_text, text_out, _stats) in fields.items():
+                rslt.setdefault(field, {})[book_id] = text_out
+        return rslt
+    
+    def html_diff(self, book_id: int, field: str) -> str:
+        '''
+        HTML table of the differences of a changed comment
+        '''
+        text, text_out, _stats = self.books[book_id][field]
+        table = difflib.HtmlDiff(wrapcolumn=80).make_table(
+            text.splitlines(), text_out.splitlines(),
+            _('Before'), _('After'), context=True, numlines=1,
+        )
+        return f'<html><head><style>{DIFF_STYLE}</style></head><body>{table}</body></html>'
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+import time
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import comments_cleaner
+from .comments_cleaner import Cleaner, Rule, RuleLoopError, Step, check_budget
+
+
+class RuleStats:
+    
+    __slots__ = ('calls', 'iterations', 'matched', 'modified', 'time')
+    
+    def __init__(self):
+        self.calls = 0
+        self.matched = 0
+        self.modified = 0
+        self.iterations = 0
+        self.time = 0.0
+
+
+def rules_labels(*sources) -> Dict[Union[Rule, Step], str]:
+    '''
+    name of the rules and steps of the sources (prefix, module or object)
+    "TABLE[index]" for the rules of the tuples
+    '''
+    rslt = {}
+    for prefix, source in sources:
+        for name, value in vars(source).items():
+            if isinstance(value, (Rule, Step)):
+                rslt.setdefault(value, prefix+name)
+            elif isinstance(value, (tuple, list)):
+                for idx, rule in enumerate(value):
+                    if isinstance(rule, tuple) and rule and isinstance(rule[-1], Rule):
+                        # full_check: (para, check, rule)
+                        rule = rule[-1]
+                    if isinstance(rule, (Rule, Step)):
+                        rslt.setdefault(rule, f'{prefix}{name}[{idx}]')
+    return rslt
+
+
+def _rule_loop(rule: Rule, text: str) -> Tuple[str, int]:
+    rslt = text
+    iterations = 0
+    while rule.regex.search(rslt):
+        check_budget()
+        if iterations > 1000:
+            raise RuleLoopError(rule.regex.pattern, rule.repl)
+        rslt = rule.regex.sub(rule.repl, rslt)
+        iterations += 1
+    return rslt, iterations
+
+
+def _rule_sub(rule: Rule, text: str) -> Tuple[str, int]:
+    rslt, iterations = rule.regex.subn(rule.repl, text)
+    return rslt, 1 if iterations else 0
+
+
+def _step_call(step: Step, text: str) -> Tuple[str, int]:
+    rslt = step.func(text)
+    return rslt, 0 if rslt == text else 1
+
+
+class RuleRecorder:
+    '''
+    Record the rules and steps that modified the texts, see take_fired().
+    
+    Used by the preview to know the rules that changed each comment,
+    it don't time them like RuleProfiler, so it can run with the cache of the results.
+    
+    While active, Rule and Step are patched for all the Cleaner, use it as a context manager
+    or with start() and stop().
+    '''
+    
+    def __init__(self, cleaner: Cleaner):
+        self.labels = rules_labels(('', comments_cleaner), ('Cleaner.', cleaner))
+        # rules that modified a text since the last take_fired()
+        self.fired = set()
+        self._patched = None
+    
+    def start(self):
+        if self._patched:
+            return
+        self._patched = (Rule.__call__, Rule.sub, Step.__call__)
+        fired = self.fired
+        
+        def recorded(call: Callable[[Union[Rule, Step], str], str]) -> Callable[[Union[Rule, Step], str], str]:
+            def recorded_call(rule: Union[Rule, Step], text: str) -> str:
+                rslt = call(rule, text)
+                if rslt != text:
+                    fired.add(rule)
+                return rslt
+            return recorded_call
+        
+        Rule.__call__, Rule.sub, Step.__call__ = map(recorded, self._patched)
+    
+    def stop(self):
+        if self._patched:
+            Rule.__call__, Rule.sub, Step.__call__ = self._patched
+            self._patched = None
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def take_fired(self) -> List[str]:
+        '''
+        labels of the rules that modified a text since the last call, and reset them
+        '''
+        rslt = sorted(self.label(r) for r in self.fired)
+        self.fired.clear()
+        return rslt
+    
+    def label(self, rule: Union[Rule, Step]) -> str:
+        return self.labels.get(rule) or repr(rule)
+
+
+class RuleProfiler(RuleRecorder):
+    '''
+    Instrumentation of the cleaning rules: for each Rule, record the calls,
+    the calls where the pattern matched, the calls that modified the text,
+    the iterations of the fixpoint loop and the time.
+    
+    The other steps of the cleaning (Step: unnest_blocks(), the CSS parse, the formatter...)
+    are recorded the same way, a step that modified the text count as matched.
+    The time of a step don't include the rules and steps called inside it,
+    so the total of the table is the time of the cleaning.
+    
+    The rules that modified the texts are recorded too, like RuleRecorder.
+    '''
+    
+    def __init__(self, cleaner: Cleaner):
+        RuleRecorder.__init__(self, cleaner)
+        self.stats: Dict[Union[Rule, Step], RuleStats] = {}
+    
+    def start(self):
+        if self._patched:
+            return
+        self._patched = (Rule.__call__, Rule.sub, Step.__call__)
+        stats = self.stats
+        fired = self.fired
+        # time of the rules called inside the current one, to remove of its own time
+        nested = [0.0]
+        
+        def timed(rule: Union[Rule, Step], text: str, call: Callable[..., Tuple[str, int]]) -> str:
+            outer = nested[0]
+            nested[0] = 0.0
+            start = time.perf_counter()
+            try:
+                rslt, iterations = call(rule, text)
+            finally:
+                elapsed = time.perf_counter() - start
+                own = elapsed - nested[0]
+                nested[0] = outer + elapsed
+            
+            s = stats.get(rule)
+            if s is None:
+                s = stats[rule] = RuleStats()
+            s.calls += 1
+            s.time += own
+            s.iterations += iterations
+            if iterations:
+                s.matched += 1
+                if rslt != text:
+                    s.modified += 1
+                    fired.add(rule)
+            return rslt
+        
+        def profiled_call(rule: Rule, text: str) -> str:
+            return timed(rule, text, _rule_sub if rule.simple else _rule_loop)
+        
+        def profiled_sub(rule: Rule, text: str) -> str:
+            return timed(rule, text, _rule_sub)
+        
+        def profiled_step(step: Step, text: str) -> str:
+            return timed(step, text, _step_call)
+        
+        Rule.__call__ = profiled_call
+        Rule.sub = profiled_sub
+        Step.__call__ = profiled_step
+    
+    def rows(self) -> List[tuple]:
+        '''
+        (rule, calls, matched, modified, iterations, time in ms), the slowest first
+        the known rules never called are at the end
+        '''
+        rslt = [
+            (self.label(r), s.calls, s.matched, s.modified, s.iterations, s.time*1000)
+            for r,s in self.stats.items()
+        ]
+        rslt.sort(key=lambda x: x[-1], reverse=True)
+        rslt.extend((l, 0, 0, 0, 0, 0.0) for r,l in self.labels.items() if r not in self.stats)
+        return rslt
+    
+    def summary(self) -> str:
+        rows = self.rows()
+        if not rows:
+            return 'No rule executed.'
+        
+        width = min(max(len(r[0]) for r in rows), 60)
+        lines = [f'{"rule":<{width}} {"calls":>8} {"matched":>8} {"modified":>8} {"loops":>8} {"ms":>10}']
+        for name, calls, matched, modified, iterations, ms in rows:
+            lines.append(f'{name[:width]:<{width}} {calls:>8} {matched:>8} {modified:>8} {iterations:>8} {ms:>10.2f}')
+        
+        executed = sum(1 for r in rows if r[1])
+        never = sum(1 for r in rows if r[1] and not r[2])
+        lines.append(f'{executed} rules executed, {never} never matched, {len(rows)-executed} never called, '
+                     f'total {sum(r[-1] for r in rows):0.1f} ms')
+        return '\n'.join(lines)
+    
+    def write(self, path: str):
+        '''
+        write the stats in a tab separated file
+        '''
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('rule\tcalls\tmatched\tmodified\titerations\tms\n')
+            for row in self.rows():
+                f.write('\t'.join(map(str, row[:-1]))+f'\t{row[-1]:0.3f}\n')
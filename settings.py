@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2020, un_pogaz <un.pogaz@gmail.com>'
+
+
+try:
+    load_translations()
+except NameError:
+    pass  # load_translations() added in calibre 1.9
+
+# The keys, values and defaults of the settings, without Qt:
+# imported by the cleaning engine, the worker processes and the command line.
+# The widgets and the stored PREFS are in config.py.
+
+import re
+from collections import OrderedDict
+
+from calibre.constants import numeric_version as CALIBRE_VERSION
+
+
+class KEY:
+    KEEP_URL = 'KeepUrl'
+    HEADINGS = 'Headings'
+    FONT_WEIGHT = 'FontWeight'
+    DEL_ITALIC = 'RemoveItalic'
+    DEL_UNDER = 'RemoveUnderline'
+    DEL_STRIKE = 'RemoveStrikethrough'
+    FORCE_JUSTIFY = 'ForceJustify'
+    LIST_ALIGN = 'ListAlign'
+    ID_CLASS = 'ID_Class'
+    FULL_BOLD = 'FullBold'
+    FULL_ITALIC = 'FullItalic'
+    CSS_KEEP_ACTIVE = 'CSStoKeepActive'
+    CSS_KEEP = 'CSStoKeep'
+    
+    DEL_FORMATTING = 'RemoveFormatting'
+    
+    MARKDOWN = 'Markdown'
+    DOUBLE_BR = 'DoubleBR'
+    SINGLE_BR = 'SingleBR'
+    EMPTY_PARA = 'EmptyParagraph'
+    IMG_TAG = 'ImgTag'
+    
+    ENGINE = 'Engine'
+    FORMATTER = 'Formatter'
+    
+    CUSTOM_COLUMN = 'CustomColumn'
+    PARALLEL = 'Parallel'
+    CACHE = 'Cache'
+    CHUNKED = 'Chunked'
+    PROFILE = 'Profile'
+    TIME_BUDGET = 'TimeBudget'
+    PREFILTER = 'Prefilter'
+    LOG_LEVEL = 'LogLevel'
+    LOG_FILE = 'LogFile'
+    
+    NOTES_SETTINGS = 'NotesSettings'
+
+
+KEEP_URL = OrderedDict([
+                    ('keep', _('Keep URL')),
+                    ('del', _('Delete URL'))])
+
+HEADINGS = OrderedDict([
+                        ('conv', _('Converte to a paragraph')),
+                        ('bolder', _('Converte to a paragraph but keep the bold')),
+                        ('none', _('No change'))])
+
+FONT_WEIGHT = OrderedDict([
+                        ('trunc', _('Round the Weights value to the hundred')),
+                        ('bold', _("Round to Bold (value 'bold')")),
+                        ('none', _('Do not change the Weights')),
+                        ('del', _('Delete Weights'))])
+FONT_WEIGHT_ALT = _('Round to Bold (value 600)')
+
+FORCE_JUSTIFY = OrderedDict([
+                        ('all', _('Force the justification (replace "center" and "right")')),
+                        ('empty', _('Justification for indeterminate text (keep "center" and "right")')),
+                        ('none', _('No change')),
+                        ('del', _('Delete all alignment'))])
+
+LIST_ALIGN = OrderedDict([
+                    ('keep', _("Use the 'Justification' setting")),
+                    ('del', _('Delete the alignment in lists'))])
+
+ID_CLASS = OrderedDict([
+                        ('id', _('Delete "id" attribut')),
+                        ('class', _('Delete "class" attribut')),
+                        ('id_class', _('Delete "id" and "class" attribut')),
+                        ('none', _('No change'))])
+
+
+MARKDOWN = OrderedDict([
+                        ('always', _('Convert in all comments (not recomanded)')),
+                        ('try', _('Convert only from a plain text comment')),
+                        ('none', _('No change'))])
+
+DOUBLE_BR = OrderedDict([
+                        ('empty', _('Create a empty paragraph')),
+                        ('new', _('Create a new paragraph')),
+                        ('none', _('No change'))])
+
+SINGLE_BR = OrderedDict([
+                        ('para', _('Create a new paragraph')),
+                        ('space', _('Replace with space')),
+                        ('none', _('No change'))])
+
+EMPTY_PARA = OrderedDict([
+                        ('merge', _('Merge in a single empty paragraph')),
+                        ('none', _('No change')),
+                        ('del', _('Delete empty paragraph'))])
+
+IMG_TAG = OrderedDict([
+                    ('keep', _('Keep images')),
+                    ('del', _('Delete images'))])
+
+ENGINE = OrderedDict([
+                    ('regex', _('Regular expressions')),
+                    ('tokenizer', _('Single-pass tokenizer (faster)'))])
+
+PROFILE = OrderedDict([
+                    ('none', _('Disabled')),
+                    ('log', _('Print the statistics in the debug log')),
+                    ('file', _('Print the statistics and save them in a file'))])
+
+PREFILTER = OrderedDict([
+                    ('skip', _('Skip the comments already clean')),
+                    ('validate', _('Clean them anyway and report the errors in the debug log')),
+                    ('none', _('Disabled'))])
+
+LOG_LEVEL = OrderedDict([
+                    ('off', _('Nothing')),
+                    ('summary', _('Summary of the cleaning')),
+                    ('changed', _('Summary and changes of the modified comments')),
+                    ('full', _('All the comments, before and after'))])
+
+FORMATTER = OrderedDict([
+                    ('headless', _('Built-in formatter (faster)')),
+                    ('calibre', _('Calibre comments editor'))])
+
+
+# Set defaults
+_defaults = {}
+_defaults[KEY.KEEP_URL] = 'keep'
+_defaults[KEY.HEADINGS] = 'none'
+_defaults[KEY.FONT_WEIGHT] = 'bold'
+_defaults[KEY.DEL_ITALIC] = False
+_defaults[KEY.DEL_UNDER] = False
+_defaults[KEY.DEL_STRIKE] = False
+_defaults[KEY.FULL_BOLD] = True
+_defaults[KEY.FULL_ITALIC] = False
+_defaults[KEY.FORCE_JUSTIFY] = 'empty'
+_defaults[KEY.LIST_ALIGN] = 'del'
+_defaults[KEY.ID_CLASS] = 'id_class'
+_defaults[KEY.CSS_KEEP_ACTIVE] = True
+_defaults[KEY.CSS_KEEP] = ''
+
+_defaults[KEY.DEL_FORMATTING] = False
+
+_defaults[KEY.MARKDOWN] = 'try'
+_defaults[KEY.DOUBLE_BR] = 'new'
+_defaults[KEY.SINGLE_BR] = 'none'
+_defaults[KEY.EMPTY_PARA] = 'merge'
+_defaults[KEY.IMG_TAG] = 'del'
+
+_defaults[KEY.ENGINE] = 'regex'
+_defaults[KEY.FORMATTER] = 'calibre'
+
+# defaults of the stored settings (config.PREFS), the cleaning settings and the job options
+_prefs_defaults = _defaults.copy()
+_prefs_defaults[KEY.CUSTOM_COLUMN] = False
+_prefs_defaults[KEY.PARALLEL] = False
+_prefs_defaults[KEY.CACHE] = True
+_prefs_defaults[KEY.CHUNKED] = False
+_prefs_defaults[KEY.PROFILE] = 'none'
+_prefs_defaults[KEY.TIME_BUDGET] = 30
+_prefs_defaults[KEY.PREFILTER] = 'skip'
+_prefs_defaults[KEY.LOG_LEVEL] = 'summary'
+_prefs_defaults[KEY.LOG_FILE] = False
+_prefs_defaults[KEY.NOTES_SETTINGS] = _defaults.copy()
+_prefs_defaults[KEY.NOTES_SETTINGS][KEY.IMG_TAG] = 'keep'
+_prefs_defaults[KEY.NOTES_SETTINGS][KEY.CSS_KEEP] = 'float'
+
+
+def notes_settings(stored: dict) -> dict:
+    '''
+    the notes settings saved, over the defaults
+    JSONConfig only apply the defaults of the top keys, the settings added since the save are missing
+    '''
+    rslt = _prefs_defaults[KEY.NOTES_SETTINGS].copy()
+    rslt.update(stored)
+    return rslt
+
+
+CSS_DEFAULT = 'text-align font-weight font-style text-decoration'
+
+
+# fix a imcompatibility betwen multiple Calibre version
+CALIBRE_VERSIONS_BOLD = CALIBRE_VERSION < (4,0,0) or CALIBRE_VERSION >= (6,0,0)
+
+if not CALIBRE_VERSIONS_BOLD:
+    FONT_WEIGHT['bold'] = FONT_WEIGHT_ALT
+
+if CALIBRE_VERSION >= (6,0,0):
+    del FONT_WEIGHT['trunc']
+
+if CALIBRE_VERSION >= (7,0,0):
+    CALIBRE_HAS_NOTES = True
+else:
+    CALIBRE_HAS_NOTES = False
+
+
+# same flags that the regex of common_utils
+FLAGS = re.ASCII + re.MULTILINE + re.DOTALL
+
+
+def css_clean_rules(css: str) -> str:
+    # remove space and invalid character
+    css = re.sub(r'[.*!()?+<>\\]', r'', css.lower(), flags=FLAGS)
+    while re.search(r'([,;:\n\r]|\s{2,})', css, FLAGS):
+        css = re.sub(r'([,;:\n\r]|\s{2,})', r' ', css, flags=FLAGS)
+    css = re.sub(r'^\s*(.*?)\s*$', r'\1', css, flags=FLAGS)
+    # split to table, remove duplicate and sorted
+    css = sorted(set(css.split(' ')))
+    # return into string
+    return ' '.join(css)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# The tests load the engine like the benchmark, over the stubs of Calibre (see benchmark/bench.py).
+# Run inside Calibre to use the real Calibre modules, and to run the tests that need them:
+#
+#   calibre-debug -c "import sys, pytest; sys.exit(pytest.main(['tests']))"
+
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+
+import bench  # noqa: E402
+from corpus import corpus  # noqa: E402
+
+try:
+    import calibre.gui2  # noqa: F401
+    HAS_CALIBRE = True
+except ImportError:
+    HAS_CALIBRE = False
+
+
+def load_plugin():
+    '''
+    import the engine of the plugin, return comments_cleaner and settings
+    '''
+    if not HAS_CALIBRE:
+        # pytest import the __init__.py of the plugin, as the parent package of the tests
+        bench.stub_module('calibre.customize')
+        return bench.load_plugin()
+    
+    plugin = types.ModuleType(bench.PACKAGE)
+    plugin.__path__ = [ROOT]
+    sys.modules[bench.PACKAGE] = plugin
+    cc = importlib.import_module(bench.PACKAGE+'.comments_cleaner')
+    settings = importlib.import_module(bench.PACKAGE+'.settings')
+    return cc, settings
+
+
+CC, SETTINGS = load_plugin()
+
+
+@pytest.fixture(scope='session')
+def cc():
+    return CC
+
+
+@pytest.fixture(scope='session')
+def settings():
+    return SETTINGS
+
+
+@pytest.fixture(scope='session')
+def texts():
+    '''
+    the comments of the benchmark, normalized
+    '''
+    return [CC.normalize_comment(t) for lst in corpus().values() for t in lst]
+
+
+@pytest.fixture
+def prefs():
+    '''
+    the default settings, with the built-in formatter
+    '''
+    rslt = dict(SETTINGS._defaults)
+    rslt[SETTINGS.KEY.FORMATTER] = 'headless'
+    return rslt
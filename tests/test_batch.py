@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# clean_batch() is run by the worker processes of the parallel cleaning,
+# its counters are summed in the Cleaner of the job for the log.
+
+
+def test_batch_counters(cc, texts, prefs):
+    # and some texts already clean, for the prefilter
+    texts = texts + [cc.Cleaner(prefs)(text) for text in texts[:50]]
+    cleaner = cc.Cleaner(prefs, prefilter='skip')
+    expected = [cleaner(text) for text in texts]
+    
+    half = len(texts) // 2
+    total = cc.Cleaner(prefs, prefilter='skip')
+    rslt = []
+    for batch in (list(enumerate(texts))[:half], list(enumerate(texts))[half:]):
+        results, counters = cc.clean_batch(prefs, batch, prefilter='skip')
+        total.add_counters(counters)
+        rslt.extend(text_out for _idx, _text_norm, text_out in results)
+    
+    assert rslt == expected
+    assert total.counters() == cleaner.counters()
+    assert cleaner.second_passes and cleaner.prefiltered
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# The built-in formatter must give the same result as the Calibre comments editor,
+# before to be the default formatter. Need the real Calibre, see conftest.py.
+
+import pytest
+from conftest import HAS_CALIBRE
+
+pytestmark = pytest.mark.skipif(not HAS_CALIBRE, reason='need the Calibre comments editor')
+
+
+@pytest.fixture(scope='module')
+def app():
+    from calibre.gui2 import ensure_app
+    ensure_app()
+
+
+def test_formatter_same_as_calibre(app, cc, texts):
+    diffs = cc.check_formatter(texts)
+    assert not diffs, f'{len(diffs)} differences, first one: {diffs[0]!r}'
+
+
+@pytest.mark.parametrize('del_formatting', [False, True])
+def test_cleaner_same_as_calibre(app, cc, settings, texts, prefs, del_formatting):
+    prefs[settings.KEY.DEL_FORMATTING] = del_formatting
+    headless = cc.Cleaner(dict(prefs, Formatter='headless'))
+    calibre = cc.Cleaner(dict(prefs, Formatter='calibre'))
+    for text in texts:
+        assert headless(text) == calibre(text)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+import importlib
+import time
+
+import bench
+
+
+def test_profiler_same_result_and_total(cc, texts, prefs):
+    profiler = importlib.import_module(bench.PACKAGE+'.profiler')
+    cleaner = cc.Cleaner(prefs)
+    expected = [cleaner(text) for text in texts]
+    
+    cleaner = cc.Cleaner(prefs)
+    prof = profiler.RuleProfiler(cleaner)
+    start = time.perf_counter()
+    with prof:
+        rslt = [cleaner(text) for text in texts]
+    elapsed = (time.perf_counter() - start) * 1000
+    assert rslt == expected
+    
+    # the steps that are not a Rule are recorded, and the time of the table add up
+    labels = {row[0] for row in prof.rows() if row[1]}
+    assert {'unnest_blocks', 'ordered_attributs', 'Cleaner.clean_css', 'Cleaner.format'} <= labels
+    total = sum(row[-1] for row in prof.rows())
+    assert 0.8 * elapsed < total <= elapsed
+    
+    # and the first substitution of apply_block_rules()
+    assert any(prof.stats[rule].calls for rule in cleaner.block_rules if rule in prof.stats)
+
+
+def test_recorder_same_rules_as_profiler(cc, texts, prefs):
+    profiler = importlib.import_module(bench.PACKAGE+'.profiler')
+    cleaner = cc.Cleaner(prefs)
+    with profiler.RuleProfiler(cleaner) as prof:
+        expected = [(cleaner(text), prof.take_fired()) for text in texts]
+    
+    with profiler.RuleRecorder(cleaner) as recorder:
+        rslt = [(cleaner(text), recorder.take_fired()) for text in texts]
+    assert rslt == expected
+    
+    # the plain text steps are recorded
+    with profiler.RuleRecorder(cleaner) as recorder:
+        cleaner('a -- b\r\nc')
+        fired = recorder.take_fired()
+    assert {'NEWLINES', 'PLAIN_DASH', 'PLAIN_DIV'} <= set(fired)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# the notes settings are a nested dict of the stored settings,
+# the ones saved before a new setting don't have it.
+
+
+def test_notes_settings_new_keys(cc, settings):
+    KEY = settings.KEY
+    stored = settings._prefs_defaults[KEY.NOTES_SETTINGS].copy()
+    del stored[KEY.ENGINE]
+    del stored[KEY.FORMATTER]
+    stored[KEY.DEL_ITALIC] = True
+    
+    prefs = settings.notes_settings(stored)
+    assert prefs[KEY.ENGINE] == settings._defaults[KEY.ENGINE]
+    assert prefs[KEY.FORMATTER] == settings._defaults[KEY.FORMATTER]
+    assert prefs[KEY.DEL_ITALIC] is True
+    assert KEY.ENGINE not in stored
+    
+    # the Cleaner of the notes read the new keys
+    prefs[KEY.FORMATTER] = 'headless'
+    assert cc.Cleaner(prefs)('<p><i>a</i></p>') == '<div>\n<p align="justify">a</p></div>'
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# The tokenizer engine must give the same result as the regular expressions, byte for byte.
+
+import pytest
+
+PRESETS = {
+    'default': {},
+    'notes': {'ImgTag': 'keep', 'CSStoKeep': 'float'},
+    'del_formatting': {'RemoveFormatting': True},
+    'markdown': {'Markdown': 'always'},
+    'aggressive': {
+        'KeepUrl': 'del', 'Headings': 'conv', 'FontWeight': 'del', 'RemoveItalic': True, 'RemoveUnderline': True,
+        'RemoveStrikethrough': True, 'ForceJustify': 'all', 'ID_Class': 'none', 'FullItalic': True,
+        'DoubleBR': 'empty', 'SingleBR': 'para', 'EmptyParagraph': 'del',
+    },
+    'mild': {
+        'Headings': 'bolder', 'FontWeight': 'none', 'ForceJustify': 'del', 'ListAlign': 'keep',
+        'CSStoKeepActive': False, 'Markdown': 'none', 'DoubleBR': 'none', 'SingleBR': 'space',
+        'EmptyParagraph': 'none', 'FullBold': False,
+    },
+}
+
+
+@pytest.mark.parametrize('preset', PRESETS)
+def test_tokenizer_same_as_regex(cc, texts, prefs, preset):
+    prefs.update(PRESETS[preset])
+    regex = cc.Cleaner(dict(prefs, Engine='regex'))
+    tokenizer = cc.Cleaner(dict(prefs, Engine='tokenizer'))
+    for text in texts:
+        assert tokenizer(text) == regex(text), text
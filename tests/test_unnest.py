@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, un_pogaz <un.pogaz@gmail.com>'
+
+
+# unnest_blocks() replaced four regex rules for the nested paragraphs,
+# the outputs of these rules on the nested <div> of the retailers are pinned here.
+
+import pytest
+
+NBSP = '\xa0'
+
+UNNEST = [
+    ('<p class="1">a<p class="2">b</p>c</p>', '<p class="1">a</p><p class="2">b</p><p class="1">c</p>'),
+    ('<p class="1"> <p class="2">b</p> </p>', '<p class="2">b</p>'),
+    ('<p class="1"> <h3>a</h3> </p>', '<h3>a</h3>'),
+    ('<p class="1"> <h3>a</h3>b</p>', '<p class="1"> <h3>a</h3>b</p>'),
+    ('<p class="1"> <p class="2">b</p> <p class="3">c</p> </p>',
+     '<p class="2">b</p><p class="3">c</p><p class="1"> </p>'),
+    ('<p class="1">a<p class="2">b</p> <p class="3">c</p> </p>',
+     '<p class="1">a</p><p class="2">b</p><p class="1"> </p><p class="3">c</p><p class="1"> </p>'),
+    ('<p class="1">a<p class="2">b</p> <p class="3">c</p>d',
+     '<p class="1">a</p><p class="2">b</p><p class="1"> <p class="3">c</p>d'),
+]
+
+
+@pytest.mark.parametrize('text, expected', UNNEST)
+def test_unnest_blocks(cc, text, expected):
+    assert cc.unnest_blocks(text) == expected
+
+
+RETAILER = [
+    (
+        ('<div><div id="description"><h3>Title</h3>\n<ul><li>a</li><li>b</li></ul>\n'
+         '<p align="justify">&nbsp;</p></div></div>'),
+        ('<div>\n<p align="justify">'+NBSP+'</p>\n<h3>Title</h3>\n<ul><li>a</li>\n<li>b</li></ul>\n'
+         '<p align="justify">'+NBSP+'</p></div>'),
+        '<div>\n<p>Title</p>\n<p>a</p>\n<p>b</p></div>',
+    ),
+    (
+        ('<div><div id="description" class="product-description"><h3 style="font-weight: bold">Title</h3>\n'
+         '<p class="p1">First <b>bold</b>.</p>\n<p class="p2">Second.</p>\n<p class="p3">Third.</p></div></div>'),
+        ('<div>\n<h3>Title</h3>\n<p align="justify">First <strong>bold</strong>.</p>\n'
+         '<p align="justify">Second.</p>\n<p align="justify">Third.</p></div>'),
+        ('<div>\n<p>Title</p>\n<p>First bold.</p>\n<p>'+NBSP+'</p>\n'
+         '<p>Second.</p>\n<p>'+NBSP+'</p>\n<p>Third.</p></div>'),
+    ),
+    (
+        '<div><div id="d"><p>a</p>\n<p>b</p></div><div><p>c</p></div></div>',
+        '<div>\n<p align="justify">a</p>\n<p align="justify">b</p>\n<p align="justify">c</p></div>',
+        '<div>\n<p>a</p>\n<p>b</p>\n<p>'+NBSP+'</p>\n<p>c</p></div>',
+    ),
+    (
+        '<div><p class="x">lead<p>a</p>\n<p>b</p>\n</p></div>',
+        '<div>\n<p align="justify">lead</p>\n<p align="justify">a</p>\n<p align="justify">b</p></div>',
+        '<div>\n<p>lead</p>\n<p>a</p>\n<p>'+NBSP+'</p>\n<p>b</p></div>',
+    ),
+    (
+        '<div><p class="x"><h3>T</h3>tail</p></div>',
+        '<div>\n<p align="justify">'+NBSP+'</p>\n<h3>T</h3>\n<p>tail</p></div>',
+        '<div>\n<p>T</p>\n<p>tail</p></div>',
+    ),
+    (
+        '<div><p class="x">\n<p>a</p>\n<p>b</p>\n</p></div>',
+        '<div>\n<p align="justify">a</p>\n<p align="justify">b</p></div>',
+        '<div>\n<p>a</p>\n<p>b</p></div>',
+    ),
+    # the outer <div> keep its attributs
+    (
+        '<div align="right" style="font-weight: bold">aa<div>bb</div>cc</div>',
+        ('<div>\n<p align="right" style=" font-weight: bold;">aa</p>\n<p align="justify">bb</p>\n'
+         '<p align="right" style=" font-weight: bold;">cc</p></div>'),
+        '<div>\n<p>aa</p>\n<p>bb</p>\n<p>cc</p></div>',
+    ),
+    (
+        '<div><div align="right">aa<div>&nbsp;</div>cc</div></div>',
+        '<div>\n<p align="right">aa</p>\n<p align="justify">'+NBSP+'</p>\n<p align="right">cc</p></div>',
+        '<div>\n<p>aa</p>\n<p>'+NBSP+'</p>\n<p>cc</p></div>',
+    ),
+]
+
+
+@pytest.mark.parametrize('text, expected, expected_del', RETAILER)
+def test_nested_div(cc, settings, prefs, text, expected, expected_del):
+    assert cc.Cleaner(prefs)(text) == expected
+    prefs[settings.KEY.DEL_FORMATTING] = True
+    assert cc.Cleaner(prefs)(text) == expected_del
+
+
+# a <script> or <center> end at the first closing tag, even after a other opening tag
+CONTENT = [
+    ('<p>x</p><script>a<script>b</script><p>VISIBLE para</p>',
+     '<div>\n<p align="justify">x</p>\n<p align="justify">VISIBLE para</p></div>'),
+    ('<p>x</p><center>a<center>b</center><p>VISIBLE para</p>',
+     ('<div>\n<p align="justify">x</p>\n<p align="center">a</p>\n<center>b</center>\n'
+      '<p align="justify">VISIBLE para</p></div>')),
+]
+
+
+@pytest.mark.parametrize('engine', ['regex', 'tokenizer'])
+@pytest.mark.parametrize('text, expected', CONTENT)
+def test_tag_content(cc, settings, prefs, engine, text, expected):
+    prefs[settings.KEY.ENGINE] = engine
+    assert cc.Cleaner(prefs)(text) == expected